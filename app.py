@@ -1,8 +1,22 @@
-import os
 from flask import Flask, request, abort, jsonify
-from models import setup_db, Movies, Actors
+from models import (setup_db, bulk_insert, update_by_id, update_many,
+                    delete_by_id, add_casting, remove_casting, parse_date,
+                    parse_age, VersionMismatch, Movies, Actors)
 from flask_cors import CORS
 from auth import AuthError, requires_auth
+from bulk import (BULK_MODES, BulkError, read_items, validate_items,
+                  validate_updates)
+from conditional import if_match_versions, row_etag
+from idempotency import idempotent
+from listing import MOVIES, ACTORS, run_list
+from instrumentation import count_error, instrument
+from metrics import registry
+from query_debug import enable_query_debug
+from replicas import enable_replicas
+from pagination import page_limit
+from search import search, decode_search_cursor
+from settings import settings
+from serializers import json_response
 
 
 def create_app(test_config=None):
@@ -10,32 +24,115 @@ def create_app(test_config=None):
     app = Flask(__name__)
     setup_db(app)
     CORS(app)
+    instrument(app)
+    if settings.QUERY_DEBUG:
+        enable_query_debug(app)
+    if settings.DATABASE_REPLICA_URLS:
+        enable_replicas(app)
+
+    # validates and inserts the items of a bulk request
+    def create_bulk(model, fields, key):
+        mode = request.args.get('mode', 'atomic')
+        if mode not in BULK_MODES:
+            abort(400)
+        try:
+            items = read_items(request)
+        except BulkError as error:
+            return jsonify({
+                            "success": False,
+                            "error": 400,
+                            "message": str(error)
+                            }), 400
+        rows, indexes, errors = validate_items(
+            items, fields, model.parsers)
+        if not rows or (errors and mode == 'atomic'):
+            return jsonify({
+                            "success": False,
+                            "error": 400,
+                            "message": "bad request",
+                            "errors": errors
+                            }), 400
+        try:
+            ids = bulk_insert(model, rows)
+        except Exception:
+            abort(422)
+        return jsonify({
+                        "success": True,
+                        key: [{"index": index, "id": new_id}
+                              for index, new_id in zip(indexes, ids)],
+                        "errors": errors
+                        }), 201
+
+    # validates and applies the items of a batch update
+    def update_bulk(model, fields, key):
+        mode = request.args.get('mode', 'atomic')
+        if mode not in BULK_MODES:
+            abort(400)
+        try:
+            items = read_items(request)
+        except BulkError as error:
+            return jsonify({
+                            "success": False,
+                            "error": 400,
+                            "message": str(error)
+                            }), 400
+        updates, indexes, errors = validate_updates(
+            items, fields, model.parsers)
+        if not updates or (errors and mode == 'atomic'):
+            return jsonify({
+                            "success": False,
+                            "error": 400,
+                            "message": "bad request",
+                            "errors": errors
+                            }), 400
+        try:
+            outcomes = update_many(model, updates)
+        except Exception:
+            abort(422)
+        results = []
+        for index, (row_id, _, _) in zip(indexes, updates):
+            status, version = outcomes[row_id]
+            results.append({"index": index, "id": row_id,
+                            "status": status, "version": version})
+        return jsonify({
+                        "success": True,
+                        key: results,
+                        "errors": errors
+                        }), 200
 
     @app.route('/')
     def get_greeting():
         greeting = "Hello"
         return greeting
 
-    # GET /movies
+    # GET /movies, see listing.list_view
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
     def get_movie(jwt):
-        try:
-            formatted_movies = []
-            movies_all = Movies.query.all()
-            for movie in movies_all:
-                formatted_movies.append(movie.format())
-            # return json response
-            return jsonify({
-                            "success": True,
-                            "movies": formatted_movies,
-                            }), 200
-        except Exception:
-            abort(422)
+        return run_list(MOVIES)
+
+    # GET /movies/<int:movie_id> with the row version as ETag
+    @app.route('/movies/<int:movie_id>', methods=['GET'])
+    @requires_auth('get:movies')
+    def get_single_movie(jwt, movie_id):
+        movie = Movies.query.get(movie_id)
+        if movie is None:
+            abort(404)
+        etag = row_etag('movies', movie_id, movie.version)
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            response = jsonify({
+                                "success": True,
+                                "movie": movie.format()
+                                })
+        response.set_etag(etag)
+        return response
 
     # POST /movies expects a body with 'title' and 'date'
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movies')
+    @idempotent
     def create_movie(jwt):
         # get json object
         body = request.get_json()
@@ -47,41 +144,61 @@ def create_app(test_config=None):
             abort(400)
         if new_date is None:
             abort(400)
+        try:
+            new_date = parse_date(new_date)
+        except ValueError:
+            abort(400)
 
         try:
             # add row in data base
             movie = Movies(title=new_title, date=new_date)
             movie.insert()
             # return json response
-            return jsonify({
-                            "success": True,
-                            "movie_id": movie.id
-                            }), 201
+            response = jsonify({
+                                "success": True,
+                                "movie_id": movie.id
+                                })
+            response.set_etag(row_etag('movies', movie.id, movie.version))
+            return response, 201
         except Exception:
             abort(422)
 
+    # POST /movies/bulk expects an array or NDJSON of movies
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    @idempotent
+    def create_movies_bulk(jwt):
+        return create_bulk(Movies, ('title', 'date'), 'movies')
+
+    # PATCH /movies expects an array or NDJSON of {id, version, ...fields}
+    @app.route('/movies', methods=['PATCH'])
+    @requires_auth('patch:movies')
+    def movies_update_batch(jwt):
+        return update_bulk(Movies, ('title', 'date'), 'movies')
+
     # DELETE /movies/<int:movie_id>
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
     @requires_auth('delete:movies')
     def delete_movie(jwt, movie_id):
         try:
-            # get movie by movie_id
-            movie = Movies.query.filter(Movies.id == movie_id).one_or_none()
-            # error 404
-            if movie is None:
-                return jsonify({
-                                'success': False,
-                                'error': 'Movie is not found',
-                                'movie_id': movie_id
-                                }), 404
-            # delete row in data base
-            movie.delete()
-            return jsonify({
-                            'success': True,
-                            'deleted': movie_id
-                            }), 200
+            # delete row in data base, if its version matches If-Match
+            deleted = delete_by_id(
+                Movies, movie_id, if_match_versions('movies', movie_id))
+        except VersionMismatch:
+            abort(412)
         except Exception:
             abort(422)
+        # error 404
+        if not deleted:
+            return jsonify({
+                            'success': False,
+                            'error': 'Movie is not found',
+                            'movie_id': movie_id
+                            }), 404
+        return jsonify({
+                        'success': True,
+                        'deleted': movie_id
+                        }), 200
 
     # PATCH /movies
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
@@ -89,46 +206,94 @@ def create_app(test_config=None):
     def movies_update(jwt, movie_id):
         # load PATCH body
         body = request.get_json()
-        # get element by id
         try:
-            movie = Movies.query.filter(Movies.id == movie_id).one_or_none()
-            # error 404
-            if movie is None:
-                abort(404)
             # prepare body
+            values = {}
             if body.get('title'):
-                movie.title = body.get('title')
+                values['title'] = body.get('title')
             if body.get('date'):
-                movie.date = body.get('date')
-            # update data base
-            movie.update()
-            return jsonify({
+                values['date'] = parse_date(body.get('date'))
+            # update data base with a single statement, if the version
+            # of the row matches If-Match
+            movie = update_by_id(Movies, movie_id, values,
+                                 if_match_versions('movies', movie_id))
+        except VersionMismatch:
+            abort(412)
+        except Exception:
+            abort(422)
+        # error 404
+        if movie is None:
+            abort(404)
+        # the returned row carries the same attributes as the model
+        response = jsonify({
                             "success": True,
-                            "updated movie": movie.format()
-                            }), 200
+                            "updated movie": Movies.format(movie)
+                            })
+        response.set_etag(row_etag('movies', movie_id, movie.version))
+        return response, 200
+
+    # POST /movies/<int:movie_id>/actors/<int:actor_id> casts an actor
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>',
+               methods=['POST'])
+    @requires_auth('patch:movies')
+    def cast_actor(jwt, movie_id, actor_id):
+        try:
+            found = add_casting(movie_id, actor_id)
         except Exception:
             abort(422)
+        if not found:
+            abort(404)
+        return jsonify({
+                        "success": True,
+                        "movie_id": movie_id,
+                        "actor_id": actor_id
+                        }), 200
 
-    # GET /actors
-    @app.route('/actors', methods=['GET'])
-    @requires_auth('get:actors')
-    def get_actor(jwt):
+    # DELETE /movies/<int:movie_id>/actors/<int:actor_id> uncasts an actor
+    @app.route('/movies/<int:movie_id>/actors/<int:actor_id>',
+               methods=['DELETE'])
+    @requires_auth('patch:movies')
+    def uncast_actor(jwt, movie_id, actor_id):
         try:
-            formatted_actors = []
-            actors_all = Actors.query.all()
-            for actor in actors_all:
-                formatted_actors.append(actor.format())
-            # return json response
-            return jsonify({
-                            "success": True,
-                            "actors": formatted_actors,
-                            }), 200
+            found = remove_casting(movie_id, actor_id)
         except Exception:
             abort(422)
+        if not found:
+            abort(404)
+        return jsonify({
+                        "success": True,
+                        "movie_id": movie_id,
+                        "deleted": actor_id
+                        }), 200
+
+    # GET /actors, see listing.list_view
+    @app.route('/actors', methods=['GET'])
+    @requires_auth('get:actors')
+    def get_actor(jwt):
+        return run_list(ACTORS)
+
+    # GET /actors/<int:actor_id> with the row version as ETag
+    @app.route('/actors/<int:actor_id>', methods=['GET'])
+    @requires_auth('get:actors')
+    def get_single_actor(jwt, actor_id):
+        actor = Actors.query.get(actor_id)
+        if actor is None:
+            abort(404)
+        etag = row_etag('actors', actor_id, actor.version)
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            response = jsonify({
+                                "success": True,
+                                "actor": actor.format()
+                                })
+        response.set_etag(etag)
+        return response
 
     # POST /actors expects a body with 'name' and 'gender' and 'age'
     @app.route('/actors', methods=['POST'])
     @requires_auth('post:actors')
+    @idempotent
     def create_actor(jwt):
         # get json object
         body = request.get_json()
@@ -143,41 +308,61 @@ def create_app(test_config=None):
             abort(400)
         if new_age is None:
             abort(400)
+        try:
+            new_age = parse_age(new_age)
+        except ValueError:
+            abort(400)
 
         try:
             # add row in data base
             actor = Actors(name=new_name, gender=new_gender, age=new_age)
             actor.insert()
             # return json response
-            return jsonify({
-                            "success": True,
-                            "actor_id": actor.id
-                            }), 201
+            response = jsonify({
+                                "success": True,
+                                "actor_id": actor.id
+                                })
+            response.set_etag(row_etag('actors', actor.id, actor.version))
+            return response, 201
         except Exception:
             abort(422)
 
+    # POST /actors/bulk expects an array or NDJSON of actors
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    @idempotent
+    def create_actors_bulk(jwt):
+        return create_bulk(Actors, ('name', 'gender', 'age'), 'actors')
+
+    # PATCH /actors expects an array or NDJSON of {id, version, ...fields}
+    @app.route('/actors', methods=['PATCH'])
+    @requires_auth('patch:actors')
+    def actors_update_batch(jwt):
+        return update_bulk(Actors, ('name', 'gender', 'age'), 'actors')
+
     # DELETE  /actors/<int:actor_id>
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
     @requires_auth('delete:actors')
     def delete_actor(jwt, actor_id):
         try:
-            # get actor by actor_id
-            actor = Actors.query.filter(Actors.id == actor_id).one_or_none()
-            # error 404
-            if actor is None:
-                return jsonify({
-                                'success': False,
-                                'error': 'Actor is not found',
-                                'actor_id': actor_id
-                                }), 404
-            # delete row in data base
-            actor.delete()
-            return jsonify({
-                            'success': True,
-                            'deleted': actor_id
-                            }), 200
+            # delete row in data base, if its version matches If-Match
+            deleted = delete_by_id(
+                Actors, actor_id, if_match_versions('actors', actor_id))
+        except VersionMismatch:
+            abort(412)
         except Exception:
             abort(422)
+        # error 404
+        if not deleted:
+            return jsonify({
+                            'success': False,
+                            'error': 'Actor is not found',
+                            'actor_id': actor_id
+                            }), 404
+        return jsonify({
+                        'success': True,
+                        'deleted': actor_id
+                        }), 200
 
     # PATCH /actors
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
@@ -185,32 +370,71 @@ def create_app(test_config=None):
     def actors_update(jwt, actor_id):
         # load PATCH body
         body = request.get_json()
-        # get element by id
         try:
-            actor = Actors.query.filter(Actors.id == actor_id).one_or_none()
-            # error 404
-            if actor is None:
-                abort(404)
             # prepare body
+            values = {}
             if body.get('name'):
-                actor.name = body.get('name')
+                values['name'] = body.get('name')
             if body.get('gender'):
-                actor.gender = body.get('gender')
+                values['gender'] = body.get('gender')
             if body.get('age'):
-                actor.age = body.get('age')
-            # update data base
-            actor.update()
-            return jsonify({
+                values['age'] = parse_age(body.get('age'))
+            # update data base with a single statement, if the version
+            # of the row matches If-Match
+            actor = update_by_id(Actors, actor_id, values,
+                                 if_match_versions('actors', actor_id))
+        except VersionMismatch:
+            abort(412)
+        except Exception:
+            abort(422)
+        # error 404
+        if actor is None:
+            abort(404)
+        # the returned row carries the same attributes as the model
+        response = jsonify({
                             "success": True,
-                            "updated actor": actor.format()
-                            }), 200
+                            "updated actor": Actors.format(actor)
+                            })
+        response.set_etag(row_etag('actors', actor_id, actor.version))
+        return response, 200
+
+    # GET /search?q= searches movie titles and actor names
+    @app.route('/search', methods=['GET'])
+    @requires_auth('get:movies', 'get:actors')
+    def search_all(jwt):
+        query = request.args.get('q', '').strip()
+        if not query:
+            abort(400)
+        try:
+            limit = page_limit(request.args)
+            after = None
+            if request.args.get('next'):
+                after = decode_search_cursor(request.args['next'])
+        except ValueError:
+            abort(400)
+        try:
+            results, next_cursor = search(query, limit, after)
+            return json_response({
+                                  "success": True,
+                                  "results": results,
+                                  "next": next_cursor
+                                  }, 200)
         except Exception:
             abort(422)
 
+    # GET /metrics in the Prometheus text format
+    @app.route('/metrics', methods=['GET'])
+    @requires_auth('get:metrics')
+    def metrics(jwt):
+        return app.response_class(
+            registry.render(),
+            content_type='text/plain; version=0.0.4; charset=utf-8')
+
     # ------------------------Error Handling -------------------
     # Error-Handler 422
     @app.errorhandler(422)
     def unprocessable(error):
+        count_error(422)
         return jsonify({
                         "success": False,
                         "error": 422,
@@ -220,15 +444,27 @@ def create_app(test_config=None):
     # Error-Handler 404
     @app.errorhandler(404)
     def resource_not_found(error):
+        count_error(404)
         return jsonify({
                         "success": False,
                         "error": 404,
                         "message": "resource not found"
                         }), 404
 
+    # Error-Handler 412
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        count_error(412)
+        return jsonify({
+                        "success": False,
+                        "error": 412,
+                        "message": "precondition failed"
+                        }), 412
+
     # Error-Handler 400
     @app.errorhandler(400)
     def bad_request(error):
+        count_error(400)
         return jsonify({
                         "success": False,
                         "error": 400,
@@ -238,6 +474,7 @@ def create_app(test_config=None):
     # Error-Handler AuthErrors
     @app.errorhandler(AuthError)
     def auth_error(error):
+        count_error(error.status_code)
         return jsonify({
                         "success": False,
                         "error": error.status_code,
@@ -247,7 +484,15 @@ def create_app(test_config=None):
     return app
 
 
-app = create_app()
+# `app` is created on first access, importing this module (manage.py, the
+# tests) builds no application and reads no configuration
+def __getattr__(name):
+    global app
+    if name != 'app':
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    app = create_app()
+    return app
+
 
 if __name__ == '__main__':
-    app.run()
+    create_app().run()
@@ -0,0 +1,225 @@
+import asyncio
+import io
+import sys
+from contextvars import ContextVar
+from a2wsgi import WSGIMiddleware
+from flask import _app_ctx_stack, _request_ctx_stack, g, request_started
+from werkzeug.local import get_ident
+from werkzeug.wrappers import Request
+from app import create_app
+from async_db import AsyncDatabase
+from auth import requires_auth_async
+from listing import LIST_ROUTES, list_view
+from models import pool_settings
+
+'''
+ASGI serving mode
+    `uvicorn asgi:app` serves the app of create_app from an event loop.
+    GET /movies and GET /actors are answered by coroutines: the signing
+    keys are fetched without blocking and the rows are read through an
+    async driver (see async_db). They run the same list_view as the
+    Flask views and go through the app's before_request and
+    after_request hooks and error handlers, so metrics, query debugging
+    and read replicas work as with gunicorn. Every other request, and
+    lists with ?stream=, runs the Flask view on a thread.
+
+    Requests in flight per process are bounded by the number of database
+    connections, DB_POOL_SIZE + DB_MAX_OVERFLOW, instead of by threads.
+'''
+
+# Werkzeug 1.0 keeps the request and app contexts per thread, the
+# coroutine views get their own entries on the context stacks instead
+_task_ident = ContextVar('task_ident', default=None)
+
+
+def context_ident():
+    ident = _task_ident.get()
+    return get_ident() if ident is None else ident
+
+
+_request_ctx_stack.__ident_func__ = context_ident
+_app_ctx_stack.__ident_func__ = context_ident
+
+
+class AsyncApp:
+    def __init__(self, flask_app, database, concurrency,
+                 statement_timeout=0):
+        self.flask_app = flask_app
+        # one thread per database connection for the Flask views
+        self.wsgi = WSGIMiddleware(wsgi_environ_fix(flask_app),
+                                   workers=concurrency)
+        self.database = database
+        self.concurrency = concurrency
+        self.statement_timeout = statement_timeout
+        # AsyncDatabase of every read replica, by engine URL
+        self.replica_databases = {}
+        self.views = {path: self.coroutine_view(route)
+                      for path, route in LIST_ROUTES.items()}
+        self._slots = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        async with self._slots:
+            view = None
+            if scope['type'] == 'http' and scope['method'] == 'GET':
+                view = self.views.get(scope['path'])
+            if view is not None:
+                environ = build_environ(scope)
+                # streamed lists keep their connection open on a thread
+                if 'stream' not in Request(environ).args:
+                    response = await self.dispatch(environ, view)
+                    return await self.send_response(environ, response, send)
+            await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.database.connect()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def close(self):
+        await self.database.close()
+        for database in self.replica_databases.values():
+            await database.close()
+
+    @staticmethod
+    async def send_response(environ, response, send):
+        app_iter, status, headers = response.get_wsgi_response(environ)
+        await send({
+            'type': 'http.response.start',
+            'status': int(status.split(' ', 1)[0]),
+            'headers': [(name.lower().encode('latin-1'),
+                         value.encode('latin-1'))
+                        for name, value in headers],
+        })
+        await send({'type': 'http.response.body', 'body': b''.join(app_iter)})
+
+    # Flask.wsgi_app and full_dispatch_request with a coroutine view
+    async def dispatch(self, environ, view):
+        app = self.flask_app
+        _task_ident.set(object())
+        ctx = app.request_context(environ)
+        error = None
+        try:
+            try:
+                ctx.push()
+                app.try_trigger_before_first_request_functions()
+                try:
+                    request_started.send(app)
+                    rv = app.preprocess_request()
+                    if rv is None:
+                        rv = await view()
+                except Exception as e:
+                    rv = app.handle_user_exception(e)
+                return app.finalize_request(rv)
+            except Exception as e:
+                error = e
+                return app.handle_exception(e)
+        finally:
+            if app.should_ignore_error(error):
+                error = None
+            ctx.auto_pop(error)
+
+    def coroutine_view(self, route):
+        @requires_auth_async(route.permission)
+        async def view(jwt):
+            database = self.database_for(g.get('db_engine'))
+            steps = list_view(route)
+            try:
+                statement = next(steps)
+                while True:
+                    try:
+                        rows = await database.fetch(statement)
+                    except Exception as error:
+                        statement = steps.throw(error)
+                    else:
+                        statement = steps.send(rows)
+            except StopIteration as done:
+                return done.value
+
+        return view
+
+    # the primary, or the replica replicas.py picked for the request
+    def database_for(self, engine):
+        if engine is None:
+            return self.database
+        url = str(engine.url)
+        if url not in self.replica_databases:
+            self.replica_databases[url] = AsyncDatabase(
+                url, self.concurrency, self.statement_timeout)
+        return self.replica_databases[url]
+
+
+# a2wsgi passes SERVER_PORT as an int or as '0' when the server address
+# is unknown, which breaks Werkzeug's host lookup for requests without a
+# Host header
+def wsgi_environ_fix(wsgi_app):
+    def fixed_app(environ, start_response):
+        port = environ.get('SERVER_PORT')
+        environ['SERVER_PORT'] = str(port) if port not in (None, 0, '0') \
+            else '80'
+        if 'HTTP_HOST' not in environ:
+            environ['HTTP_HOST'] = '{}:{}'.format(
+                environ['SERVER_NAME'], environ['SERVER_PORT'])
+        return wsgi_app(environ, start_response)
+
+    return fixed_app
+
+
+# WSGI environ of a request without body
+def build_environ(scope):
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': (scope.get('client') or ('', 0))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+    return environ
+
+
+def create_asgi_app(flask_app, database=None):
+    settings = pool_settings(flask_app.config)
+    concurrency = settings['DB_POOL_SIZE'] + settings['DB_MAX_OVERFLOW']
+    if database is None:
+        database = AsyncDatabase(
+            flask_app.config['SQLALCHEMY_DATABASE_URI'], concurrency,
+            settings['DB_STATEMENT_TIMEOUT'])
+    return AsyncApp(flask_app, database, concurrency,
+                    settings['DB_STATEMENT_TIMEOUT'])
+
+
+# created on first access like app.app, for `uvicorn asgi:app`
+def __getattr__(name):
+    global app
+    if name != 'app':
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    app = create_asgi_app(create_app())
+    return app
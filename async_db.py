@@ -0,0 +1,184 @@
+import asyncio
+import importlib.util
+import time
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.dialects.postgresql.base import PGCompiler, PGDialect
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql.compiler import SQLCompiler
+from sqlalchemy.util import KeyedTuple
+
+# the drivers are imported when a pool opens
+
+'''
+Async database access for the ASGI mode
+    Statements are built with SQLAlchemy exactly like in the Flask views
+    and compiled for the database, then run on an async driver: asyncpg
+    on Postgres, aiosqlite on SQLite. Bind and result values go through
+    the same type processors SQLAlchemy applies, so rows look like the
+    rows of Query.all(). At most `size` connections are open at a time.
+'''
+
+
+'''
+on_statement(listener)
+    registers `listener(statement, seconds)`, called after every statement
+    an AsyncDatabase ran, in the context of the request that ran it. The
+    async drivers bypass SQLAlchemy's engine events, this stands in for
+    them.
+'''
+
+statement_listeners = []
+
+
+def on_statement(listener):
+    statement_listeners.append(listener)
+    return listener
+
+
+'''
+AsyncpgDialect
+    Postgres dialect for statements run by asyncpg: parameters are
+    numbered $1, $2, ... and backslashes in literals are not doubled, the
+    servers have standard_conforming_strings on since 9.1.
+'''
+
+
+class AsyncpgCompiler(PGCompiler):
+    def bindparam_string(self, name, positional_names=None, expanding=False,
+                         **kw):
+        if expanding:
+            return super().bindparam_string(
+                name, positional_names, expanding, **kw)
+        if positional_names is not None:
+            positional_names.append(name)
+        else:
+            self.positiontup.append(name)
+        # the numeric paramstyle fills in the positions after compiling
+        return '$[_POSITION]'
+
+    def render_literal_value(self, value, type_):
+        return SQLCompiler.render_literal_value(self, value, type_)
+
+
+class AsyncpgDialect(PGDialect):
+    statement_compiler = AsyncpgCompiler
+    default_paramstyle = 'numeric'
+
+
+class SQLitePool:
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self._connections = None
+
+    async def open(self):
+        import aiosqlite
+        self._connections = asyncio.Queue()
+        for _ in range(self.size):
+            self._connections.put_nowait(await aiosqlite.connect(self.path))
+
+    async def fetch(self, sql, params):
+        connection = await self._connections.get()
+        try:
+            cursor = await connection.execute(sql, params)
+            try:
+                return await cursor.fetchall()
+            finally:
+                await cursor.close()
+        finally:
+            self._connections.put_nowait(connection)
+
+    async def close(self):
+        for _ in range(self.size):
+            connection = await self._connections.get()
+            await connection.close()
+
+
+class PostgresPool:
+    def __init__(self, dsn, size, statement_timeout=0):
+        self.dsn = dsn
+        self.size = size
+        self.statement_timeout = statement_timeout
+        self._pool = None
+
+    async def open(self):
+        import asyncpg
+        server_settings = {}
+        if self.statement_timeout:
+            server_settings['statement_timeout'] = str(self.statement_timeout)
+        self._pool = await asyncpg.create_pool(
+            self.dsn, min_size=1, max_size=self.size,
+            server_settings=server_settings)
+
+    async def fetch(self, sql, params):
+        async with self._pool.acquire() as connection:
+            return await connection.fetch(sql, *params)
+
+    async def close(self):
+        await self._pool.close()
+
+
+class AsyncDatabase:
+    def __init__(self, database_path, size, statement_timeout=0):
+        url = make_url(database_path)
+        self.size = size
+        if url.get_backend_name() in ('postgres', 'postgresql'):
+            if importlib.util.find_spec('asyncpg') is None:
+                raise RuntimeError('the ASGI mode needs asyncpg')
+            self.dialect = AsyncpgDialect()
+            dsn = 'postgresql://' + database_path.split('://', 1)[1]
+            self.pool = PostgresPool(dsn, size, statement_timeout)
+        elif url.get_backend_name() == 'sqlite':
+            if importlib.util.find_spec('aiosqlite') is None:
+                raise RuntimeError('the ASGI mode needs aiosqlite')
+            self.dialect = sqlite.dialect()
+            self.pool = SQLitePool(url.database or ':memory:', size)
+        else:
+            raise RuntimeError(
+                f'no async driver for {url.get_backend_name()}')
+        self._opened = None
+
+    async def connect(self):
+        # the first caller opens the pool, everybody else waits for it
+        if self._opened is None:
+            self._opened = asyncio.ensure_future(self.pool.open())
+        await asyncio.shield(self._opened)
+
+    async def close(self):
+        if self._opened is not None:
+            await self._opened
+            self._opened = None
+            await self.pool.close()
+
+    def compile(self, statement):
+        compiled = statement.compile(dialect=self.dialect)
+        params = []
+        for name in compiled.positiontup:
+            value = compiled.params[name]
+            process = compiled.binds[name].type.dialect_impl(self.dialect) \
+                .bind_processor(self.dialect)
+            params.append(value if process is None else process(value))
+        return compiled.string, params
+
+    # rows of a Query or a select(), with the column names as attributes
+    async def fetch(self, statement):
+        if hasattr(statement, 'statement'):
+            statement = statement.statement
+        await self.connect()
+        sql, params = self.compile(statement)
+        columns = list(statement.inner_columns)
+        labels = [column.key for column in columns]
+        processors = [column.type.dialect_impl(self.dialect)
+                      .result_processor(self.dialect, None)
+                      for column in columns]
+        start = time.perf_counter()
+        try:
+            rows = await self.pool.fetch(sql, params)
+        finally:
+            elapsed = time.perf_counter() - start
+            for listener in statement_listeners:
+                listener(sql, elapsed)
+        return [KeyedTuple([value if process is None else process(value)
+                            for value, process in zip(row, processors)],
+                           labels)
+                for row in rows]
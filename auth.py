@@ -1,16 +1,25 @@
+import asyncio
+import hashlib
 import json
 import os
-from flask import request, _request_ctx_stack, abort
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request, _request_ctx_stack, abort
 from functools import wraps
-from jose import jwt
 from urllib.request import urlopen
+from settings import settings
 
-# database_path = os.environ['DATABASE_URL']
+# jose and httpx are imported on first use, they are slow to import
 
-
-AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
-ALGORITHMS = os.environ['ALGORITHMS']
-API_AUDIENCE = os.environ['API_AUDIENCE']
+# JWKSCache options and the settings they default to
+JWKS_OPTIONS = {
+    'url': 'JWKS_URL',
+    'ttl': 'JWKS_TTL',
+    'refresh_ahead': 'JWKS_REFRESH_AHEAD',
+    'min_refetch_interval': 'JWKS_MIN_REFETCH_INTERVAL',
+    'timeout': 'JWKS_FETCH_TIMEOUT',
+}
 
 # AuthError Exception
 '''
@@ -53,15 +62,321 @@ def get_token_auth_header():
     return headers_parts[1]
 
 
+# JWKS key cache
+'''
+JWKSCache
+    Process wide cache of the signing keys published by Auth0.
+    Keys are kept for `ttl` seconds and refreshed by a daemon thread
+    `refresh_ahead` seconds before they expire. An unknown `kid` triggers
+    at most one refetch per `min_refetch_interval` seconds, so tokens with
+    made-up key ids cannot hammer the identity provider. When a refresh
+    fails the previously fetched keys stay in use.
+    get_key_async is the variant for the ASGI mode, it fetches without
+    blocking the event loop.
+    Arguments left out are taken from the settings on first use. The URL
+    can point at a local file or a stub server; use_jwks(document) serves
+    a given JWKS document instead of fetching one, e.g. the keys of an
+    offline issuer.
+'''
+
+
+class JWKSCache:
+    def __init__(self, url=None, ttl=None, refresh_ahead=None,
+                 min_refetch_interval=None, timeout=None):
+        self._options = {
+            'url': url,
+            'ttl': ttl,
+            'refresh_ahead': refresh_ahead,
+            'min_refetch_interval': min_refetch_interval,
+            'timeout': timeout,
+        }
+        self._jwks = None
+        self._keys = {}
+        self._expires_at = 0.0
+        self._last_fetch = None
+        self._inflight = None
+        self._lock = threading.Lock()
+        self._refresher = None
+        self._refresher_pid = None
+
+    # the options are resolved when one of them is first read
+    def __getattr__(self, name):
+        if name not in JWKS_OPTIONS:
+            raise AttributeError(name)
+        options = {option: value if value is not None else
+                   getattr(settings, JWKS_OPTIONS[option])
+                   for option, value in self._options.items()}
+        options['refresh_ahead'] = min(options['refresh_ahead'],
+                                       options['ttl'] / 2)
+        for option, value in options.items():
+            # options assigned since construction are kept
+            self.__dict__.setdefault(option, value)
+        return self.__dict__[name]
+
+    # serves `jwks` from now on, the URL is no longer fetched
+    def use_jwks(self, jwks):
+        with self._lock:
+            self._jwks = jwks
+            self._last_fetch = time.monotonic()
+            self._install(jwks, self._last_fetch)
+
+    def fetch(self):
+        if self._jwks is not None:
+            return self._jwks
+        jsonurl = urlopen(self.url, timeout=self.timeout)
+        return json.loads(jsonurl.read())
+
+    async def fetch_async(self):
+        try:
+            import httpx
+        except ImportError:
+            httpx = None
+        if self._jwks is not None:
+            return self._jwks
+        if httpx is not None and self.url.startswith(('http:', 'https:')):
+            async with httpx.AsyncClient(timeout=self.timeout) as client:
+                response = await client.get(self.url)
+                response.raise_for_status()
+                return response.json()
+        # file:// URLs and installs without httpx read on a thread
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.fetch)
+
+    def refresh(self):
+        with self._lock:
+            return self._refresh_locked()
+
+    def _refresh_locked(self):
+        self._last_fetch = time.monotonic()
+        return self._install(self.fetch(), self._last_fetch)
+
+    def _install(self, jwks, fetched_at):
+        self._keys = {
+            key['kid']: {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+            for key in jwks['keys'] if 'kid' in key
+        }
+        self._expires_at = fetched_at + self.ttl
+        return self._keys
+
+    def _can_refetch(self):
+        return (self._last_fetch is None or
+                time.monotonic() - self._last_fetch >=
+                self.min_refetch_interval)
+
+    def get_key(self, kid):
+        with self._lock:
+            if time.monotonic() >= self._expires_at and self._can_refetch():
+                try:
+                    self._refresh_locked()
+                except Exception:
+                    # keep serving the stale keys if we have any
+                    if not self._keys:
+                        raise
+            key = self._keys.get(kid)
+            if key is None and self._can_refetch():
+                # kid miss, the signing keys may have been rotated
+                self._refresh_locked()
+                key = self._keys.get(kid)
+        self._ensure_refresher()
+        return key
+
+    async def get_key_async(self, kid):
+        loop = asyncio.get_event_loop()
+        with self._lock:
+            stale = time.monotonic() >= self._expires_at or \
+                kid not in self._keys
+            inflight = self._inflight
+            if inflight is not None and inflight.get_loop() is not loop:
+                # left behind by a closed event loop
+                inflight = None
+            if stale and inflight is None and self._can_refetch():
+                # shared, concurrent requests await the same fetch
+                self._last_fetch = fetched_at = time.monotonic()
+                inflight = self._inflight = loop.create_task(
+                    self._fetch_async_and_install(fetched_at))
+        if stale and inflight is not None:
+            try:
+                await asyncio.shield(inflight)
+            except Exception:
+                # keep serving the stale keys if we have any
+                if not self._keys:
+                    raise
+        self._ensure_refresher()
+        return self._keys.get(kid)
+
+    async def _fetch_async_and_install(self, fetched_at):
+        try:
+            jwks = await self.fetch_async()
+            with self._lock:
+                self._install(jwks, fetched_at)
+        finally:
+            self._inflight = None
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._expires_at = 0.0
+            self._last_fetch = None
+
+    def _ensure_refresher(self):
+        # threads do not survive fork, so every worker starts its own
+        if self._refresher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._refresher_pid = os.getpid()
+            self._refresher = threading.Thread(
+                target=self._refresh_loop, name='jwks-refresh', daemon=True)
+            self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            with self._lock:
+                refresh_at = self._expires_at - self.refresh_ahead
+            time.sleep(max(refresh_at - time.monotonic(),
+                           self.min_refetch_interval))
+            try:
+                self.refresh()
+            except Exception:
+                # retried on the next round, requests keep the cached keys
+                pass
+
+
+jwks_cache = JWKSCache()
+
+
+# Verified token cache
+'''
+TokenCache
+    Bounded LRU cache mapping the SHA-256 digest of a bearer token to its
+    verified payload, so a token only pays for the RSA signature check
+    once. Entries are dropped as soon as the token's `exp` has passed and
+    tokens without `exp` are never cached. `maxsize` defaults to the
+    TOKEN_CACHE_SIZE setting.
+'''
+
+
+class TokenCache:
+    def __init__(self, maxsize=None):
+        self._maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def maxsize(self):
+        if self._maxsize is None:
+            self._maxsize = settings.TOKEN_CACHE_SIZE
+        return self._maxsize
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+    def get(self, token):
+        key = self.digest(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                payload, expires_at = entry
+                if time.time() < expires_at:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return payload
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, token, payload):
+        expires_at = payload.get('exp')
+        if self.maxsize <= 0 or not isinstance(expires_at, (int, float)):
+            return
+        key = self.digest(token)
+        with self._lock:
+            self._entries[key] = (payload, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+token_cache = TokenCache()
+
+
+# Permissions
+'''
+Payload
+    Verified JWT payload, a plain dict that additionally carries the
+    `permissions` claim as frozenset. It is built once per token and
+    reused for every request served from the token cache.
+'''
+
+
+class Payload(dict):
+    def __init__(self, claims):
+        super().__init__(claims)
+        permissions = claims.get('permissions')
+        if isinstance(permissions, (list, tuple, set, frozenset)):
+            self.permission_set = frozenset(permissions)
+        else:
+            self.permission_set = None
+
+
+'''
+Permissions
+    Compiled permission requirement of a route. Every permission in
+    `all_of` and, if given, at least one permission in `any_of` must be
+    granted. Checking is a set operation against Payload.permission_set.
+'''
+
+
+class Permissions:
+    def __init__(self, all_of=(), any_of=()):
+        self.all_of = frozenset(p for p in all_of if p)
+        self.any_of = frozenset(p for p in any_of if p)
+
+    @classmethod
+    def compile(cls, permission):
+        if isinstance(permission, cls):
+            return permission
+        if isinstance(permission, str):
+            return cls(all_of=(permission,))
+        return cls(all_of=permission)
+
+    def allowed(self, granted):
+        if not self.all_of <= granted:
+            return False
+        return not self.any_of or not self.any_of.isdisjoint(granted)
+
+
 # Check permissions
 def check_permissions(permission, payload):
-    if 'permissions' not in payload:
-        raise AuthError({
-                        'code': 'invalid_claims',
-                        'description': 'Permissions not included in JWT.'
-                        }, 400)
+    granted = getattr(payload, 'permission_set', None)
+    if granted is None:
+        if not isinstance(payload.get('permissions'), list):
+            raise AuthError({
+                            'code': 'invalid_claims',
+                            'description': 'Permissions not included in JWT.'
+                            }, 400)
+        granted = frozenset(payload['permissions'])
 
-    if permission not in payload['permissions']:
+    if not Permissions.compile(permission).allowed(granted):
         raise AuthError({
                         'code': 'unauthorized',
                         'description': 'Permission not found.'
@@ -71,31 +386,32 @@ def check_permissions(permission, payload):
 
 # Verify jwt
 def verify_decode_jwt(token):
-    # GET THE PUBLIC KEY FROM AUTH0
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    # GET THE PUBLIC KEY FROM THE JWKS CACHE
+    rsa_key = jwks_cache.get_key(token_key_id(token))
+    return decode_jwt(token, rsa_key)
+
 
+async def verify_decode_jwt_async(token):
+    rsa_key = await jwks_cache.get_key_async(token_key_id(token))
+    return decode_jwt(token, rsa_key)
+
+
+def token_key_id(token):
+    from jose import jwt
     # GET THE DATA IN THE HEADER
     unverified_header = jwt.get_unverified_header(token)
 
     # CHOOSE OUR KEY
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
+    return unverified_header['kid']
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
 
+def decode_jwt(token, rsa_key):
+    from jose import jwt
     # Finally, verify!!!
     if rsa_key:
         try:
@@ -103,12 +419,12 @@ def verify_decode_jwt(token):
             payload = jwt.decode(
                 token,
                 rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                algorithms=settings.ALGORITHMS,
+                audience=settings.API_AUDIENCE,
+                issuer='https://' + settings.AUTH0_DOMAIN + '/'
             )
 
-            return payload
+            return Payload(payload)
 
         except jwt.ExpiredSignatureError:
             raise AuthError({
@@ -133,20 +449,89 @@ def verify_decode_jwt(token):
 
 
 # Decorator
-def requires_auth(permission=''):
+'''
+requires_auth(*permissions, any_of=())
+    requires every permission in `permissions` and, if given, one of
+    `any_of`. The requirement is compiled once when the route is declared.
+'''
+
+
+def requires_auth(*permissions, any_of=()):
+    required = Permissions(all_of=permissions, any_of=any_of)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
+            start = time.perf_counter()
             try:
-                payload = verify_decode_jwt(token)
-            except Exception:
-                raise AuthError({
-                        'code': 'Authorization not valid',
-                        'description': 'Authorization is not valid'
-                        }, 401)
-            check_permissions(permission, payload)
+                payload = authenticate(required)
+            finally:
+                # read by the request instrumentation
+                g.auth_seconds = time.perf_counter() - start
             return f(payload, *args, **kwargs)
 
         return wrapper
     return requires_auth_decorator
+
+
+def authenticate(required):
+    token = get_token_auth_header()
+    payload = token_cache.get(token)
+    if payload is None:
+        start = time.perf_counter()
+        try:
+            payload = verify_decode_jwt(token)
+        except Exception:
+            raise invalid_authorization()
+        finally:
+            g.jwt_seconds = time.perf_counter() - start
+        token_cache.put(token, payload)
+    check_permissions(required, payload)
+    return payload
+
+
+async def authenticate_async(required):
+    token = get_token_auth_header()
+    payload = token_cache.get(token)
+    if payload is None:
+        start = time.perf_counter()
+        try:
+            payload = await verify_decode_jwt_async(token)
+        except Exception:
+            raise invalid_authorization()
+        finally:
+            g.jwt_seconds = time.perf_counter() - start
+        token_cache.put(token, payload)
+    check_permissions(required, payload)
+    return payload
+
+
+'''
+requires_auth_async(*permissions, any_of=())
+    requires_auth for the coroutine views of the ASGI mode, the signing
+    keys are fetched without blocking the event loop
+'''
+
+
+def requires_auth_async(*permissions, any_of=()):
+    required = Permissions(all_of=permissions, any_of=any_of)
+
+    def requires_auth_decorator(f):
+        @wraps(f)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                payload = await authenticate_async(required)
+            finally:
+                g.auth_seconds = time.perf_counter() - start
+            return await f(payload, *args, **kwargs)
+
+        return wrapper
+    return requires_auth_decorator
+
+
+def invalid_authorization():
+    return AuthError({
+                     'code': 'Authorization not valid',
+                     'description': 'Authorization is not valid'
+                     }, 401)
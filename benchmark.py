@@ -0,0 +1,377 @@
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+'''
+Benchmarks
+    Runs offline: tokens are minted by a LocalIssuer whose keys are handed
+    to auth.jwks_cache, and the data lives in a freshly seeded SQLite
+    database in a temporary directory that is removed after the run (or
+    in the database given with --database).
+    Every endpoint is driven through the Flask test client and through a
+    real threaded WSGI server, --concurrency requests at a time, and the
+    latency percentiles and throughput of every scenario are reported.
+
+    python benchmark.py --scale 100k --save baseline.json
+    python benchmark.py --scale 100k --compare baseline.json
+
+    --compare exits with status 1 when the p95 latency of a scenario grew,
+    or its throughput dropped, by more than --threshold (default 20%), and
+    with status 2 when the baseline was taken at another scale or
+    concurrency.
+    A Postgres database has to be migrated (manage.py db upgrade) first.
+'''
+
+SCALES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+SEED_CHUNK_SIZE = 10000
+WORDS = ('black', 'men', 'night', 'river', 'star', 'city', 'last', 'blue',
+         'summer', 'return', 'house', 'dark', 'road', 'king', 'love')
+
+
+# the app modules read their settings on import, so this runs first
+def configure(database_url, domain, audience):
+    os.environ['DATABASE_URL'] = database_url
+    os.environ['AUTH0_DOMAIN'] = domain
+    os.environ['ALGORITHMS'] = 'RS256'
+    os.environ['API_AUDIENCE'] = audience
+
+
+def title(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(3)).title()
+
+
+def seed(db, rows, rng):
+    from models import Movies, Actors, casting
+    for start in range(0, rows, SEED_CHUNK_SIZE):
+        count = min(SEED_CHUNK_SIZE, rows - start)
+        db.session.execute(Movies.__table__.insert(), [{
+            'title': title(rng),
+            'date': datetime.date(rng.randint(1950, 2020),
+                                  rng.randint(1, 12), 1),
+        } for _ in range(count)])
+        db.session.execute(Actors.__table__.insert(), [{
+            'name': title(rng),
+            'gender': rng.choice(('female', 'male')),
+            'age': rng.randint(5, 90),
+        } for _ in range(count)])
+        # one cast member per movie on average
+        db.session.execute(casting.insert(), [{
+            'movie_id': movie_id, 'actor_id': rng.randint(1, rows),
+        } for movie_id in range(start + 1, start + count + 1)])
+        db.session.commit()
+
+
+'''
+Scenarios
+    (name, factory) pairs, factory(i) returns the method, path and JSON
+    body of the i-th request. Deletes remove seeded rows from the top of
+    the id range, one per request, updates and castings touch the lower
+    half, which is never deleted. The i-th uncasting removes the pair the
+    i-th casting added, streams are limited to a year of movies or an age
+    of actors so that they stay comparable across scales.
+'''
+
+
+def scenarios(rows, rng):
+    from pagination import encode_cursor
+    kept = max(rows // 2, 1)
+
+    def page(path):
+        return lambda i: ('GET', path + '&next=' +
+                          encode_cursor(rng.randint(0, rows)), None)
+
+    def movie(i):
+        return {'title': title(rng), 'date': str(rng.randint(1950, 2020))}
+
+    def actor(i):
+        return {'name': title(rng), 'gender': 'female',
+                'age': rng.randint(5, 90)}
+
+    # distinct pairs for the first `kept` requests
+    def pair(i):
+        return '/movies/%d/actors/%d' % (1 + i % kept, kept - i % kept)
+
+    def year_of_movies(stream_format):
+        year = rng.randint(1950, 2020)
+        return ('GET', '/movies?stream=%s&date_from=%d-01-01'
+                '&date_to=%d-12-31' % (stream_format, year, year), None)
+
+    return [
+        ('greeting', lambda i: ('GET', '/', None)),
+        ('list movies', page('/movies?limit=50')),
+        ('list actors', page('/actors?limit=50')),
+        ('list movies with cast', page('/movies?limit=50&include=actors')),
+        ('filter actors', lambda i: (
+            'GET', '/actors?gender=female&age_min=%d&limit=50' %
+            rng.randint(5, 90), None)),
+        ('search', lambda i: (
+            'GET', '/search?q=' + rng.choice(WORDS) + '&limit=20', None)),
+        ('get movie', lambda i: (
+            'GET', '/movies/%d' % rng.randint(1, kept), None)),
+        ('get actor', lambda i: (
+            'GET', '/actors/%d' % rng.randint(1, kept), None)),
+        ('stream movies as ndjson', lambda i: year_of_movies('ndjson')),
+        ('stream movies as json', lambda i: year_of_movies('json')),
+        ('stream actors as ndjson', lambda i: (
+            'GET', '/actors?stream=ndjson&age_min=%d&age_max=%d' %
+            ((rng.randint(5, 90),) * 2), None)),
+        ('metrics', lambda i: ('GET', '/metrics', None)),
+        ('create movie', lambda i: ('POST', '/movies', movie(i))),
+        ('create actor', lambda i: ('POST', '/actors', actor(i))),
+        ('bulk create movies', lambda i: (
+            'POST', '/movies/bulk', [movie(i) for _ in range(100)])),
+        ('bulk create actors', lambda i: (
+            'POST', '/actors/bulk', [actor(i) for _ in range(100)])),
+        ('update movie', lambda i: (
+            'PATCH', '/movies/%d' % rng.randint(1, kept), {'title': 'X'})),
+        ('update actor', lambda i: (
+            'PATCH', '/actors/%d' % rng.randint(1, kept), {'age': 40})),
+        ('batch update movies', lambda i: (
+            'PATCH', '/movies', [{'id': movie_id, 'title': title(rng)}
+                                 for movie_id in rng.sample(
+                                     range(1, kept + 1), min(kept, 100))])),
+        ('batch update actors', lambda i: (
+            'PATCH', '/actors', [{'id': actor_id, 'age': rng.randint(5, 90)}
+                                 for actor_id in rng.sample(
+                                     range(1, kept + 1), min(kept, 100))])),
+        ('cast actor', lambda i: ('POST', pair(i), None)),
+        ('uncast actor', lambda i: ('DELETE', pair(i), None)),
+        ('delete movie', lambda i: ('DELETE', '/movies/%d' % (rows - i),
+                                    None)),
+        ('delete actor', lambda i: ('DELETE', '/actors/%d' % (rows - i),
+                                    None)),
+    ]
+
+
+class TestClientDriver:
+    name = 'test-client'
+
+    def __init__(self, app, token):
+        self.app = app
+        self.headers = {'Authorization': 'Bearer ' + token}
+        # a client per thread, they keep cookies
+        self.local = threading.local()
+
+    def request(self, method, path, body):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.open(path, method=method, json=body,
+                               headers=self.headers)
+        response.get_data()
+        return response.status_code
+
+    def close(self):
+        pass
+
+
+class WSGIServerDriver:
+    name = 'wsgi-server'
+
+    def __init__(self, app, token):
+        from werkzeug.serving import WSGIRequestHandler, make_server
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(self, *args, **kwargs):
+                pass
+
+        self.server = make_server('127.0.0.1', 0, app, threaded=True,
+                                  request_handler=QuietHandler)
+        self.base = 'http://127.0.0.1:%d' % self.server.server_port
+        self.token = token
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def request(self, method, path, body):
+        data = None if body is None else json.dumps(body).encode('utf-8')
+        request = Request(self.base + path, data=data, method=method,
+                          headers={'Authorization': 'Bearer ' + self.token,
+                                   'Content-Type': 'application/json'})
+        try:
+            with urlopen(request) as response:
+                response.read()
+                return response.status
+        except HTTPError as error:
+            return error.code
+
+    def close(self):
+        self.server.shutdown()
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def run_scenario(driver, factory, requests, warmup, offset,
+                 concurrency=1):
+    for i in range(warmup):
+        driver.request(*factory(offset + i))
+    # built up front, the factories share one random generator
+    batch = [factory(offset + i) for i in range(warmup, warmup + requests)]
+
+    def timed(request):
+        start = time.perf_counter()
+        status = driver.request(*request)
+        return time.perf_counter() - start, status
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        timings = list(executor.map(timed, batch))
+    elapsed = time.perf_counter() - started
+    latencies = sorted(latency for latency, _ in timings)
+    errors = sum(1 for _, status in timings if status >= 400)
+    return {
+        'requests': requests,
+        'errors': errors,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'rps': requests / elapsed if elapsed else 0.0,
+    }
+
+
+# why a baseline cannot be compared with this run, None when it can
+def incomparable(baseline, scale, concurrency):
+    if baseline.get('scale') != scale:
+        return 'the baseline was taken at scale %s, not %s' % (
+            baseline.get('scale'), scale)
+    if baseline.get('concurrency', 1) != concurrency:
+        return 'the baseline was taken at concurrency %d, not %d' % (
+            baseline.get('concurrency', 1), concurrency)
+    return None
+
+
+# returns a message for every scenario that got slower than the baseline
+def compare(results, baseline, threshold):
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if result['p95_ms'] > base['p95_ms'] * (1 + threshold):
+            regressions.append('%s: p95 %.2f ms -> %.2f ms' % (
+                key, base['p95_ms'], result['p95_ms']))
+        if result['rps'] < base['rps'] * (1 - threshold):
+            regressions.append('%s: %.1f -> %.1f requests/s' % (
+                key, base['rps'], result['rps']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the API.')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='1k')
+    parser.add_argument('--database', help='database URL (default: a new '
+                        'SQLite file seeded with --scale rows)')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='requests in flight at a time')
+    parser.add_argument('--driver', choices=('test-client', 'wsgi-server',
+                                             'all'), default='all')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--compare', help='baseline file to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    if args.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+    # refused before spending minutes on seeding and measuring
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        reason = incomparable(baseline, args.scale, args.concurrency)
+        if reason is not None:
+            print('cannot compare: ' + reason, file=sys.stderr)
+            return 2
+
+    if args.database:
+        return run(args, args.database, baseline)
+    # the seeded file can take gigabytes, it goes with the directory
+    with tempfile.TemporaryDirectory(prefix='capstone-bench-') as workdir:
+        return run(args, 'sqlite:///' + os.path.join(workdir, 'bench.db'),
+                   baseline)
+
+
+# seeds the database when it has no movies yet, then measures
+def run(args, database_url, baseline):
+    rows = SCALES[args.scale]
+    rng = random.Random(args.seed)
+    configure(database_url, 'bench.local', 'Capstone')
+    from auth import jwks_cache
+    from local_issuer import default_issuer
+    issuer = default_issuer()
+    jwks_cache.use_jwks(issuer.jwks())
+
+    from app import create_app
+    from models import db, Movies
+    app = create_app()
+    try:
+        with app.app_context():
+            if database_url.startswith('sqlite'):
+                db.create_all()
+            if db.session.query(Movies.id).first() is None:
+                print('seeding %d rows per table ...' % rows,
+                      file=sys.stderr)
+                seed(db, rows, rng)
+        return measure(args, app, issuer, rows, rng, baseline)
+    finally:
+        # open connections would keep the SQLite file from being removed
+        with app.app_context():
+            db.engine.dispose()
+
+
+# every scenario with every driver, checked against the baseline
+def measure(args, app, issuer, rows, rng, baseline):
+    drivers = (TestClientDriver, WSGIServerDriver)
+    if args.driver != 'all':
+        drivers = [d for d in drivers if d.name == args.driver]
+    token = issuer.mint()
+    results = {}
+    offset = 0
+    for driver_class in drivers:
+        driver = driver_class(app, token)
+        try:
+            for name, factory in scenarios(rows, rng):
+                result = run_scenario(driver, factory, args.requests,
+                                      args.warmup, offset, args.concurrency)
+                results[f'{driver.name}: {name}'] = result
+                print('%-45s p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms  '
+                      '%8.1f req/s  %d errors' % (
+                          f'{driver.name}: {name}', result['p50_ms'],
+                          result['p95_ms'], result['p99_ms'],
+                          result['rps'], result['errors']))
+        finally:
+            driver.close()
+        # the next driver deletes rows further down the id range
+        offset += args.requests + args.warmup
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump({'scale': args.scale,
+                       'concurrency': args.concurrency,
+                       'results': results},
+                      baseline_file, indent=2, sort_keys=True)
+    if baseline is not None:
+        regressions = compare(results, baseline['results'], args.threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression, file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
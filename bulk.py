@@ -0,0 +1,115 @@
+import json
+from settings import settings
+
+BULK_MODES = ('atomic', 'partial')
+
+'''
+Bulk create and update helpers
+    The body of POST /movies/bulk and POST /actors/bulk, and of the batch
+    updates PATCH /movies and PATCH /actors, is either a JSON array or
+    NDJSON (Content-Type: application/x-ndjson). Every item is validated
+    up front and reported by its index, then the valid items are written
+    in one transaction.
+'''
+
+
+class BulkError(ValueError):
+    pass
+
+
+# returns a list of (index, item or None, error or None)
+def read_items(request):
+    if request.mimetype == 'application/x-ndjson':
+        items = []
+        lines = request.get_data(as_text=True).splitlines()
+        for index, line in enumerate(
+                line for line in lines if line.strip()):
+            try:
+                items.append((index, json.loads(line), None))
+            except ValueError:
+                items.append((index, None, 'invalid JSON'))
+    else:
+        body = request.get_json(silent=True)
+        if not isinstance(body, list):
+            raise BulkError('body must be a JSON array')
+        items = [(index, item, None) for index, item in enumerate(body)]
+    if not items:
+        raise BulkError('no items sent')
+    if len(items) > settings.BULK_MAX_ITEMS:
+        raise BulkError(
+            f'at most {settings.BULK_MAX_ITEMS} items per request')
+    return items
+
+
+# returns the rows to insert, their indexes and the per-item errors
+def validate_items(items, fields, parsers):
+    rows = []
+    indexes = []
+    errors = []
+    for index, item, error in items:
+        if error is None and not isinstance(item, dict):
+            error = 'item must be a JSON object'
+        if error is None:
+            missing = [field for field in fields if item.get(field) is None]
+            if missing:
+                error = 'missing ' + ', '.join(missing)
+        if error is None:
+            row = {}
+            for field in fields:
+                parse = parsers.get(field)
+                try:
+                    row[field] = item[field] if parse is None \
+                        else parse(item[field])
+                except ValueError:
+                    error = 'invalid ' + field
+                    break
+        if error is not None:
+            errors.append({'index': index, 'error': error})
+            continue
+        rows.append(row)
+        indexes.append(index)
+    return rows, indexes, errors
+
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+# returns the (id, version, values) updates, their indexes and the errors
+def validate_updates(items, fields, parsers):
+    updates = []
+    indexes = []
+    errors = []
+    seen = set()
+    for index, item, error in items:
+        if error is None and not isinstance(item, dict):
+            error = 'item must be a JSON object'
+        if error is None and not is_int(item.get('id')):
+            error = 'missing id'
+        if error is None and item['id'] in seen:
+            error = 'duplicate id'
+        version = None if error is not None else item.get('version')
+        if version is not None and not is_int(version):
+            error = 'invalid version'
+        values = {}
+        if error is None:
+            for field in fields:
+                if item.get(field) is None:
+                    continue
+                parse = parsers.get(field)
+                try:
+                    values[field] = item[field] if parse is None \
+                        else parse(item[field])
+                except ValueError:
+                    error = 'invalid ' + field
+                    break
+            else:
+                if not values:
+                    error = 'nothing to update'
+        if error is not None:
+            errors.append({'index': index, 'error': error})
+            continue
+        seen.add(item['id'])
+        updates.append((item['id'], version, values))
+        indexes.append(index)
+    return updates, indexes, errors
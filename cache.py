@@ -0,0 +1,255 @@
+import base64
+import importlib.util
+import json
+import threading
+import time
+from collections import OrderedDict
+from flask import Response, g, request
+from models import on_write
+from settings import settings
+
+'''
+Cache backends
+    get(key) returns the value or None, set(key, value, ttl) stores it,
+    incr(key) atomically increments a counter and returns the new value
+    and counter(key) reads it.
+'''
+
+
+class LRUCacheBackend:
+    def __init__(self, maxsize=None):
+        if maxsize is None:
+            maxsize = settings.RESPONSE_CACHE_SIZE
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        # counters are kept apart so eviction can never reset them
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def incr(self, key):
+        with self._lock:
+            value = self._counters.get(key, 0) + 1
+            self._counters[key] = value
+            return value
+
+    def counter(self, key):
+        return self._counters.get(key, 0)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._counters.clear()
+
+
+'''
+SharedCacheBackend
+    interface of a cache shared by all workers, e.g. Redis or memcached.
+    Values cross process boundaries, so they are stored as bytes: the
+    response entries (body, status, mimetype) as JSON with the body base64
+    encoded, never pickled, so whoever can write to the cache cannot run
+    code in the app.
+'''
+
+
+class SharedCacheBackend:
+    def get_bytes(self, key):
+        raise NotImplementedError
+
+    def set_bytes(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def incr(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def counter(self, key):
+        value = self.get_bytes(key)
+        return 0 if value is None else int(value)
+
+    def get(self, key):
+        value = self.get_bytes(key)
+        if value is None:
+            return None
+        body, status, mimetype = json.loads(value)
+        return base64.b64decode(body), status, mimetype
+
+    def set(self, key, value, ttl=None):
+        body, status, mimetype = value
+        self.set_bytes(key, json.dumps([base64.b64encode(body).decode(),
+                                        status, mimetype]).encode(), ttl)
+
+
+'''
+RedisCacheBackend
+    SharedCacheBackend on a Redis server, RESPONSE_CACHE_BACKEND=redis.
+    Keys are prefixed so clear() only drops the entries of this cache.
+'''
+
+
+class RedisCacheBackend(SharedCacheBackend):
+    PREFIX = 'response_cache:'
+
+    def __init__(self, url=None, client=None):
+        if client is None:
+            if importlib.util.find_spec('redis') is None:
+                raise RuntimeError('RESPONSE_CACHE_BACKEND=redis needs redis')
+            import redis
+            client = redis.Redis.from_url(
+                url or settings.RESPONSE_CACHE_URL)
+        self.client = client
+
+    def get_bytes(self, key):
+        return self.client.get(self.PREFIX + key)
+
+    def set_bytes(self, key, value, ttl=None):
+        # Redis expiries are whole milliseconds and at least 1
+        expires = None if ttl is None else max(1, int(ttl * 1000))
+        self.client.set(self.PREFIX + key, value, px=expires)
+
+    def incr(self, key):
+        return self.client.incr(self.PREFIX + key)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.PREFIX + '*'))
+        if keys:
+            self.client.delete(*keys)
+
+
+'''
+FakeSharedCache
+    in memory stand-in for a shared cache, used by the tests
+'''
+
+
+class FakeSharedCache(SharedCacheBackend):
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get_bytes(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+            return value
+
+    def set_bytes(self, key, value, ttl=None):
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+
+    def incr(self, key):
+        with self._lock:
+            value, expires_at = self._entries.get(key, (b'0', None))
+            value = int(value) + 1
+            self._entries[key] = (str(value).encode('ascii'), expires_at)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+'''
+ResponseCache
+    read-through cache of successful GET responses. Entries live in a
+    namespace, one per table, and are keyed by the generation of that
+    namespace, the ETag of the response if there is one and the full
+    request path. invalidate(namespace) bumps the generation, which
+    orphans every entry of the namespace at once; it is called after
+    every commit that wrote to the table.
+'''
+
+
+class ResponseCache:
+    def __init__(self, backend=None, ttl=None):
+        self._backend = backend
+        self._ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    # DEFAULT_BACKEND and the TTL are resolved from the settings on first use
+    @property
+    def backend(self):
+        if self._backend is DEFAULT_BACKEND:
+            self._backend = default_backend()
+        return self._backend
+
+    @backend.setter
+    def backend(self, backend):
+        self._backend = backend
+
+    @property
+    def ttl(self):
+        if self._ttl is None:
+            self._ttl = settings.RESPONSE_CACHE_TTL
+        return self._ttl
+
+    def key(self, namespace):
+        generation = self.backend.counter(f'{namespace}:generation')
+        return '{}:{}:{}:{}'.format(
+            namespace, generation, g.get('etag', ''), request.full_path)
+
+    def invalidate(self, namespace):
+        if self.backend is not None:
+            self.backend.incr(f'{namespace}:generation')
+
+    # returns the cached response of the current request or None
+    def lookup(self, key):
+        entry = self.backend.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        body, status, mimetype = entry
+        return Response(body, status=status, mimetype=mimetype)
+
+    def store(self, key, response):
+        if response.status_code == 200 and not response.is_streamed:
+            self.backend.set(key, (response.get_data(),
+                                   response.status_code,
+                                   response.mimetype), self.ttl)
+
+
+DEFAULT_BACKEND = object()
+
+
+def default_backend():
+    backend = settings.RESPONSE_CACHE_BACKEND
+    if backend == 'lru':
+        return LRUCacheBackend()
+    if backend == 'redis':
+        return RedisCacheBackend()
+    if backend == 'none':
+        return None
+    raise ValueError(f'unknown RESPONSE_CACHE_BACKEND {backend!r}')
+
+
+response_cache = ResponseCache(DEFAULT_BACKEND)
+on_write(response_cache.invalidate)
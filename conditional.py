@@ -0,0 +1,59 @@
+import hashlib
+from flask import request
+
+'''
+Conditional GET
+    List responses carry a strong ETag built from the write counter of
+    the table (see models.table_version) and the query string, plus the
+    version of the embedded table for `?include=` requests. A request
+    whose If-None-Match matches is answered with 304 after a single
+    primary key lookup, without reading or serializing any row (see
+    listing.list_view).
+
+    The version is read before the rows, so a write in between can only
+    pair newer rows with an older ETag, which costs the client one extra
+    full response but never hides a change.
+'''
+
+
+# tables whose versions make up the ETag of a list request
+def etag_tables(table_name, args, related=()):
+    names = (table_name,)
+    if args.get('include') in related:
+        names += (args['include'],)
+    return names
+
+
+# `versions` maps the names of etag_tables to their table versions
+def list_etag(table_name, args, related, versions):
+    query = '&'.join(f'{key}={value}'
+                     for key, value in sorted(args.items(multi=True)))
+    variant = hashlib.sha1(query.encode('utf-8')).hexdigest()[:16]
+    names = etag_tables(table_name, args, related)
+    return '-'.join([table_name] + [str(versions[name]) for name in names] +
+                    [variant])
+
+
+'''
+Conditional writes
+    A single movie or actor carries the strong ETag
+    "<table>-<id>-v<version>" of its row version. If-Match on PATCH and
+    DELETE names the versions the client has seen; the UPDATE or DELETE
+    statement itself only matches while the row still has one of them, so
+    a concurrent change is answered with 412 without any locking.
+'''
+
+
+def row_etag(table_name, row_id, version):
+    return f'{table_name}-{row_id}-v{version}'
+
+
+# versions accepted by If-Match, None when there is no condition
+def if_match_versions(table_name, row_id):
+    if_match = request.if_match
+    if not if_match or if_match.star_tag:
+        return None
+    prefix = row_etag(table_name, row_id, '')
+    # If-Match compares strong ETags only
+    return set(int(tag[len(prefix):]) for tag in if_match.as_set()
+               if tag.startswith(prefix) and tag[len(prefix):].isdigit())
@@ -0,0 +1,41 @@
+from sqlalchemy import func
+from models import parse_age, parse_date, Movies, Actors
+
+'''
+List filters
+    GET /movies?title=&date_from=&date_to= and
+    GET /actors?name=&gender=&age_min=&age_max= narrow the list on the
+    database side. `title` and `name` match case insensitive prefixes,
+    which the lower(...) text_pattern_ops indexes serve; dates and ages
+    are ranges on btree indexes. Bad values raise ValueError.
+'''
+
+
+def _prefix(column, value):
+    escaped = value.lower().replace('\\', '\\\\') \
+        .replace('%', '\\%').replace('_', '\\_')
+    return func.lower(column).like(escaped + '%', escape='\\')
+
+
+def movie_filters(args):
+    criteria = []
+    if args.get('title'):
+        criteria.append(_prefix(Movies.title, args['title']))
+    if args.get('date_from'):
+        criteria.append(Movies.date >= parse_date(args['date_from']))
+    if args.get('date_to'):
+        criteria.append(Movies.date <= parse_date(args['date_to']))
+    return criteria
+
+
+def actor_filters(args):
+    criteria = []
+    if args.get('name'):
+        criteria.append(_prefix(Actors.name, args['name']))
+    if args.get('gender'):
+        criteria.append(Actors.gender == args['gender'])
+    if args.get('age_min'):
+        criteria.append(Actors.age >= parse_age(args['age_min']))
+    if args.get('age_max'):
+        criteria.append(Actors.age <= parse_age(args['age_max']))
+    return criteria
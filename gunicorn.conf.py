@@ -0,0 +1,76 @@
+import multiprocessing
+import os
+
+'''
+Gunicorn settings, loaded by
+`gunicorn --config gunicorn.conf.py "app:create_app()"`
+    Workers, threads and pools are sized from the CPU count and the
+    database: the DB_MAX_CONNECTIONS of the database are split between
+    the WEB_DYNOS dynos, every dyno starts 2 * CPUs + 1 workers (at most
+    one per connection) and the connections of the dyno are split
+    between its workers as their DB_POOL_SIZE, without overflow. A worker
+    runs one thread per pooled connection. WEB_CONCURRENCY,
+    GUNICORN_THREADS, DB_POOL_SIZE and DB_MAX_OVERFLOW override the
+    computed values.
+
+    The app is imported once in the master (preload_app) and shared with
+    the workers copy-on-write. SQLAlchemy connections must not cross the
+    fork, so the engine is disposed before forking and again in every
+    new worker.
+'''
+
+# connection limit of the database plan, Heroku hobby databases allow 20
+DB_MAX_CONNECTIONS = int(os.environ.get('DB_MAX_CONNECTIONS', 20))
+# web dynos sharing the database, Heroku does not tell a dyno how many
+WEB_DYNOS = int(os.environ.get('WEB_DYNOS', 1))
+
+
+def worker_count(cpu_count, connections):
+    return max(1, min(2 * cpu_count + 1, connections))
+
+
+def pool_size(workers, connections):
+    return max(1, connections // workers)
+
+
+dyno_connections = max(1, DB_MAX_CONNECTIONS // max(WEB_DYNOS, 1))
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', worker_count(
+    multiprocessing.cpu_count(), dyno_connections)))
+# read by models.pool_settings when the preloaded app builds its engine
+os.environ.setdefault('DB_POOL_SIZE',
+                      str(pool_size(workers, dyno_connections)))
+os.environ.setdefault('DB_MAX_OVERFLOW', '0')
+threads = int(os.environ.get('GUNICORN_THREADS',
+                             max(int(os.environ['DB_POOL_SIZE']), 1)))
+worker_class = 'gthread' if threads > 1 else 'sync'
+
+preload_app = True
+
+# recycle workers now and then, jittered so they do not restart together
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER',
+                                         max_requests // 10))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+
+def dispose_engine():
+    from models import db
+    if db.app is not None:
+        db.engine.dispose()
+        router = db.app.extensions.get('replicas')
+        for replica in router.replicas if router is not None else ():
+            replica.engine.dispose()
+
+
+def pre_fork(server, worker):
+    # the master closes its connections, so no socket is inherited
+    dispose_engine()
+
+
+def post_fork(server, worker):
+    # a fresh pool per worker
+    dispose_engine()
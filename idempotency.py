@@ -0,0 +1,197 @@
+import hashlib
+import json
+import logging
+import time
+from functools import wraps
+from flask import Response, abort, jsonify, make_response, request
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from models import db, IdempotencyKeys
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+'''
+Idempotency keys
+    A POST sent with an `Idempotency-Key` header runs once per key and
+    client: the first request claims the key by inserting its row, a
+    retry with the same key gets the stored response replayed (marked
+    with `Idempotent-Replayed: true`) without touching the tables again.
+    A duplicate arriving while the first request is still running waits
+    for its response, polling the row, for up to IDEMPOTENCY_WAIT seconds
+    and is answered with 409 after that. Reusing a key for a different
+    request, including the same body with another query string, is
+    answered with 422.
+
+    Only responses below 400 are stored, an error releases the key so
+    the request can be retried. A response that cannot be stored after
+    its write committed keeps the key claimed, so a retry is answered
+    with 409 instead of writing twice. A first request that never finished is
+    taken over after IDEMPOTENCY_LOCK_TIMEOUT seconds. Stored responses
+    are replayed for IDEMPOTENCY_TTL seconds; `python manage.py
+    purge_idempotency_keys` deletes the expired rows.
+'''
+
+MAX_KEY_LENGTH = 255
+# tries to store a response whose write has committed
+STORE_ATTEMPTS = 3
+# headers of a stored response that are replayed
+STORED_HEADERS = ('Content-Type', 'ETag', 'Location')
+
+
+class KeyInFlight(Exception):
+    pass
+
+
+class KeyReused(Exception):
+    pass
+
+
+def fingerprint():
+    digest = hashlib.sha256(
+        f'{request.method} {request.full_path}\n'.encode())
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def key_filter(owner, key):
+    table = IdempotencyKeys.__table__
+    return (table.c.owner == owner) & (table.c.key == key)
+
+
+# returns None once the key is ours, the stored row when it is done
+def claim(owner, key, request_fingerprint):
+    table = IdempotencyKeys.__table__
+    deadline = time.monotonic() + settings.IDEMPOTENCY_WAIT
+    delay = 0.01
+    while True:
+        now = time.time()
+        try:
+            db.session.execute(table.insert().values(
+                owner=owner, key=key, fingerprint=request_fingerprint,
+                created_at=now, expires_at=now + settings.IDEMPOTENCY_TTL))
+            db.session.commit()
+            return None
+        except IntegrityError:
+            db.session.rollback()
+        row = db.session.execute(
+            select([table]).where(key_filter(owner, key))).first()
+        # ends the read, so the next poll sees new commits
+        db.session.rollback()
+        if row is None:
+            # released in between, claim it again
+            continue
+        abandoned = row.status is None and \
+            row.created_at + settings.IDEMPOTENCY_LOCK_TIMEOUT <= now
+        if row.expires_at <= now or abandoned:
+            # removes exactly this row, a concurrent taker wins the insert
+            db.session.execute(table.delete().where(
+                key_filter(owner, key) &
+                (table.c.created_at == row.created_at)))
+            db.session.commit()
+            continue
+        if row.fingerprint != request_fingerprint:
+            raise KeyReused()
+        if row.status is not None:
+            return row
+        if time.monotonic() >= deadline:
+            raise KeyInFlight()
+        time.sleep(delay)
+        delay = min(delay * 2, 0.25)
+
+
+def store(owner, key, response):
+    table = IdempotencyKeys.__table__
+    headers = {name: response.headers[name] for name in STORED_HEADERS
+               if name in response.headers}
+    db.session.execute(table.update().where(key_filter(owner, key)).values(
+        status=response.status_code, headers=json.dumps(headers),
+        body=response.get_data()))
+    db.session.commit()
+
+
+def release(owner, key):
+    table = IdempotencyKeys.__table__
+    try:
+        db.session.execute(table.delete().where(
+            key_filter(owner, key) & table.c.status.is_(None)))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def replay(row):
+    response = Response(row.body, status=row.status)
+    for name, value in json.loads(row.headers).items():
+        response.headers[name] = value
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+# deletes the expired keys and returns how many there were
+def purge_expired(now=None):
+    table = IdempotencyKeys.__table__
+    result = db.session.execute(table.delete().where(
+        table.c.expires_at <= (time.time() if now is None else now)))
+    db.session.commit()
+    return result.rowcount
+
+
+'''
+idempotent
+    decorator for views wrapped by requires_auth, keys are kept per token
+    subject so clients cannot replay each other's responses
+'''
+
+
+def idempotent(f):
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return f(payload, *args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            abort(400)
+        owner = payload.get('sub', '')
+        try:
+            row = claim(owner, key, fingerprint())
+        except KeyInFlight:
+            return jsonify({
+                            "success": False,
+                            "error": 409,
+                            "message": "a request with this Idempotency-Key"
+                                       " is in progress"
+                            }), 409
+        except KeyReused:
+            return jsonify({
+                            "success": False,
+                            "error": 422,
+                            "message": "Idempotency-Key was used for a"
+                                       " different request"
+                            }), 422
+        if row is not None:
+            return replay(row)
+        try:
+            response = make_response(f(payload, *args, **kwargs))
+        except Exception:
+            release(owner, key)
+            raise
+        if response.status_code >= 400:
+            release(owner, key)
+            return response
+        # the write has committed, releasing the key would let a retry
+        # write again, so the key stays claimed when storing fails
+        for attempt in range(STORE_ATTEMPTS):
+            try:
+                store(owner, key, response)
+                break
+            except Exception as error:
+                db.session.rollback()
+                failure = error
+        else:
+            logger.error('could not store the response of Idempotency-Key'
+                         ' %r', key, exc_info=failure)
+        return response
+
+    return wrapper
@@ -0,0 +1,142 @@
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from async_db import on_statement
+from auth import token_cache
+from cache import response_cache
+from metrics import registry, histogram_samples
+from models import pool_metrics
+
+'''
+Request instrumentation
+    instrument(app) records for every request, labelled by the route
+    rule, the method and the status: the latency, the response size and
+    the number and duration of the SQL statements it ran. Time spent in
+    requires_auth and in JWT verification is recorded per route as well,
+    and the error handlers count their responses by status code.
+    GET /metrics renders everything in the Prometheus text format.
+
+    Metrics live in the process, every gunicorn worker reports its own.
+    Streamed responses are measured until their first byte.
+'''
+
+REQUEST_LABELS = ('endpoint', 'method', 'status')
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+request_duration = registry.histogram(
+    'http_request_duration_seconds', 'Time spent answering a request.',
+    REQUEST_LABELS)
+response_size = registry.histogram(
+    'http_response_size_bytes', 'Size of the response body.',
+    REQUEST_LABELS, SIZE_BUCKETS)
+request_queries = registry.histogram(
+    'http_request_db_queries', 'SQL statements run by a request.',
+    REQUEST_LABELS, QUERY_BUCKETS)
+request_db_time = registry.histogram(
+    'http_request_db_seconds', 'Time a request spent in SQL statements.',
+    REQUEST_LABELS)
+auth_duration = registry.histogram(
+    'auth_seconds', 'Time spent in requires_auth.', ('endpoint',))
+jwt_duration = registry.histogram(
+    'jwt_verify_seconds', 'Time spent verifying a JWT.', ('endpoint',))
+errors = registry.counter(
+    'http_errors_total', 'Responses of the error handlers.', ('code',))
+
+
+def count_error(code):
+    errors.labels(code).inc()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context,
+                      executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context,
+                     executemany):
+    record_query(conn)
+
+
+@event.listens_for(Engine, 'handle_error')
+def stop_failed_query_timer(context):
+    if context.connection is not None:
+        record_query(context.connection)
+
+
+def record_query(conn):
+    starts = conn.info.get('query_start')
+    if starts:
+        count_query(None, time.perf_counter() - starts.pop())
+
+
+# counts a statement of the request, the async driver of the ASGI mode
+# reports its statements here as well
+@on_statement
+def count_query(statement, elapsed):
+    if has_request_context():
+        g.db_queries = g.get('db_queries', 0) + 1
+        g.db_seconds = g.get('db_seconds', 0.0) + elapsed
+
+
+def start_request():
+    g.request_start = time.perf_counter()
+
+
+def record_request(response):
+    start = g.get('request_start')
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    labels = (endpoint, request.method, response.status_code)
+    if start is not None:
+        request_duration.labels(*labels).observe(
+            time.perf_counter() - start)
+    if response.content_length is not None:
+        response_size.labels(*labels).observe(response.content_length)
+    request_queries.labels(*labels).observe(g.get('db_queries', 0))
+    request_db_time.labels(*labels).observe(g.get('db_seconds', 0.0))
+    if 'auth_seconds' in g:
+        auth_duration.labels(endpoint).observe(g.auth_seconds)
+    if 'jwt_seconds' in g:
+        jwt_duration.labels(endpoint).observe(g.jwt_seconds)
+    return response
+
+
+def instrument(app):
+    app.before_request(start_request)
+    app.after_request(record_request)
+
+
+@registry.collector
+def collect_pool():
+    pool = pool_metrics()
+    metrics = [
+        ('db_pool_checkout_wait_seconds',
+         'Time a checkout waited for a free connection.', 'histogram',
+         histogram_samples('db_pool_checkout_wait_seconds',
+                           pool['checkout_wait'])),
+        ('db_pool_checkout_timeouts_total',
+         'Checkouts that gave up after the pool timeout.', 'counter',
+         [('db_pool_checkout_timeouts_total', [],
+           pool['checkout_timeouts'])]),
+    ]
+    for name in ('size', 'checked_out', 'overflow'):
+        if name in pool:
+            metrics.append((f'db_pool_{name}',
+                            f'Connection pool {name.replace("_", " ")}.',
+                            'gauge', [(f'db_pool_{name}', [], pool[name])]))
+    return metrics
+
+
+@registry.collector
+def collect_caches():
+    return [
+        (f'{name}_{outcome}_total', f'{name.replace("_", " ").capitalize()} '
+         f'{outcome}.', 'counter',
+         [(f'{name}_{outcome}_total', [], getattr(cache, outcome))])
+        for name, cache in (('response_cache', response_cache),
+                            ('token_cache', token_cache))
+        for outcome in ('hits', 'misses')
+    ]
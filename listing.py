@@ -0,0 +1,125 @@
+from collections import namedtuple
+from flask import Response, abort, g, request
+from sqlalchemy.orm import Query
+from werkzeug.exceptions import HTTPException
+from cache import response_cache
+from conditional import etag_tables, list_etag
+from filters import movie_filters, actor_filters
+from models import db, select_table_versions, Movies, Actors
+from pagination import page_args, page_query, split_page
+from serializers import (parse_fields, parse_include, select_rows,
+                         field_positions, to_dict, related_query,
+                         group_related, json_response)
+from streaming import STREAM_FORMATS, stream_response
+
+'''
+List views
+    GET /movies and GET /actors for both serving modes. list_view(route)
+    is a generator holding the whole view: it yields every statement it
+    needs and is sent back the rows, or has the error of the statement
+    thrown in, and returns the response. run_list drives it with the
+    session for the Flask views, asgi.py drives it with the async driver,
+    so both modes answer with the same status codes, headers and bytes.
+
+    The list carries a strong ETag made of the table versions (see
+    conditional.py), a matching If-None-Match is answered with 304 after
+    one primary key lookup, and full responses go through the response
+    cache.
+'''
+
+ListRoute = namedtuple('ListRoute', 'model permission filters related')
+
+MOVIES = ListRoute(Movies, 'get:movies', movie_filters, 'actors')
+ACTORS = ListRoute(Actors, 'get:actors', actor_filters, 'movies')
+LIST_ROUTES = {'/movies': MOVIES, '/actors': ACTORS}
+
+
+def list_view(route):
+    model = route.model
+    name = model.__tablename__
+    related = (route.related,)
+    key = None
+    # a failing statement answers 422, as the views always did
+    try:
+        # the versions are read before the rows, see conditional.py
+        tables = etag_tables(name, request.args, related)
+        versions = dict.fromkeys(tables, 0)
+        rows = yield select_table_versions(tables)
+        versions.update((row.name, row.version) for row in rows)
+        etag = g.etag = list_etag(name, request.args, related, versions)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        if response_cache.backend is not None:
+            key = response_cache.key(name)
+            response = response_cache.lookup(key)
+            if response is not None:
+                response.set_etag(etag)
+                return response
+        # read the requested columns and relations
+        try:
+            fields = parse_fields(request.args, model)
+            include = parse_include(request.args, model)
+            criteria = route.filters(request.args)
+        except ValueError:
+            abort(400)
+        query = select_rows(model, fields).filter(*criteria)
+        # stream the whole table on ?stream=ndjson or ?stream=json
+        stream_format = request.args.get('stream')
+        if stream_format is not None:
+            if stream_format not in STREAM_FORMATS or include is not None:
+                abort(400)
+            return stream_response(query, model, fields, name,
+                                   stream_format)
+        # read page size and cursor
+        try:
+            limit, after_id = page_args(request.args)
+        except ValueError:
+            abort(400)
+        rows = yield page_query(query, model.id, limit, after_id)
+        rows, next_cursor = split_page(rows, limit)
+        positions = field_positions(query, fields, model.encoders)
+        formatted = [to_dict(row, positions) for row in rows]
+        # embed the related rows with one query for the whole page
+        if include is not None and rows:
+            ids = [row.id for row in rows]
+            related_rows = yield related_query(model, include, ids)
+            embedded = group_related(model, include, ids, related_rows)
+            for row, formatted_row in zip(rows, formatted):
+                formatted_row[include] = embedded[row.id]
+        response = json_response({
+                                  "success": True,
+                                  name: formatted,
+                                  "next": next_cursor
+                                  }, 200)
+    except HTTPException:
+        raise
+    except Exception:
+        abort(422)
+    if key is not None:
+        response_cache.store(key, response)
+    response.set_etag(etag)
+    return response
+
+
+def fetch(statement):
+    if isinstance(statement, Query):
+        return statement.all()
+    return db.session.execute(statement).fetchall()
+
+
+# runs list_view(route) on the session, for the Flask views
+def run_list(route):
+    steps = list_view(route)
+    try:
+        statement = next(steps)
+        while True:
+            try:
+                rows = fetch(statement)
+            except Exception as error:
+                statement = steps.throw(error)
+            else:
+                statement = steps.send(rows)
+    except StopIteration as done:
+        return done.value
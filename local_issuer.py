@@ -0,0 +1,76 @@
+import base64
+import json
+import os
+import time
+import uuid
+from Crypto.PublicKey import RSA
+from jose import jwt
+
+'''
+LocalIssuer
+    offline stand-in for Auth0: generates an RS256 signing key, mints
+    tokens with any permissions and expiry and publishes the matching
+    JWKS document, which testing.py and benchmark.py hand to
+    auth.jwks_cache.use_jwks(). Used by the tests and the benchmarks,
+    never by production code.
+'''
+
+ALL_PERMISSIONS = ('get:movies', 'get:actors', 'post:movies', 'post:actors',
+                   'patch:movies', 'patch:actors', 'delete:movies',
+                   'delete:actors', 'get:metrics')
+
+
+def b64_int(value):
+    raw = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+class LocalIssuer:
+    def __init__(self, domain, audience, bits=2048):
+        self.domain = domain
+        self.audience = audience
+        self.key = RSA.generate(bits)
+        self.kid = uuid.uuid4().hex
+        self._pem = self.key.exportKey('PEM').decode('ascii')
+
+    def mint(self, permissions=ALL_PERMISSIONS, expires_in=3600,
+             subject='local|tester', **claims):
+        now = int(time.time())
+        payload = {
+            'iss': f'https://{self.domain}/',
+            'aud': self.audience,
+            'sub': subject,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions),
+        }
+        payload.update(claims)
+        return jwt.encode(payload, self._pem, algorithm='RS256',
+                          headers={'kid': self.kid})
+
+    def jwks(self):
+        return {'keys': [{
+            'kty': 'RSA',
+            'kid': self.kid,
+            'use': 'sig',
+            'alg': 'RS256',
+            'n': b64_int(self.key.n),
+            'e': b64_int(self.key.e),
+        }]}
+
+    def write_jwks(self, path):
+        with open(path, 'w') as jwks_file:
+            json.dump(self.jwks(), jwks_file)
+        return 'file://' + path
+
+
+_default_issuer = None
+
+
+# issuer for AUTH0_DOMAIN and API_AUDIENCE, created on first use
+def default_issuer():
+    global _default_issuer
+    if _default_issuer is None:
+        _default_issuer = LocalIssuer(os.environ['AUTH0_DOMAIN'],
+                                      os.environ['API_AUDIENCE'])
+    return _default_issuer
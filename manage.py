@@ -1,13 +1,29 @@
-from flask_script import Manager
+from flask_script import Command, Manager
 from flask_migrate import Migrate, MigrateCommand
 
-from app import app
+from app import create_app
+from idempotency import purge_expired
 from models import db
 
-migrate = Migrate(app, db)
-manager = Manager(app)
+
+# the app is only built when a command runs
+def create_manage_app():
+    app = create_app()
+    Migrate(app, db)
+    return app
+
+
+class PurgeIdempotencyKeys(Command):
+    """Deletes the expired Idempotency-Key responses"""
+
+    def run(self):
+        print('%d expired idempotency keys deleted' % purge_expired())
+
+
+manager = Manager(create_manage_app)
 
 manager.add_command('db', MigrateCommand)
+manager.add_command('purge_idempotency_keys', PurgeIdempotencyKeys())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,164 @@
+import threading
+from bisect import bisect_left
+
+# upper bounds in seconds, an implicit +Inf bucket follows the last one
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+'''
+Histogram
+    Thread safe histogram with fixed buckets. observe() is a bisect and
+    three additions under a lock, cheap enough for every request.
+'''
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    # cumulative counts per upper bound, like Prometheus expects them
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+            count = self._count
+        cumulative = []
+        running = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),),
+                                       counts):
+            running += bucket_count
+            cumulative.append((bound, running))
+        return {'buckets': cumulative, 'sum': total, 'count': count}
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+'''
+MetricFamily
+    a counter or histogram per combination of label values, created on
+    first use by labels(*values)
+'''
+
+
+class MetricFamily:
+    def __init__(self, name, documentation, kind, labelnames, factory):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self._factory = factory
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._factory())
+        return child
+
+    def samples(self):
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            labels = list(zip(self.labelnames, values))
+            if self.kind == 'counter':
+                yield self.name, labels, child.value
+                continue
+            yield from histogram_samples(self.name, child.snapshot(), labels)
+
+
+# samples of a Histogram.snapshot()
+def histogram_samples(name, snapshot, labels=()):
+    labels = list(labels)
+    for bound, count in snapshot['buckets']:
+        yield (name + '_bucket',
+               labels + [('le', format_value(float(bound)))], count)
+    yield name + '_sum', labels, snapshot['sum']
+    yield name + '_count', labels, snapshot['count']
+
+
+'''
+Registry
+    the metrics of the process, rendered in the Prometheus text format.
+    Collectors are callables returning (name, help, kind, samples) for
+    values that are read when scraped, e.g. the pool state.
+'''
+
+
+class Registry:
+    def __init__(self):
+        self.families = []
+        self.collectors = []
+
+    # counter names end in _total, the name of their only sample
+    def counter(self, name, documentation, labelnames=()):
+        if not name.endswith('_total'):
+            raise ValueError(f'counter {name!r} does not end in _total')
+        family = MetricFamily(name, documentation, 'counter', labelnames,
+                              Counter)
+        self.families.append(family)
+        return family
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        family = MetricFamily(name, documentation, 'histogram', labelnames,
+                              lambda: Histogram(buckets))
+        self.families.append(family)
+        return family
+
+    def collector(self, collect):
+        self.collectors.append(collect)
+        return collect
+
+    def render(self):
+        lines = []
+        metrics = [(family.name, family.documentation, family.kind,
+                    family.samples()) for family in self.families]
+        for collect in self.collectors:
+            metrics.extend(collect())
+        for name, documentation, kind, samples in metrics:
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {kind}')
+            for sample_name, labels, value in samples:
+                lines.append(sample_name + format_labels(labels) + ' ' +
+                             format_value(value))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, value.replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
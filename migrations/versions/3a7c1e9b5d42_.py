@@ -0,0 +1,32 @@
+"""table versions for conditional GET
+
+Revision ID: 3a7c1e9b5d42
+Revises: 20e5db4060b9
+Create Date: 2026-10-18 09:12:40.118305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3a7c1e9b5d42'
+down_revision = '20e5db4060b9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_versions = op.create_table('table_versions',
+    sa.Column('name', sa.String(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table_versions, [
+        {'name': 'movies', 'version': 0},
+        {'name': 'actors', 'version': 0},
+    ])
+
+
+def downgrade():
+    op.drop_table('table_versions')
@@ -0,0 +1,110 @@
+"""typed release date and age, indexes for list filters
+
+Revision ID: 7f3b2a6c9e08
+Revises: c41d8e2f7a15
+Create Date: 2026-10-18 13:45:02.731960
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import datetime
+
+
+# revision identifiers, used by Alembic.
+revision = '7f3b2a6c9e08'
+down_revision = 'c41d8e2f7a15'
+branch_labels = None
+depends_on = None
+
+
+# release years like '2002' become the first of January
+def release_date(value):
+    value = str(value)
+    if len(value) == 4 and value.isdigit():
+        return datetime.date(int(value), 1, 1)
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+# rewrites every release date as YYYY-MM-DD, a value that is no date
+# stops the migration instead of being dropped
+def convert_release_dates(bind):
+    movies = sa.table('movies', sa.column('id', sa.Integer),
+                      sa.column('date', sa.String))
+    converted = []
+    invalid = []
+    for movie_id, value in bind.execute(
+            sa.select([movies.c.id, movies.c.date])
+            .where(movies.c.date.isnot(None)).order_by(movies.c.id)):
+        try:
+            iso = release_date(value).isoformat()
+        except ValueError:
+            invalid.append(f'{movie_id}: {value!r}')
+            continue
+        if iso != value:
+            converted.append({'movie_id': movie_id, 'iso': iso})
+    if invalid:
+        raise RuntimeError(
+            'movies whose release date is neither a year nor a '
+            'YYYY-MM-DD date (id: date): ' + ', '.join(invalid) +
+            '; correct them and run the upgrade again')
+    if converted:
+        bind.execute(movies.update()
+                     .where(movies.c.id == sa.bindparam('movie_id'))
+                     .values(date=sa.bindparam('iso')), converted)
+
+
+# ages have to be whole numbers of at least 0 already, anything else
+# stops the migration instead of being rewritten
+def check_ages(bind):
+    actors = sa.table('actors', sa.column('id', sa.Integer),
+                      sa.column('age', sa.Integer))
+    invalid = [
+        f'{actor_id}: {value!r}' for actor_id, value in bind.execute(
+            sa.select([actors.c.id, sa.cast(actors.c.age, sa.String)])
+            .where(actors.c.age.isnot(None)).order_by(actors.c.id))
+        if not value.isdigit()
+    ]
+    if invalid:
+        raise RuntimeError(
+            'actors whose age is not a whole number of at least 0 '
+            '(id: age): ' + ', '.join(invalid) +
+            '; correct them and run the upgrade again')
+
+
+def upgrade():
+    bind = op.get_bind()
+    convert_release_dates(bind)
+    check_ages(bind)
+    if bind.dialect.name == 'postgresql':
+        op.alter_column('movies', 'date', type_=sa.Date(),
+                        existing_type=sa.String(),
+                        postgresql_using='date::date')
+        op.alter_column('actors', 'age', type_=sa.Integer(),
+                        existing_type=sa.Integer(),
+                        postgresql_using='age::text::integer')
+        op.execute('CREATE INDEX ix_movies_title_prefix '
+                   'ON movies (lower(title) text_pattern_ops)')
+        op.execute('CREATE INDEX ix_actors_name_prefix '
+                   'ON actors (lower(name) text_pattern_ops)')
+    else:
+        # SQLite does not enforce column types, Date reads the ISO text
+        op.execute('CREATE INDEX ix_movies_title_prefix '
+                   'ON movies (lower(title))')
+        op.execute('CREATE INDEX ix_actors_name_prefix '
+                   'ON actors (lower(name))')
+    op.create_index(op.f('ix_movies_date'), 'movies', ['date'], unique=False)
+    op.create_index(op.f('ix_actors_age'), 'actors', ['age'], unique=False)
+    op.create_index(op.f('ix_actors_gender'), 'actors', ['gender'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_actors_gender'), table_name='actors')
+    op.drop_index(op.f('ix_actors_age'), table_name='actors')
+    op.drop_index(op.f('ix_movies_date'), table_name='movies')
+    op.drop_index('ix_actors_name_prefix', table_name='actors')
+    op.drop_index('ix_movies_title_prefix', table_name='movies')
+    if op.get_bind().dialect.name == 'postgresql':
+        op.alter_column('movies', 'date', type_=sa.String(),
+                        existing_type=sa.Date(),
+                        postgresql_using='date::text')
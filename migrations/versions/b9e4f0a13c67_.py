@@ -0,0 +1,43 @@
+"""full text search vectors for titles and names
+
+Revision ID: b9e4f0a13c67
+Revises: 7f3b2a6c9e08
+Create Date: 2026-10-18 15:20:48.264719
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b9e4f0a13c67'
+down_revision = '7f3b2a6c9e08'
+branch_labels = None
+depends_on = None
+
+# table -> searched column
+SEARCHED = {'movies': 'title', 'actors': 'name'}
+
+
+def upgrade():
+    # other databases search through the in-process index of search.py
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    for table, column in SEARCHED.items():
+        op.execute(f'ALTER TABLE {table} ADD COLUMN search_vector tsvector')
+        op.execute(f"UPDATE {table} SET search_vector = to_tsvector("
+                   f"'pg_catalog.simple', coalesce({column}, ''))")
+        op.execute(f'CREATE INDEX ix_{table}_search_vector '
+                   f'ON {table} USING gin (search_vector)')
+        op.execute(f'CREATE TRIGGER {table}_search_vector_update '
+                   f'BEFORE INSERT OR UPDATE OF {column} ON {table} '
+                   f'FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger('
+                   f"search_vector, 'pg_catalog.simple', {column})")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    for table in SEARCHED:
+        op.execute(f'DROP TRIGGER {table}_search_vector_update ON {table}')
+        op.execute(f'DROP INDEX ix_{table}_search_vector')
+        op.execute(f'ALTER TABLE {table} DROP COLUMN search_vector')
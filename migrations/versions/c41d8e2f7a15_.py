@@ -0,0 +1,33 @@
+"""casting of actors in movies
+
+Revision ID: c41d8e2f7a15
+Revises: 3a7c1e9b5d42
+Create Date: 2026-10-18 11:02:17.504193
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c41d8e2f7a15'
+down_revision = '3a7c1e9b5d42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('casting',
+    sa.Column('movie_id', sa.Integer(), nullable=False),
+    sa.Column('actor_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['actor_id'], ['actors.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['movie_id'], ['movies.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('movie_id', 'actor_id')
+    )
+    op.create_index(op.f('ix_casting_actor_id'), 'casting', ['actor_id'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_casting_actor_id'), table_name='casting')
+    op.drop_table('casting')
@@ -0,0 +1,29 @@
+"""row versions of movies and actors for optimistic concurrency
+
+Revision ID: d2a8c5f1e347
+Revises: b9e4f0a13c67
+Create Date: 2026-10-18 17:05:31.402816
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2a8c5f1e347'
+down_revision = 'b9e4f0a13c67'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing rows start at version 1
+    op.add_column('movies', sa.Column('version', sa.Integer(),
+                                      nullable=False, server_default='1'))
+    op.add_column('actors', sa.Column('version', sa.Integer(),
+                                      nullable=False, server_default='1'))
+
+
+def downgrade():
+    op.drop_column('actors', 'version')
+    op.drop_column('movies', 'version')
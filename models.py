@@ -1,35 +1,557 @@
-from sqlalchemy import Column, String, create_engine
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
+from sqlalchemy import (DDL, Column, String, create_engine, event, false,
+                        select, text)
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import sessionmaker
+from flask import g, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from metrics import Histogram
+from settings import settings
+import datetime
 import json
-import os
+import time
 
-database_path = os.environ['DATABASE_URL']
+# Connection pool settings, app.config entries of the same name win
+POOL_SETTINGS = ('DB_POOL_SIZE', 'DB_MAX_OVERFLOW', 'DB_POOL_TIMEOUT',
+                 'DB_POOL_RECYCLE', 'DB_POOL_PRE_PING', 'DB_STATEMENT_TIMEOUT')
 # database_path = "postgres://{}/{}".format('localhost:5432', 'capstone')
 
-db = SQLAlchemy()
+
+'''
+RoutingSession
+    SignallingSession that runs the statements of a request on the engine
+    replicas.py picked for it (`g.db_engine`), the primary otherwise
+'''
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if has_request_context():
+            engine = g.get('db_engine')
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
+
+'''
+InstrumentedQueuePool
+    QueuePool that records how long every checkout waited for a free
+    connection and how many checkouts gave up after the pool timeout
+'''
+
+pool_checkout_wait = Histogram()
+pool_checkout_timeouts = 0
+
+
+class InstrumentedQueuePool(QueuePool):
+    def _do_get(self):
+        global pool_checkout_timeouts
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            pool_checkout_timeouts += 1
+            raise
+        finally:
+            pool_checkout_wait.observe(time.perf_counter() - start)
+
+
+'''
+pool_settings(config) / engine_options(config, database_path)
+    pool_settings merges app.config into the pool defaults, engine_options
+    builds the SQLAlchemy engine options from the pool settings. SQLite
+    keeps its own pool, pool sizing only applies to server databases.
+'''
+
+
+def pool_settings(config):
+    return {name: config.get(name, getattr(settings, name))
+            for name in POOL_SETTINGS}
+
+
+def engine_options(config, database_path):
+    settings = pool_settings(config)
+    options = {'pool_pre_ping': settings['DB_POOL_PRE_PING']}
+    backend = make_url(database_path).get_backend_name()
+    if backend == 'sqlite':
+        return options
+    options.update({
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': settings['DB_POOL_SIZE'],
+        'max_overflow': settings['DB_MAX_OVERFLOW'],
+        'pool_timeout': settings['DB_POOL_TIMEOUT'],
+        'pool_recycle': settings['DB_POOL_RECYCLE'],
+    })
+    # postgres:// is the scheme Heroku sets, an alias of postgresql://
+    if settings['DB_STATEMENT_TIMEOUT'] and \
+            backend in ('postgres', 'postgresql'):
+        options['connect_args'] = {
+            'options': '-c statement_timeout=%d' %
+                       settings['DB_STATEMENT_TIMEOUT']
+        }
+    return options
+
+
+'''
+pool_metrics()
+    current state of the connection pool of the bound engine
+'''
+
+
+def pool_metrics():
+    pool = db.engine.pool
+    metrics = {
+        'checkout_wait': pool_checkout_wait.snapshot(),
+        'checkout_timeouts': pool_checkout_timeouts,
+    }
+    if isinstance(pool, QueuePool):
+        metrics.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0),
+        })
+    return metrics
+
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service, the database
+    defaults to DATABASE_URL. Migrations are registered by manage.py.
 '''
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=None):
+    if database_path is None:
+        database_path = settings.DATABASE_URL
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        app.config, database_path)
     db.app = app
     db.init_app(app)
-    migrate = Migrate(app, db)
     # db.create_all()
 
 
+'''
+bump_table_version(name)
+    counts a write to table `name`. Runs inside the writing transaction,
+    so the new version becomes visible together with the written rows.
+'''
+
+
+def bump_table_version(name):
+    db.session.info.setdefault('written_tables', set()).add(name)
+    table = TableVersions.__table__
+    result = db.session.execute(
+        table.update().where(table.c.name == name)
+        .values(version=table.c.version + 1))
+    if result.rowcount == 0:
+        db.session.execute(table.insert().values(name=name, version=1))
+
+
+'''
+on_write(listener)
+    registers `listener(table_name)`, called after every commit that
+    wrote to that table
+'''
+
+write_listeners = []
+
+
+def on_write(listener):
+    write_listeners.append(listener)
+    return listener
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def notify_write_listeners(session):
+    for name in session.info.pop('written_tables', ()):
+        for listener in write_listeners:
+            listener(name)
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def forget_written_tables(session):
+    session.info.pop('written_tables', None)
+
+
+'''
+table_version(name)
+    current write count of table `name`, a single primary key lookup
+'''
+
+
+def table_version(name):
+    return table_versions(name)[name]
+
+
+def select_table_versions(names):
+    table = TableVersions.__table__
+    return select([table.c.name, table.c.version]) \
+        .where(table.c.name.in_(names))
+
+
+# versions of several tables with a single query
+def table_versions(*names):
+    rows = db.session.execute(select_table_versions(names))
+    versions = dict.fromkeys(names, 0)
+    versions.update((name, version) for name, version in rows)
+    return versions
+
+
+'''
+Column parsers and encoders
+    parsers turn request values into column values and raise ValueError
+    on bad input, encoders turn column values into JSON values
+'''
+
+
+# accepts a release year ('2002') or a full date ('2002-07-03')
+def parse_date(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        value = str(value)
+    if not isinstance(value, str):
+        raise ValueError('date must be a string')
+    if len(value) == 4 and value.isdigit():
+        return datetime.date(int(value), 1, 1)
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+# accepts a whole number (32) or a string of digits ('32')
+def parse_age(value):
+    if isinstance(value, str) and value.isdigit():
+        value = int(value)
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ValueError('age must be a whole number')
+    if value < 0:
+        raise ValueError('age must not be negative')
+    return value
+
+
+def encode_date(value):
+    return None if value is None else value.isoformat()
+
+
+'''
+bulk_insert(model, rows)
+    inserts a list of column dicts in one transaction and returns the new
+    ids in the order of `rows`. Postgres gets multi-row
+    INSERT ... VALUES ... RETURNING id statements, other databases fall
+    back to bulk_insert_mappings.
+'''
+
+
+def bulk_insert(model, rows):
+    try:
+        if db.engine.dialect.implicit_returning:
+            ids = []
+            table = model.__table__
+            chunk_size = settings.BULK_CHUNK_SIZE
+            for start in range(0, len(rows), chunk_size):
+                chunk = rows[start:start + chunk_size]
+                result = db.session.execute(
+                    table.insert().values(chunk).returning(table.c.id))
+                ids.extend(row[0] for row in result)
+        else:
+            mappings = [dict(row) for row in rows]
+            db.session.bulk_insert_mappings(
+                model, mappings, return_defaults=True)
+            ids = [mapping['id'] for mapping in mappings]
+        bump_table_version(model.__tablename__)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return ids
+
+
+'''
+VersionMismatch
+    raised by update_by_id and delete_by_id when the row exists but its
+    version is none of the expected `versions`
+'''
+
+
+class VersionMismatch(Exception):
+    pass
+
+
+# the row with `row_id`, restricted to `versions` unless that is None
+def version_filter(table, row_id, versions):
+    where = table.c.id == row_id
+    if versions is not None:
+        where = where & (table.c.version.in_(versions) if versions
+                         else false())
+    return where
+
+
+# called when a conditional write matched no row
+def check_version_mismatch(table, row_id, versions):
+    if versions is not None and db.session.execute(
+            select([table.c.id]).where(table.c.id == row_id)).first():
+        raise VersionMismatch()
+
+
+'''
+update_by_id(model, row_id, values, versions=None)
+    updates one row with a single UPDATE ... RETURNING statement and
+    returns the updated row or None when no row has that id. Databases
+    without RETURNING read the row back after the UPDATE. The row version
+    is bumped by the same statement, and with `versions` the statement
+    only matches while the row has one of them.
+'''
+
+
+def update_by_id(model, row_id, values, versions=None):
+    table = model.__table__
+    where = version_filter(table, row_id, versions)
+    try:
+        if not values:
+            row = db.session.execute(table.select().where(where)).first()
+        elif db.engine.dialect.implicit_returning:
+            row = db.session.execute(
+                table.update().where(where)
+                .values(version=table.c.version + 1, **values)
+                .returning(*table.c)).first()
+        else:
+            result = db.session.execute(
+                table.update().where(where)
+                .values(version=table.c.version + 1, **values))
+            row = None
+            if result.rowcount:
+                row = db.session.execute(
+                    table.select().where(table.c.id == row_id)).first()
+        if row is None:
+            check_version_mismatch(table, row_id, versions)
+        elif values:
+            bump_table_version(model.__tablename__)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return row
+
+
+'''
+update_many(model, items)
+    applies a batch of (id, version, values) updates in one transaction.
+    A row is only updated while its version still equals the one the
+    client read (None skips the check), and the same statement bumps the
+    version. Returns {id: (status, version)} with the status 'updated',
+    'not_found' or 'conflict' and the current version of the row.
+    Postgres updates a whole chunk with one UPDATE ... FROM (VALUES ...)
+    whose outcomes come back with it, other databases run one UPDATE per
+    row and read the versions back with one SELECT per chunk.
+'''
+
+
+def update_many(model, items):
+    table = model.__table__
+    fields = [field for field in model.json_fields if field != 'id' and
+              any(field in values for _, _, values in items)]
+    chunk_size = settings.BULK_CHUNK_SIZE
+    outcomes = {}
+    try:
+        for start in range(0, len(items), chunk_size):
+            chunk = items[start:start + chunk_size]
+            if db.engine.dialect.name == 'postgresql':
+                outcomes.update(update_from_values(table, fields, chunk))
+            else:
+                outcomes.update(update_row_by_row(table, chunk))
+        if any(status == 'updated' for status, _ in outcomes.values()):
+            bump_table_version(model.__tablename__)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return outcomes
+
+
+def update_from_values(table, fields, chunk):
+    dialect = db.engine.dialect
+    quote = dialect.identifier_preparer.quote
+    columns = ['id', 'version'] + fields
+    # typed casts, a column of NULLs in VALUES would have no type
+    types = {column: table.c[column].type.compile(dialect=dialect)
+             for column in columns}
+    rows = []
+    params = {}
+    for index, (row_id, version, values) in enumerate(chunk):
+        cells = dict(values, id=row_id, version=version)
+        for column in columns:
+            params[f'{column}_{index}'] = cells.get(column)
+        rows.append('(' + ', '.join(
+            f'CAST(:{column}_{index} AS {types[column]})'
+            for column in columns) + ')')
+    name = quote(table.name)
+    # fields missing from an item keep their value
+    assignments = ''.join(
+        f'{quote(field)} = COALESCE(v.{quote(field)}, t.{quote(field)}), '
+        for field in fields)
+    statement = text(
+        f'WITH v ({", ".join(quote(column) for column in columns)}) '
+        f'AS (VALUES {", ".join(rows)}), '
+        f'u AS (UPDATE {name} AS t SET {assignments}'
+        'version = t.version + 1 FROM v WHERE t.id = v.id '
+        'AND (v.version IS NULL OR t.version = v.version) '
+        'RETURNING t.id, t.version) '
+        # the outer query sees the rows as they were before the UPDATE
+        'SELECT v.id, u.version, c.version FROM v '
+        'LEFT JOIN u ON u.id = v.id '
+        f'LEFT JOIN {name} AS c ON c.id = v.id')
+    outcomes = {}
+    for row_id, updated, current in db.session.execute(statement, params):
+        if updated is not None:
+            outcomes[row_id] = ('updated', updated)
+        elif current is not None:
+            outcomes[row_id] = ('conflict', current)
+        else:
+            outcomes[row_id] = ('not_found', None)
+    return outcomes
+
+
+def update_row_by_row(table, chunk):
+    updated = set()
+    for row_id, version, values in chunk:
+        where = table.c.id == row_id
+        if version is not None:
+            where = where & (table.c.version == version)
+        result = db.session.execute(
+            table.update().where(where)
+            .values(version=table.c.version + 1, **values))
+        if result.rowcount:
+            updated.add(row_id)
+    versions = dict(db.session.execute(
+        select([table.c.id, table.c.version])
+        .where(table.c.id.in_([row_id for row_id, _, _ in chunk])))
+        .fetchall())
+    outcomes = {}
+    for row_id, _, _ in chunk:
+        if row_id in updated:
+            outcomes[row_id] = ('updated', versions[row_id])
+        elif row_id in versions:
+            outcomes[row_id] = ('conflict', versions[row_id])
+        else:
+            outcomes[row_id] = ('not_found', None)
+    return outcomes
+
+
+'''
+delete_by_id(model, row_id, versions=None)
+    deletes one row with a single DELETE statement and returns whether a
+    row with that id existed, `versions` works as for update_by_id
+'''
+
+
+def delete_by_id(model, row_id, versions=None):
+    table = model.__table__
+    try:
+        result = db.session.execute(
+            table.delete().where(version_filter(table, row_id, versions)))
+        if result.rowcount:
+            bump_table_version(model.__tablename__)
+        else:
+            check_version_mismatch(table, row_id, versions)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return result.rowcount > 0
+
+
+'''
+add_casting(movie_id, actor_id) / remove_casting(movie_id, actor_id)
+    link and unlink an actor and a movie. add_casting returns False when
+    the movie or the actor does not exist, remove_casting returns False
+    when the actor was not cast in the movie. A casting change alters the
+    embedded lists of both tables, so both versions are bumped.
+'''
+
+
+def add_casting(movie_id, actor_id):
+    try:
+        found = db.session.execute(select([
+            select([Movies.id]).where(Movies.id == movie_id).as_scalar(),
+            select([Actors.id]).where(Actors.id == actor_id).as_scalar(),
+            select([casting.c.movie_id]).where(
+                (casting.c.movie_id == movie_id) &
+                (casting.c.actor_id == actor_id)).as_scalar(),
+        ])).first()
+        if found[0] is None or found[1] is None:
+            return False
+        if found[2] is None:
+            db.session.execute(casting.insert().values(
+                movie_id=movie_id, actor_id=actor_id))
+            bump_table_version(Movies.__tablename__)
+            bump_table_version(Actors.__tablename__)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        # a concurrent request cast the actor first
+        if not is_cast(movie_id, actor_id):
+            raise
+    except Exception:
+        db.session.rollback()
+        raise
+    return True
+
+
+def is_cast(movie_id, actor_id):
+    return db.session.execute(select([casting.c.movie_id]).where(
+        (casting.c.movie_id == movie_id) &
+        (casting.c.actor_id == actor_id))).first() is not None
+
+
+def remove_casting(movie_id, actor_id):
+    try:
+        result = db.session.execute(casting.delete().where(
+            (casting.c.movie_id == movie_id) &
+            (casting.c.actor_id == actor_id)))
+        if result.rowcount:
+            bump_table_version(Movies.__tablename__)
+            bump_table_version(Actors.__tablename__)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return result.rowcount > 0
+
+
+casting = db.Table(
+    'casting',
+    Column('movie_id', db.Integer,
+           db.ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True),
+    Column('actor_id', db.Integer,
+           db.ForeignKey('actors.id', ondelete='CASCADE'), primary_key=True,
+           index=True)
+)
+
+
 class Movies(db.Model):
     __tablename__ = 'movies'
+    json_fields = ('id', 'title', 'date')
+    parsers = {'date': parse_date}
+    encoders = {'date': encode_date}
 
     id = Column(db.Integer, primary_key=True)
     title = Column(String)
-    date = Column(String)
+    date = Column(db.Date, index=True)
+    # bumped by every update, see update_many
+    version = Column(db.Integer, nullable=False, default=1,
+                     server_default='1')
+    # loaded on access, lists embed the cast with serializers.related_query
+    actors = db.relationship(
+        'Actors', secondary=casting, passive_deletes=True,
+        backref=db.backref('movies', passive_deletes=True))
 
     def __init__(self, title, date):
         self.title = title
@@ -37,30 +559,39 @@ class Movies(db.Model):
 
     def insert(self):
         db.session.add(self)
+        bump_table_version(self.__tablename__)
         db.session.commit()
 
     def update(self):
+        self.version = Movies.version + 1
+        bump_table_version(self.__tablename__)
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        bump_table_version(self.__tablename__)
         db.session.commit()
 
     def format(self):
         return {
             'id': self.id,
             'title': self.title,
-            'date': self.date
+            'date': encode_date(self.date)
         }
 
 
 class Actors(db.Model):
     __tablename__ = 'actors'
+    json_fields = ('id', 'name', 'gender', 'age')
+    parsers = {'age': parse_age}
+    encoders = {}
 
     id = Column(db.Integer, primary_key=True)
     name = Column(String)
-    gender = Column(String)
-    age = Column(String)
+    gender = Column(String, index=True)
+    age = Column(db.Integer, index=True)
+    version = Column(db.Integer, nullable=False, default=1,
+                     server_default='1')
 
     def __init__(self, name, gender, age):
         self.name = name
@@ -69,13 +600,17 @@ class Actors(db.Model):
 
     def insert(self):
         db.session.add(self)
+        bump_table_version(self.__tablename__)
         db.session.commit()
 
     def update(self):
+        self.version = Actors.version + 1
+        bump_table_version(self.__tablename__)
         db.session.commit()
 
     def delete(self):
         db.session.delete(self)
+        bump_table_version(self.__tablename__)
         db.session.commit()
 
     def format(self):
@@ -85,3 +620,71 @@ class Actors(db.Model):
             'gender': self.gender,
             'age': self.age
         }
+
+
+'''
+Search vectors
+    on Postgres titles and names are searched through a `search_vector`
+    tsvector column kept up to date by a trigger and served by a GIN
+    index (see search.py). The column is not mapped; create_all builds it
+    with the statements of migration b9e4f0a13c67.
+'''
+
+SEARCHED_COLUMNS = {Movies.__table__: 'title', Actors.__table__: 'name'}
+
+
+def search_vector_ddl(table, column):
+    return [
+        f'ALTER TABLE {table} ADD COLUMN search_vector tsvector',
+        f"UPDATE {table} SET search_vector = to_tsvector("
+        f"'pg_catalog.simple', coalesce({column}, ''))",
+        f'CREATE INDEX ix_{table}_search_vector '
+        f'ON {table} USING gin (search_vector)',
+        f'CREATE TRIGGER {table}_search_vector_update '
+        f'BEFORE INSERT OR UPDATE OF {column} ON {table} '
+        f'FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger('
+        f"search_vector, 'pg_catalog.simple', {column})",
+    ]
+
+
+for searched_table, searched_column in SEARCHED_COLUMNS.items():
+    for statement in search_vector_ddl(searched_table.name, searched_column):
+        event.listen(searched_table, 'after_create',
+                     DDL(statement).execute_if(dialect='postgresql'))
+
+
+'''
+TableVersions
+    one row per table counting the writes to it, used to answer
+    conditional GETs without reading the table itself
+'''
+
+
+class TableVersions(db.Model):
+    __tablename__ = 'table_versions'
+
+    name = Column(String, primary_key=True)
+    version = Column(db.Integer, nullable=False, default=0)
+
+
+'''
+IdempotencyKeys
+    one row per Idempotency-Key of a client (`owner` is the token
+    subject). `status` is NULL while the first request with the key is
+    running and holds the stored response afterwards, see idempotency.py
+'''
+
+
+class IdempotencyKeys(db.Model):
+    __tablename__ = 'idempotency_keys'
+
+    owner = Column(String(255), primary_key=True)
+    key = Column(String(255), primary_key=True)
+    # SHA-256 of the method, path, query string and body of the first request
+    fingerprint = Column(String(64), nullable=False)
+    status = Column(db.Integer)
+    headers = Column(db.Text)
+    body = Column(db.LargeBinary)
+    # seconds since the epoch
+    created_at = Column(db.Float, nullable=False)
+    expires_at = Column(db.Float, nullable=False, index=True)
@@ -0,0 +1,78 @@
+import base64
+import json
+from settings import settings
+
+
+'''
+Keyset pagination
+    Pages are read with `WHERE id > :last_id ORDER BY id LIMIT :limit`,
+    so every page costs one index range scan no matter how deep the client
+    has paged. The position is handed to the client as an opaque `next`
+    cursor, which is the url safe base64 of the last id on the page.
+'''
+
+
+# opaque url safe token of a JSON object
+def encode_position(position):
+    raw = json.dumps(position, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii') \
+        .rstrip('=')
+
+
+def decode_position(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        position = json.loads(raw.decode('utf-8'))
+    except Exception:
+        raise ValueError('invalid cursor')
+    if not isinstance(position, dict):
+        raise ValueError('invalid cursor')
+    return position
+
+
+def encode_cursor(last_id):
+    return encode_position({'id': last_id})
+
+
+def decode_cursor(cursor):
+    last_id = decode_position(cursor).get('id')
+    if not isinstance(last_id, int) or isinstance(last_id, bool):
+        raise ValueError('invalid cursor')
+    return last_id
+
+
+# read ?limit= from the query string, raises ValueError
+def page_limit(args):
+    limit = int(args.get('limit', settings.DEFAULT_PAGE_SIZE))
+    if limit < 1:
+        raise ValueError('invalid limit')
+    return min(limit, settings.MAX_PAGE_SIZE)
+
+
+# read ?limit= and ?next= from the query string, raises ValueError
+def page_args(args):
+    after_id = None
+    if args.get('next'):
+        after_id = decode_cursor(args['next'])
+    return page_limit(args), after_id
+
+
+# query of one page plus one row telling whether a next page exists
+def page_query(query, column, limit, after_id=None):
+    if after_id is not None:
+        query = query.filter(column > after_id)
+    return query.order_by(column).limit(limit + 1)
+
+
+# drops the extra row, returns the rows and the next cursor or None
+def split_page(rows, limit):
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1].id)
+    return rows, None
+
+
+# returns the rows of one page and the cursor of the next page or None
+def paginate(query, column, limit, after_id=None):
+    return split_page(
+        page_query(query, column, limit, after_id).all(), limit)
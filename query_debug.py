@@ -0,0 +1,139 @@
+import logging
+import re
+import time
+from collections import Counter
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from async_db import on_statement
+from models import db
+from settings import settings
+
+logger = logging.getLogger(__name__)
+
+'''
+Query debugging
+    enable_query_debug(app) watches the SQL statements of the app's
+    engine and of its read replicas (see replicas.py). Every statement of
+    a request is logged at DEBUG level, a statement slower than `slow_ms`
+    is logged as a warning together with its EXPLAIN plan, and a request
+    running the same statement shape more than `threshold` times is
+    reported as a possible N+1. Responses get a Server-Timing header with
+    the time spent in the database.
+'''
+
+
+# the statement with literals and parameter lists collapsed
+def statement_shape(statement):
+    shape = re.sub(r'\s+', ' ', statement).strip()
+    shape = re.sub(r"'(?:[^']|'')*'", '?', shape)
+    shape = re.sub(r'%\(\w+\)s|(?<!:):\w+|\$\d+|\b\d+\b', '?', shape)
+    return re.sub(r'\(\?(?:, \?)*\)', '(?)', shape)
+
+
+def explain(conn, statement, parameters):
+    if not statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+        return ''
+    if conn.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+    # a raw cursor, so the plan does not show up as a query of its own;
+    # a failed EXPLAIN aborts a Postgres transaction, so it runs in a
+    # savepoint that is rolled back
+    savepoint = conn.dialect.name != 'sqlite'
+    cursor = conn.connection.cursor()
+    try:
+        if savepoint:
+            cursor.execute('SAVEPOINT query_debug_explain')
+        try:
+            cursor.execute(prefix + statement, parameters)
+            return '\n'.join(' '.join(str(column) for column in row)
+                             for row in cursor.fetchall())
+        except Exception as error:
+            if savepoint:
+                cursor.execute('ROLLBACK TO SAVEPOINT query_debug_explain')
+            return f'no plan: {error}'
+        finally:
+            if savepoint:
+                cursor.execute('RELEASE SAVEPOINT query_debug_explain')
+    finally:
+        cursor.close()
+
+
+def enable_query_debug(app, slow_ms=None, threshold=None):
+    if slow_ms is None:
+        slow_ms = settings.SLOW_QUERY_MS
+    if threshold is None:
+        threshold = settings.N_PLUS_ONE_THRESHOLD
+
+    def log_statement(statement, elapsed, plan):
+        logger.debug('%.2f ms %s', elapsed, statement)
+        if elapsed >= slow_ms:
+            logger.warning('slow query (%.2f ms): %s\n%s',
+                           elapsed, statement, plan())
+        if has_request_context():
+            g.setdefault('query_log', []).append(
+                (statement_shape(statement), elapsed))
+
+    def watch_engine(engine):
+        @event.listens_for(engine, 'before_cursor_execute')
+        def start_timer(conn, cursor, statement, parameters, context,
+                        executemany):
+            conn.info.setdefault('debug_query_start', []).append(
+                time.perf_counter())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def log_engine_statement(conn, cursor, statement, parameters,
+                                 context, executemany):
+            elapsed = (time.perf_counter() -
+                       conn.info['debug_query_start'].pop()) * 1000
+            log_statement(statement, elapsed, lambda: '' if executemany else
+                          explain(conn, statement, parameters))
+
+        @event.listens_for(engine, 'handle_error')
+        def forget_timer(context):
+            if context.connection is not None:
+                starts = context.connection.info.get('debug_query_start')
+                if starts:
+                    starts.pop()
+
+    with app.app_context():
+        watch_engine(db.get_engine(app))
+    # replicas enabled later are watched by enable_replicas
+    app.extensions['query_debug'] = watch_engine
+    router = app.extensions.get('replicas')
+    for replica in router.replicas if router is not None else ():
+        watch_engine(replica.engine)
+
+    # statements of the ASGI mode, without a plan
+    @on_statement
+    def log_async_statement(statement, elapsed):
+        if has_request_context() and current_app._get_current_object() is app:
+            log_statement(statement, elapsed * 1000, lambda: '')
+
+    @app.before_request
+    def start_request_timer():
+        g.query_debug_start = time.perf_counter()
+
+    @app.after_request
+    def report_queries(response):
+        log = g.get('query_log', [])
+        db_ms = sum(elapsed for _, elapsed in log)
+        repeated = [(shape, count) for shape, count in
+                    Counter(shape for shape, _ in log).items()
+                    if count > threshold]
+        for shape, count in repeated:
+            logger.warning('possible N+1 in %s %s: %d runs of %s',
+                           request.method, request.path, count, shape)
+        timings = [f'db;dur={db_ms:.2f};desc="{len(log)} queries"']
+        start = g.get('query_debug_start')
+        if start is not None:
+            total_ms = (time.perf_counter() - start) * 1000
+            timings.append(f'app;dur={max(total_ms - db_ms, 0):.2f}')
+        if repeated:
+            timings.append(
+                f'nplusone;desc="{len(repeated)} repeated statements"')
+        response.headers.add('Server-Timing', ', '.join(timings))
+        return response
+
+    return app
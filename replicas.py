@@ -0,0 +1,192 @@
+import hashlib
+import itertools
+import math
+import os
+import threading
+import time
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.engine.url import make_url
+from cache import LRUCacheBackend
+from metrics import registry
+from models import engine_options
+from settings import settings
+
+'''
+Read replicas
+    enable_replicas(app) sends the GET and HEAD requests to one of the
+    DATABASE_REPLICA_URLS, picked round robin once per request so all
+    statements of a response read the same snapshot, and every other
+    request to the primary (DATABASE_URL). Replicas have to run the same
+    schema on the same kind of database as the primary.
+
+    A client that wrote (POST, PUT, PATCH or DELETE) reads from the
+    primary for `sticky_seconds` afterwards, so it sees its own writes
+    despite replication lag: the write response sets the
+    `db_primary_until` cookie, and the worker also remembers the client's
+    Authorization header for clients that drop cookies.
+
+    Each replica is checked with `SELECT 1` when the replicas are enabled
+    and then every `health_interval` seconds by a daemon thread, so
+    requests only read the result and never wait for a check, also not on
+    the event loop of asgi.py. On Postgres a connection attempt gives up
+    after REPLICA_CONNECT_TIMEOUT seconds. A replica that fails the
+    check, or loses its connection during a query, is skipped until its
+    next check; with no healthy replica left the reads go to the primary.
+'''
+
+STICKY_COOKIE = 'db_primary_until'
+READ_METHODS = ('GET', 'HEAD')
+# methods that pin the client to the primary, not e.g. CORS preflights
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+# writing clients remembered per worker
+MAX_STICKY_CLIENTS = 10000
+
+
+class Replica:
+    def __init__(self, engine):
+        self.engine = engine
+        self.healthy = True
+        self.checked_at = None
+
+
+class ReplicaRouter:
+    def __init__(self, engines, sticky_seconds, health_interval):
+        self.replicas = [Replica(engine) for engine in engines]
+        self.sticky_seconds = sticky_seconds
+        self.health_interval = health_interval
+        self.writers = LRUCacheBackend(MAX_STICKY_CLIENTS)
+        self._turn = itertools.count()
+        self._checker_pid = None
+        self._lock = threading.Lock()
+        for replica in self.replicas:
+            event.listen(replica.engine, 'handle_error',
+                         self._disconnect_listener(replica))
+
+    def _disconnect_listener(self, replica):
+        def mark_down(context):
+            if context.is_disconnect:
+                replica.healthy = False
+                replica.checked_at = time.monotonic()
+        return mark_down
+
+    def check(self, replica):
+        try:
+            with replica.engine.connect() as conn:
+                conn.execute(text('SELECT 1'))
+            replica.healthy = True
+        except Exception:
+            replica.healthy = False
+        replica.checked_at = time.monotonic()
+
+    def check_all(self):
+        for replica in self.replicas:
+            self.check(replica)
+
+    # threads do not survive a fork, every worker starts its own checker
+    def ensure_checker(self):
+        pid = os.getpid()
+        if self._checker_pid == pid:
+            return
+        with self._lock:
+            if self._checker_pid == pid:
+                return
+            self._checker_pid = pid
+            threading.Thread(target=self._run_checks, daemon=True).start()
+
+    def _run_checks(self):
+        while True:
+            time.sleep(max(self.health_interval, 0.1))
+            self.check_all()
+
+    # engine of the next healthy replica, None when all of them are down
+    def pick(self):
+        self.ensure_checker()
+        count = len(self.replicas)
+        start = next(self._turn)
+        for offset in range(count):
+            replica = self.replicas[(start + offset) % count]
+            if replica.healthy:
+                return replica.engine
+        return None
+
+    def client_key(self):
+        authorization = request.headers.get('Authorization')
+        if not authorization:
+            return None
+        return hashlib.sha256(authorization.encode()).hexdigest()
+
+    # whether the client wrote within the last sticky_seconds
+    def is_sticky(self):
+        try:
+            until = float(request.cookies.get(STICKY_COOKIE, 0))
+        except ValueError:
+            until = 0
+        if until > time.time():
+            return True
+        key = self.client_key()
+        return key is not None and self.writers.get(key) is not None
+
+    def route(self):
+        g.db_engine = None
+        if request.method in READ_METHODS and not self.is_sticky():
+            g.db_engine = self.pick()
+
+    def remember_write(self, response):
+        if request.method not in WRITE_METHODS or \
+                response.status_code >= 400 or not self.sticky_seconds:
+            return response
+        key = self.client_key()
+        if key is not None:
+            self.writers.set(key, True, self.sticky_seconds)
+        response.set_cookie(STICKY_COOKIE,
+                            '%.3f' % (time.time() + self.sticky_seconds),
+                            max_age=math.ceil(self.sticky_seconds),
+                            httponly=True)
+        return response
+
+
+def replica_engine_options(config, url, connect_timeout):
+    options = engine_options(config, url)
+    if make_url(url).get_backend_name() in ('postgres', 'postgresql'):
+        options['connect_args'] = dict(options.get('connect_args', {}),
+                                       connect_timeout=connect_timeout)
+    return options
+
+
+def enable_replicas(app, urls=None, sticky_seconds=None,
+                    health_interval=None, connect_timeout=None):
+    if urls is None:
+        urls = settings.DATABASE_REPLICA_URLS
+    if sticky_seconds is None:
+        sticky_seconds = settings.REPLICA_STICKY_SECONDS
+    if health_interval is None:
+        health_interval = settings.REPLICA_HEALTH_INTERVAL
+    if connect_timeout is None:
+        connect_timeout = settings.REPLICA_CONNECT_TIMEOUT
+    engines = [create_engine(url, **replica_engine_options(
+                   app.config, url, connect_timeout))
+               for url in urls]
+    # statements on the replicas are debugged like those on the primary
+    watch_engine = app.extensions.get('query_debug')
+    for engine in engines if watch_engine is not None else ():
+        watch_engine(engine)
+    router = ReplicaRouter(engines, sticky_seconds, health_interval)
+    # the first check runs now, before any request reads the result
+    router.check_all()
+    app.extensions['replicas'] = router
+    app.before_request(router.route)
+    app.after_request(router.remember_write)
+    return router
+
+
+@registry.collector
+def collect_replicas():
+    if not has_app_context() or 'replicas' not in current_app.extensions:
+        return []
+    replicas = current_app.extensions['replicas'].replicas
+    return [('db_replica_healthy',
+             'Whether a read replica passed its last health check.', 'gauge',
+             [('db_replica_healthy', [('replica', str(index))],
+               int(replica.healthy))
+              for index, replica in enumerate(replicas)])]
@@ -0,0 +1,168 @@
+import math
+import re
+import threading
+from decimal import Decimal
+from sqlalchemy import text
+from models import db, table_versions, Movies, Actors
+from pagination import encode_position, decode_position
+from serializers import select_rows, field_positions, to_dict
+
+'''
+Full text search over movie titles and actor names
+    Hits of both tables are ranked together and paged with a keyset
+    cursor on (rank, type, id). Ranks are rounded to six decimals so the
+    cursor compares exactly.
+
+    On Postgres the search runs on the `search_vector` tsvector columns,
+    kept up to date by triggers and served by GIN indexes, which the
+    migration and create_all both build (see models.py). Other
+    databases, e.g. SQLite in tests, use an in-process inverted index
+    that is rebuilt whenever the table versions change.
+'''
+
+SEARCH_MODELS = {'movie': Movies, 'actor': Actors}
+
+PG_SEARCH = text('''
+SELECT type, id, rank FROM (
+    SELECT 'movie' AS type, m.id AS id,
+           round(ts_rank(m.search_vector, q)::numeric, 6) AS rank
+    FROM movies m, plainto_tsquery('pg_catalog.simple', :q) q
+    WHERE m.search_vector @@ q
+    UNION ALL
+    SELECT 'actor', a.id,
+           round(ts_rank(a.search_vector, q)::numeric, 6)
+    FROM actors a, plainto_tsquery('pg_catalog.simple', :q) q
+    WHERE a.search_vector @@ q
+) hits
+WHERE :after_rank IS NULL
+   OR (rank, type, id) < (:after_rank, :after_type, :after_id)
+ORDER BY rank DESC, type DESC, id DESC
+LIMIT :limit
+''')
+
+
+def tokenize(value):
+    return re.findall(r'\w+', (value or '').lower())
+
+
+'''
+InvertedIndex
+    maps every token of a title or name to the documents containing it
+    and how often. Documents are ranked by the sum of tf * idf over the
+    query terms and must contain all of them, like plainto_tsquery.
+'''
+
+
+class InvertedIndex:
+    def __init__(self):
+        self._postings = {}
+        self._document_count = 0
+        self._versions = None
+        self._lock = threading.Lock()
+
+    def _build(self):
+        postings = {}
+        document_count = 0
+        sources = (('movie', Movies.id, Movies.title),
+                   ('actor', Actors.id, Actors.name))
+        for doc_type, id_column, text_column in sources:
+            for row_id, value in db.session.query(id_column, text_column):
+                document_count += 1
+                for token in tokenize(value):
+                    documents = postings.setdefault(token, {})
+                    key = (doc_type, row_id)
+                    documents[key] = documents.get(key, 0) + 1
+        self._postings = postings
+        self._document_count = document_count
+
+    def refresh(self):
+        versions = table_versions('movies', 'actors')
+        with self._lock:
+            if versions != self._versions:
+                self._build()
+                self._versions = versions
+
+    def search(self, query):
+        self.refresh()
+        terms = tokenize(query)
+        if not terms:
+            return []
+        with self._lock:
+            matches = [self._postings.get(term, {}) for term in terms]
+            document_count = self._document_count
+        scores = None
+        for documents in matches:
+            idf = math.log(1 + document_count / max(len(documents), 1))
+            term_scores = {key: count * idf
+                           for key, count in documents.items()}
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {key: score + term_scores[key]
+                          for key, score in scores.items()
+                          if key in term_scores}
+        return [(round(Decimal(score), 6), doc_type, row_id)
+                for (doc_type, row_id), score in scores.items()]
+
+
+inverted_index = InvertedIndex()
+
+
+def encode_search_cursor(hit):
+    rank, doc_type, row_id = hit
+    return encode_position({'rank': str(rank), 'type': doc_type,
+                            'id': row_id})
+
+
+# (rank, type, id) of the last hit of the previous page, raises ValueError
+def decode_search_cursor(cursor):
+    position = decode_position(cursor)
+    try:
+        rank = Decimal(position['rank'])
+        doc_type = position['type']
+        row_id = position['id']
+    except Exception:
+        raise ValueError('invalid cursor')
+    if doc_type not in SEARCH_MODELS or not isinstance(row_id, int) or \
+            not rank.is_finite():
+        raise ValueError('invalid cursor')
+    return rank, doc_type, row_id
+
+
+def _ranked_hits(query, limit, after):
+    if db.engine.dialect.name == 'postgresql':
+        after_rank, after_type, after_id = after or (None, None, None)
+        rows = db.session.execute(PG_SEARCH, {
+            'q': query, 'limit': limit, 'after_rank': after_rank,
+            'after_type': after_type, 'after_id': after_id})
+        return [(row.rank, row.type, row.id) for row in rows]
+    hits = sorted(inverted_index.search(query), reverse=True)
+    if after is not None:
+        hits = [hit for hit in hits if hit < after]
+    return hits[:limit]
+
+
+# returns the formatted hits of one page and the cursor of the next page
+def search(query, limit, after=None):
+    hits = _ranked_hits(query, limit + 1, after)
+    next_cursor = None
+    if len(hits) > limit:
+        hits = hits[:limit]
+        next_cursor = encode_search_cursor(hits[-1])
+    # one query per table for the rows of the whole page
+    rows = {}
+    for doc_type, model in SEARCH_MODELS.items():
+        ids = [row_id for _, hit_type, row_id in hits if hit_type == doc_type]
+        if not ids:
+            continue
+        query_rows = select_rows(model, model.json_fields) \
+            .filter(model.id.in_(ids))
+        positions = field_positions(query_rows, model.json_fields,
+                                    model.encoders)
+        for row in query_rows:
+            rows[(doc_type, row.id)] = to_dict(row, positions)
+    results = [{'type': doc_type, 'rank': float(rank),
+                doc_type: rows[(doc_type, row_id)]}
+               for rank, doc_type, row_id in hits
+               if (doc_type, row_id) in rows]
+    return results, next_cursor
@@ -0,0 +1,164 @@
+import math
+import os
+
+'''
+Settings
+    configuration of the app, read from the environment the first time a
+    setting is used rather than when a module is imported, so importing
+    the app for manage.py, gunicorn or the tests costs no configuration.
+    Every variable is parsed and validated together, once: a missing
+    required variable or a malformed value, such as a flag that is not
+    true or false or a negative number, raises SettingsError naming all
+    of them. reload() reads the environment again.
+'''
+
+REQUIRED = object()
+
+
+# true/false, 1/0, yes/no or on/off
+def flag(value):
+    value = value.strip().lower()
+    if value in ('true', '1', 'yes', 'on'):
+        return True
+    if value in ('false', '0', 'no', 'off'):
+        return False
+    raise ValueError(value)
+
+
+# a number of items, connections or milliseconds, at least 0
+def count(value):
+    value = int(value)
+    if value < 0:
+        raise ValueError(value)
+    return value
+
+
+# a batch, chunk or page size, at least 1
+def size(value):
+    value = int(value)
+    if value < 1:
+        raise ValueError(value)
+    return value
+
+
+# seconds or milliseconds, at least 0 and finite
+def duration(value):
+    value = float(value)
+    if not 0 <= value < math.inf:
+        raise ValueError(value)
+    return value
+
+
+def cache_backend(value):
+    if value not in ('lru', 'redis', 'none'):
+        raise ValueError(value)
+    return value
+
+
+def url_list(value):
+    return tuple(url.strip() for url in value.split(',') if url.strip())
+
+
+# (name, parser, default), REQUIRED variables have no default
+SETTINGS = (
+    ('DATABASE_URL', str, REQUIRED),
+    ('AUTH0_DOMAIN', str, REQUIRED),
+    ('ALGORITHMS', str, REQUIRED),
+    ('API_AUDIENCE', str, REQUIRED),
+    # read replicas, comma separated; seconds a writing client keeps
+    # reading from the primary; seconds between replica health checks;
+    # seconds a connection to a Postgres replica may take, at least 2
+    ('DATABASE_REPLICA_URLS', url_list, ()),
+    ('REPLICA_STICKY_SECONDS', duration, 5),
+    ('REPLICA_HEALTH_INTERVAL', duration, 10),
+    ('REPLICA_CONNECT_TIMEOUT', count, 2),
+    # JWKS cache
+    ('JWKS_URL', str, None),
+    ('JWKS_TTL', duration, 3600),
+    ('JWKS_REFRESH_AHEAD', duration, 300),
+    ('JWKS_MIN_REFETCH_INTERVAL', duration, 30),
+    ('JWKS_FETCH_TIMEOUT', duration, 5),
+    # number of verified tokens kept in memory, 0 disables the cache
+    ('TOKEN_CACHE_SIZE', count, 1024),
+    # connection pool, app.config entries of the same name win
+    ('DB_POOL_SIZE', count, 5),
+    ('DB_MAX_OVERFLOW', count, 10),
+    ('DB_POOL_TIMEOUT', duration, 30),
+    ('DB_POOL_RECYCLE', count, 1800),
+    ('DB_POOL_PRE_PING', flag, True),
+    # milliseconds, 0 keeps the server default
+    ('DB_STATEMENT_TIMEOUT', count, 0),
+    ('BULK_CHUNK_SIZE', size, 1000),
+    ('BULK_MAX_ITEMS', size, 10000),
+    ('DEFAULT_PAGE_SIZE', size, 50),
+    ('MAX_PAGE_SIZE', size, 500),
+    # lru, redis or none; RESPONSE_CACHE_URL is the redis:// URL
+    ('RESPONSE_CACHE_BACKEND', cache_backend, 'lru'),
+    ('RESPONSE_CACHE_URL', str, None),
+    ('RESPONSE_CACHE_SIZE', count, 256),
+    ('RESPONSE_CACHE_TTL', duration, 60),
+    ('STREAM_BATCH_SIZE', size, 1000),
+    ('STREAM_CHUNK_BYTES', size, 64 * 1024),
+    # Idempotency-Key: seconds a stored response is replayed, seconds a
+    # duplicate waits for the first request, seconds after which an
+    # unfinished first request counts as lost
+    ('IDEMPOTENCY_TTL', duration, 24 * 3600),
+    ('IDEMPOTENCY_WAIT', duration, 10),
+    ('IDEMPOTENCY_LOCK_TIMEOUT', duration, 60),
+    # opt-in query debugging, meant for development and staging
+    ('QUERY_DEBUG', flag, False),
+    ('SLOW_QUERY_MS', duration, 100),
+    ('N_PLUS_ONE_THRESHOLD', count, 5),
+)
+
+
+class SettingsError(Exception):
+    pass
+
+
+class Settings:
+    def __init__(self, environ=os.environ):
+        self._environ = environ
+        self._values = None
+
+    def load(self):
+        values = {}
+        errors = []
+        for name, parse, default in SETTINGS:
+            raw = self._environ.get(name)
+            if raw is None:
+                if default is REQUIRED:
+                    errors.append(f'{name} is not set')
+                values[name] = default
+                continue
+            try:
+                values[name] = parse(raw)
+            except ValueError:
+                errors.append(f'{name}={raw!r} is not a valid '
+                              f'{parse.__name__}')
+        if values.get('RESPONSE_CACHE_BACKEND') == 'redis' and \
+                values['RESPONSE_CACHE_URL'] is None:
+            errors.append('RESPONSE_CACHE_URL is not set')
+        if errors:
+            raise SettingsError('invalid configuration: ' + ', '.join(errors))
+        if values['JWKS_URL'] is None:
+            values['JWKS_URL'] = \
+                f'https://{values["AUTH0_DOMAIN"]}/.well-known/jwks.json'
+        self._values = values
+        return values
+
+    def reload(self):
+        self._values = None
+        return self.load()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        values = self._values if self._values is not None else self.load()
+        try:
+            return values[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+settings = Settings()
@@ -0,0 +1,69 @@
+from flask import Response, stream_with_context
+from serializers import dumps, field_positions, to_dict
+from settings import settings
+
+STREAM_FORMATS = ('ndjson', 'json')
+
+'''
+Streaming exports
+    `?stream=ndjson` writes one JSON object per line, `?stream=json` writes
+    the same document as the paginated endpoint (without `next`) as a
+    chunked JSON array. Rows are read through a server side cursor with
+    `yield_per` and encoded one by one, so memory stays flat no matter how
+    large the table is and the first bytes leave before the last row is
+    read.
+'''
+
+
+def encode_row(row, positions):
+    return dumps(to_dict(row, positions))
+
+
+def _buffered(parts, chunk_bytes):
+    # group small pieces so every write to the socket carries a full chunk
+    buffer = []
+    size = 0
+    for part in parts:
+        buffer.append(part)
+        size += len(part)
+        if size >= chunk_bytes:
+            yield b''.join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def _ndjson(rows, positions):
+    for row in rows:
+        yield encode_row(row, positions)
+        yield b'\n'
+
+
+def _json_array(rows, positions, key):
+    yield b'{"%s":[' % key.encode('ascii')
+    separator = b''
+    for row in rows:
+        yield separator
+        yield encode_row(row, positions)
+        separator = b','
+    yield b'],"success":true}\n'
+
+
+# `query` selects tuples of `model` whose columns include `fields`
+def stream_response(query, model, fields, key, stream_format,
+                    batch_size=None, chunk_bytes=None):
+    if batch_size is None:
+        batch_size = settings.STREAM_BATCH_SIZE
+    if chunk_bytes is None:
+        chunk_bytes = settings.STREAM_CHUNK_BYTES
+    positions = field_positions(query, fields, model.encoders)
+    rows = query.order_by(model.id).yield_per(batch_size)
+    if stream_format == 'ndjson':
+        parts = _ndjson(rows, positions)
+        mimetype = 'application/x-ndjson'
+    else:
+        parts = _json_array(rows, positions, key)
+        mimetype = 'application/json'
+    return Response(stream_with_context(_buffered(parts, chunk_bytes)),
+                    mimetype=mimetype)
@@ -1,10 +1,44 @@
+import asyncio
+import contextlib
+import datetime
+import hashlib
 import os
+import pickle
+import random
+import runpy
+import subprocess
+import sys
 import unittest
+from unittest import mock
 import json
-from flask_sqlalchemy import SQLAlchemy
+import tempfile
+import threading
+import time
+import testing
+import idempotency
+from flask import jsonify
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+from jose import jwt
 
 from app import create_app
-from models import setup_db, Movies, Actors
+from models import (db, setup_db, engine_options, pool_checkout_wait,
+                    InstrumentedQueuePool, IdempotencyKeys, Movies, Actors,
+                    casting)
+from sqlalchemy import create_engine, event, text
+from cache import (LRUCacheBackend, FakeSharedCache, RedisCacheBackend,
+                   ResponseCache, response_cache)
+from pagination import encode_cursor
+from serializers import dumps
+from auth import (AuthError, JWKSCache, TokenCache, Payload, Permissions,
+                  check_permissions, token_cache)
+from metrics import Registry
+from benchmark import compare, incomparable, percentile, run_scenario, \
+    scenarios
+from query_debug import enable_query_debug, explain, statement_shape
+from replicas import enable_replicas, replica_engine_options
+from settings import Settings, SettingsError
+from asgi import create_asgi_app, wsgi_environ_fix
+from async_db import AsyncDatabase
 
 
 class CapstoneTestCase(unittest.TestCase):
@@ -33,15 +67,106 @@ class CapstoneTestCase(unittest.TestCase):
 
         # binds the app to the current context
         with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
+            self.db = db
+            # create all tables, offline runs start from an empty database
             self.db.create_all()
 
     def tearDown(self):
         """Executed after reach test"""
         pass
 
+    def count_queries(self, url, token):
+        """Runs GET url and counts the SQL statements it executes"""
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            res = self.client().get(
+                url, headers={"Authorization": "Bearer "+token})
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        return res, len(statements)
+
+    def asgi_request(self, method, url, token=None, headers=(), body=b''):
+        """Runs one request through the ASGI mode, returns status,
+        headers and body"""
+        return self.asgi_requests([(method, url, token, headers, body)])[0]
+
+    def asgi_requests(self, requests):
+        """Runs (method, url, token, headers, body) requests concurrently
+        on one ASGI app"""
+        async def run():
+            database = AsyncDatabase(self.database_path, 2)
+            asgi = create_asgi_app(self.app, database)
+            try:
+                return await asyncio.gather(*(
+                    self.asgi_call(asgi, *request) for request in requests))
+            finally:
+                await asgi.close()
+
+        return asyncio.run(run())
+
+    async def asgi_call(self, asgi, method, url, token=None, headers=(),
+                        body=b''):
+        path, _, query = url.partition('?')
+        headers = [('Host', 'localhost')] + list(headers)
+        if token is not None:
+            headers.append(('Authorization', 'Bearer ' + token))
+        if body:
+            headers.append(('Content-Type', 'application/json'))
+            headers.append(('Content-Length', str(len(body))))
+        scope = {
+            'type': 'http', 'method': method, 'path': path,
+            'query_string': query.encode('latin-1'), 'root_path': '',
+            'scheme': 'http', 'http_version': '1.1',
+            'server': ('localhost', 80), 'client': ('127.0.0.1', 1234),
+            'headers': [(name.lower().encode('latin-1'),
+                         value.encode('latin-1'))
+                        for name, value in headers],
+        }
+        messages = []
+        # the body arrives in two chunks, the last one with more_body False
+        half = len(body) // 2
+        incoming = [
+            {'type': 'http.request', 'body': body[:half], 'more_body': True},
+            {'type': 'http.request', 'body': body[half:],
+             'more_body': False},
+        ]
+
+        async def receive():
+            if incoming:
+                return incoming.pop(0)
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+
+        await asgi(scope, receive, send)
+        start = messages[0]
+        return (start['status'],
+                dict((name.decode('latin-1'), value.decode('latin-1'))
+                     for name, value in start['headers']),
+                b''.join(message.get('body', b'')
+                         for message in messages[1:]))
+
+    def create_cast_movie(self, token, actor_id):
+        """Creates a movie and casts the actor in it"""
+        res = self.client().post(
+            '/movies', json={"title": "Men in Black2", "date": "2002"},
+            headers={"Authorization": "Bearer "+token}
+            )
+        movie_id = json.loads(res.data.decode('utf-8'))['movie_id']
+        self.client().post(
+            '/movies/'+str(movie_id)+'/actors/'+str(actor_id),
+            headers={"Authorization": "Bearer "+token}
+            )
+        return movie_id
+
     # Test POST /movies --RBAC - Error
     # Casting Assistant is not allowed to perform POST /movies
     def test_create_new_movie_RBAC_error(self):
@@ -107,6 +232,641 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], False)
 
+    # Test GET /movies with keyset pagination
+    def test_get_movies_paginated(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        for i in range(3):
+            self.client().post(
+                '/movies', json={"title": "Men in Black2", "date": "2002"},
+                headers={"Authorization": "Bearer "+token_Producer}
+                )
+        res = self.client().get(
+            '/movies?limit=2',
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['movies']), 2)
+        self.assertNotEqual(data['next'], None)
+        first_page_ids = [movie['id'] for movie in data['movies']]
+        res = self.client().get(
+            '/movies?limit=2&next='+data['next'],
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['movies'][0]['id'] > max(first_page_ids))
+
+    # Test GET /movies with invalid cursor - Error
+    def test_get_movies_paginated_error(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        res = self.client().get(
+            '/movies?next=not-a-cursor',
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    # Test GET /movies streamed as NDJSON
+    def test_get_movies_stream_ndjson(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        self.client().post(
+            '/movies', json={"title": "Men in Black2", "date": "2002"},
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        res = self.client().get(
+            '/movies?stream=ndjson',
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        lines = res.data.decode('utf-8').splitlines()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertTrue(len(lines) > 0)
+        self.assertTrue('title' in json.loads(lines[0]))
+
+    # Test GET /movies streamed as JSON array
+    def test_get_movies_stream_json(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        res = self.client().get(
+            '/movies?stream=json',
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['movies']), Movies.query.count())
+
+    # Test GET /movies streamed in unknown format - Error
+    def test_get_movies_stream_error(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        res = self.client().get(
+            '/movies?stream=xml',
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        self.assertEqual(res.status_code, 400)
+
+    # Test POST /movies/bulk
+    def test_create_movies_bulk(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        res = self.client().post(
+            '/movies/bulk',
+            json=[{"title": "Men in Black2", "date": "2002"},
+                  {"title": "Men in Black3", "date": "2012"}],
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([movie['index'] for movie in data['movies']], [0, 1])
+        movie = Movies.query.get(data['movies'][1]['id'])
+        self.assertEqual(movie.title, "Men in Black3")
+
+    # Test POST /movies/bulk with NDJSON body
+    def test_create_movies_bulk_ndjson(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        res = self.client().post(
+            '/movies/bulk',
+            data='{"title": "Men in Black2", "date": "2002"}\n'
+                 '{"title": "Men in Black3", "date": "2012"}\n',
+            content_type='application/x-ndjson',
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(len(data['movies']), 2)
+
+    # Test POST /movies/bulk with an invalid item - Error
+    def test_create_movies_bulk_error(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        count_before = Movies.query.count()
+        res = self.client().post(
+            '/movies/bulk',
+            json=[{"title": "Men in Black2", "date": "2002"},
+                  {"title": "Men in Black3"}],
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['errors'][0]['index'], 1)
+        self.assertEqual(Movies.query.count(), count_before)
+
+    # Test POST /movies/bulk in partial mode
+    def test_create_movies_bulk_partial(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        res = self.client().post(
+            '/movies/bulk?mode=partial',
+            json=[{"title": "Men in Black2"},
+                  {"title": "Men in Black3", "date": "2012"}],
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(data['movies'][0]['index'], 1)
+        self.assertEqual(data['errors'][0]['index'], 0)
+
+    # Test GET /movies answers 304 while the table is unchanged
+    def test_get_movies_not_modified(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        res = self.client().get(
+            '/movies',
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        etag = res.headers['ETag']
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get(
+            '/movies',
+            headers={"Authorization": "Bearer "+token_Producer,
+                     "If-None-Match": etag}
+            )
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    # Test GET /movies changes its ETag after a write
+    def test_get_movies_modified(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        res = self.client().get(
+            '/movies',
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        etag = res.headers['ETag']
+        self.client().post(
+            '/movies', json={"title": "Men in Black2", "date": "2002"},
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        res = self.client().get(
+            '/movies',
+            headers={"Authorization": "Bearer "+token_Producer,
+                     "If-None-Match": etag}
+            )
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    # Test GET /movies is served from the response cache until a write
+    def test_get_movies_cached(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        self.client().get(
+            '/movies?limit=1',
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        hits_before = response_cache.hits
+        self.client().get(
+            '/movies?limit=1',
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        self.assertEqual(response_cache.hits, hits_before + 1)
+        self.client().post(
+            '/movies', json={"title": "Men in Black2", "date": "2002"},
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        res = self.client().get(
+            '/movies?limit=1',
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(response_cache.hits, hits_before + 1)
+
+    # Test GET /movies encodes exactly like jsonify
+    def test_get_movies_encoding(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        self.client().post(
+            '/movies', json={"title": "Men in Bläck", "date": "2002"},
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        res = self.client().get(
+            '/movies?limit=500',
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        with self.app.app_context():
+            movies = Movies.query.order_by(Movies.id).limit(500).all()
+            expected = jsonify({
+                "success": True,
+                "movies": [movie.format() for movie in movies],
+                "next": json.loads(res.data.decode('utf-8'))['next']
+            }).get_data()
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.data, expected)
+
+    # Test control characters and DEL are escaped like jsonify does
+    def test_dumps_escapes(self):
+        document = {"title": "".join(chr(i) for i in range(128)),
+                    "ids": [1, -2, None, True]}
+        with self.app.app_context():
+            expected = jsonify(document).get_data()
+        self.assertEqual(dumps(document) + b'\n', expected)
+
+    # Test a failing version lookup answers 422 in both serving modes
+    def test_get_movies_versions_error(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        broken = text('SELECT name, version FROM no_such_table')
+        with mock.patch('listing.select_table_versions',
+                        lambda tables: broken):
+            res = self.client().get(
+                '/movies', headers={"Authorization": "Bearer "+token_Producer})
+            status, headers, body = self.asgi_request(
+                'GET', '/movies', token_Producer)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(status, 422)
+
+    # Test GET /movies with sparse fieldset
+    def test_get_movies_fields(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        self.client().post(
+            '/movies', json={"title": "Men in Black2", "date": "2002"},
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        res = self.client().get(
+            '/movies?fields=title',
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(list(data['movies'][0].keys()), ['title'])
+
+    # Test GET /movies with unknown field - Error
+    def test_get_movies_fields_error(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        res = self.client().get(
+            '/movies?fields=title,budget',
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        self.assertEqual(res.status_code, 400)
+
+    # Test POST /movies/<id>/actors/<id> and GET /movies?include=actors
+    def test_cast_actor(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        res = self.client().post(
+            '/actors', json={"name": "Ryan", "gender": "female", "age": "32"},
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        actor_id = json.loads(res.data.decode('utf-8'))['actor_id']
+        movie_id = self.create_cast_movie(token_Producer, actor_id)
+        res = self.client().get(
+            '/movies?include=actors&next='+encode_cursor(movie_id - 1),
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['movies'][0]['actors'][0]['id'], actor_id)
+        res = self.client().get(
+            '/actors?include=movies&next='+encode_cursor(actor_id - 1),
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(data['actors'][0]['movies'][0]['id'], movie_id)
+
+    # Test casting an actor another request just cast succeeds
+    def test_cast_actor_concurrent(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        headers = {"Authorization": "Bearer "+token_Producer}
+        res = self.client().post('/movies', json=self.new_movie,
+                                 headers=headers)
+        movie_id = json.loads(res.data)['movie_id']
+        res = self.client().post('/actors', json=self.new_actor,
+                                 headers=headers)
+        actor_id = json.loads(res.data)['actor_id']
+        with self.app.app_context():
+            engine = db.engine
+        raced = []
+
+        # the other request inserts the link after the existence check
+        def race(conn, cursor, statement, *args):
+            if statement.startswith('INSERT INTO casting') and not raced:
+                raced.append(True)
+                with engine.connect() as other:
+                    other.execute(casting.insert().values(
+                        movie_id=movie_id, actor_id=actor_id))
+
+        event.listen(engine, 'before_cursor_execute', race)
+        try:
+            res = self.client().post(
+                '/movies/%d/actors/%d' % (movie_id, actor_id),
+                headers=headers)
+        finally:
+            event.remove(engine, 'before_cursor_execute', race)
+        self.assertTrue(raced)
+        self.assertEqual(res.status_code, 200)
+
+    # Test POST /movies/<id>/actors/<id> of an unknown actor - Error
+    def test_cast_actor_error(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        setup_response = self.client().post(
+            '/movies', json={"title": "Men in Black2", "date": "2002"},
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        tmp = json.loads(setup_response.data.decode('utf-8'))
+        res = self.client().post(
+            '/movies/'+str(tmp['movie_id'])+'/actors/999999',
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        self.assertEqual(res.status_code, 404)
+
+    # Test DELETE /movies/<id>/actors/<id>
+    def test_uncast_actor(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        res = self.client().post(
+            '/actors', json={"name": "Ryan", "gender": "female", "age": "32"},
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        actor_id = json.loads(res.data.decode('utf-8'))['actor_id']
+        movie_id = self.create_cast_movie(token_Producer, actor_id)
+        url = '/movies/'+str(movie_id)+'/actors/'+str(actor_id)
+        res = self.client().delete(
+            url, headers={"Authorization": "Bearer "+token_Producer})
+        self.assertEqual(res.status_code, 200)
+        res = self.client().delete(
+            url, headers={"Authorization": "Bearer "+token_Producer})
+        self.assertEqual(res.status_code, 404)
+
+    # Test GET /movies?include=actors runs the same number of queries
+    # no matter how many movies are on the page
+    def test_get_movies_include_query_count(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        res = self.client().post(
+            '/actors', json={"name": "Ryan", "gender": "female", "age": "32"},
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        actor_id = json.loads(res.data.decode('utf-8'))['actor_id']
+        first_id = self.create_cast_movie(token_Producer, actor_id)
+        url = '/movies?include=actors&next='+encode_cursor(first_id - 1)
+        res, few_rows_queries = self.count_queries(url, token_Producer)
+        self.assertEqual(len(json.loads(res.data)['movies']), 1)
+        for i in range(5):
+            self.create_cast_movie(token_Producer, actor_id)
+        res, many_rows_queries = self.count_queries(url, token_Producer)
+        self.assertEqual(len(json.loads(res.data)['movies']), 6)
+        self.assertEqual(many_rows_queries, few_rows_queries)
+
+    # Test GET /movies filtered by title prefix and release date
+    def test_get_movies_filtered(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        self.client().post(
+            '/movies/bulk',
+            json=[{"title": "Zorro Returns", "date": "1998-07-17"},
+                  {"title": "zorro again", "date": "2005"},
+                  {"title": "Not Zorro", "date": "2005"}],
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        res = self.client().get(
+            '/movies?title=zorro&date_from=2000&date_to=2010-12-31',
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(len(data['movies']) > 0)
+        for movie in data['movies']:
+            self.assertTrue(movie['title'].lower().startswith('zorro'))
+            self.assertTrue('2000-01-01' <= movie['date'] <= '2010-12-31')
+
+    # Test GET /movies with invalid date filter - Error
+    def test_get_movies_filtered_error(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        res = self.client().get(
+            '/movies?date_from=yesterday',
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        self.assertEqual(res.status_code, 400)
+
+    # Test POST /movies with invalid date - Error
+    def test_create_new_movie_date_error(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        res = self.client().post(
+            '/movies', json={"title": "Men in Black2", "date": "soon"},
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        self.assertEqual(res.status_code, 400)
+
+    # Test GET /search finds movies and actors ranked together
+    def test_search(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        self.client().post(
+            '/movies', json={"title": "Quokka Adventure", "date": "2002"},
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        self.client().post(
+            '/actors', json={"name": "Quokka Smith", "gender": "male",
+                             "age": "40"},
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        res = self.client().get(
+            '/search?q=quokka',
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(result['type'] for result in data['results']),
+                         set(['movie', 'actor']))
+        res = self.client().get(
+            '/search?q=quokka+adventure',
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        data = json.loads(res.data.decode('utf-8'))
+        for result in data['results']:
+            self.assertEqual(result['type'], 'movie')
+            self.assertTrue('adventure' in result['movie']['title'].lower())
+
+    # Test GET /search pages through all hits
+    def test_search_paginated(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        self.client().post(
+            '/movies/bulk',
+            json=[{"title": "Wombat Story", "date": "2002"},
+                  {"title": "Wombat Wombat", "date": "2003"},
+                  {"title": "Wombat Returns", "date": "2004"}],
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        seen = []
+        url = '/search?q=wombat&limit=2'
+        while url:
+            res = self.client().get(
+                url, headers={"Authorization": "Bearer "+token_Producer})
+            data = json.loads(res.data.decode('utf-8'))
+            self.assertEqual(res.status_code, 200)
+            seen.extend((r['type'], r['movie']['id']) for r in data['results'])
+            url = data['next'] and '/search?q=wombat&limit=2&next=' + \
+                data['next']
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertEqual(len(seen), Movies.query.filter(
+            Movies.title.like('Wombat%')).count())
+
+    # Test GET /search without query - Error
+    def test_search_error(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        res = self.client().get(
+            '/search',
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        self.assertEqual(res.status_code, 400)
+
+    # Test the ASGI mode answers lists exactly like the Flask views
+    def test_asgi_list_matches_flask(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        res = self.client().post(
+            '/actors', json=self.new_actor,
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        actor_id = json.loads(res.data.decode('utf-8'))['actor_id']
+        self.create_cast_movie(token_Producer, actor_id)
+        backend, response_cache.backend = response_cache.backend, None
+        try:
+            for url in ['/movies?limit=3', '/actors?include=movies',
+                        '/movies?fields=title&title=men&date_from=2000',
+                        '/actors?gender=female&limit=2']:
+                res = self.client().get(
+                    url, headers={"Authorization": "Bearer "+token_Producer})
+                status, headers, body = self.asgi_request(
+                    'GET', url, token_Producer)
+                self.assertEqual(status, res.status_code)
+                self.assertEqual(body, res.data)
+                self.assertEqual(headers['etag'], res.headers['ETag'])
+        finally:
+            response_cache.backend = backend
+
+    # Test the ASGI mode answers conditional GETs and errors like Flask
+    def test_asgi_list_errors(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        res = self.client().get(
+            '/movies', headers={"Authorization": "Bearer "+token_Producer})
+        status, headers, body = self.asgi_request(
+            'GET', '/movies', token_Producer,
+            headers=[('If-None-Match', res.headers['ETag'])])
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b'')
+        for url, token in [('/movies', None),
+                           ('/movies?fields=budget', token_Producer),
+                           ('/actors?limit=0', token_Producer)]:
+            headers = {}
+            if token is not None:
+                headers = {"Authorization": "Bearer "+token}
+            res = self.client().get(url, headers=headers)
+            status, headers, body = self.asgi_request('GET', url, token)
+            self.assertEqual(status, res.status_code)
+            self.assertEqual(json.loads(body), json.loads(res.data))
+
+    # Test the ASGI mode hands other routes to the Flask views
+    def test_asgi_fallback(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        status, headers, body = self.asgi_request(
+            'POST', '/movies', token_Producer,
+            body=json.dumps(self.new_movie).encode('utf-8'))
+        self.assertEqual(status, 201)
+        self.assertTrue(json.loads(body)['movie_id'])
+
+    # Test concurrent ASGI lists keep their request contexts apart
+    def test_asgi_concurrent_lists(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        self.client().post(
+            '/actors', json=self.new_actor,
+            headers={"Authorization": "Bearer "+token_Producer})
+        backend, response_cache.backend = response_cache.backend, None
+        try:
+            urls = ['/movies?limit=2', '/actors?limit=3', '/movies?limit=0']
+            results = self.asgi_requests(
+                [('GET', url, token_Producer, (), b'') for url in urls])
+            for url, (status, headers, body) in zip(urls, results):
+                res = self.client().get(
+                    url, headers={"Authorization": "Bearer "+token_Producer})
+                self.assertEqual(status, res.status_code)
+                self.assertEqual(body, res.data)
+        finally:
+            response_cache.backend = backend
+
+    # Test ASGI lists run the request hooks and read from replicas
+    def test_asgi_request_hooks(self):
+        replica_path = os.path.join(tempfile.mkdtemp(), 'replica.db')
+        replica = enable_replicas(
+            self.app, ['sqlite:///' + replica_path]).replicas[0]
+        enable_query_debug(self.app)
+        db.metadata.create_all(replica.engine)
+        replica.engine.execute(Movies.__table__.insert().values(
+            id=999997, title="Replica Only", date=datetime.date(2001, 1, 1)))
+        status, headers, body = self.asgi_request(
+            'GET', '/movies?title=replica', os.environ['TOKEN_ASSISTANT'])
+        self.assertEqual(status, 200)
+        self.assertEqual([movie['id'] for movie in json.loads(body)['movies']],
+                         [999997])
+        self.assertIn('desc="2 queries"', headers['server-timing'])
+
+    # Test the fallback copes with an int or zero port and no Host header
+    def test_asgi_fallback_environ(self):
+        for port in (80, '0'):
+            environ = EnvironBuilder('/movies', headers={
+                "Authorization": "Bearer "+os.environ['TOKEN_PRODUCER']
+                }).get_environ()
+            environ['SERVER_PORT'] = port
+            del environ['HTTP_HOST']
+            app_iter, status, headers = run_wsgi_app(
+                wsgi_environ_fix(self.app), environ)
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(environ['HTTP_HOST'], 'localhost:80')
+
+    # Test GET /metrics reports requests, queries and errors
+    def test_metrics(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        self.client().get(
+            '/movies', headers={"Authorization": "Bearer "+token_Producer})
+        self.client().delete(
+            '/movies/100000',
+            headers={"Authorization": "Bearer "+token_Producer})
+        self.client().get('/nowhere')
+        # a verified token with the metrics permission
+        token_cache.put('metrics-token', Payload({
+            'permissions': ['get:metrics'], 'exp': time.time() + 60}))
+        res = self.client().get(
+            '/metrics', headers={"Authorization": "Bearer metrics-token"})
+        body = res.data.decode('utf-8')
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain'))
+        self.assertIn('http_request_duration_seconds_count{endpoint="/movies"'
+                      ',method="GET",status="200"}', body)
+        self.assertIn('http_request_db_queries_bucket{endpoint="/movies"',
+                      body)
+        self.assertIn('auth_seconds_count{endpoint="/movies"}', body)
+        self.assertIn('http_errors_total{code="404"}', body)
+        self.assertIn('# TYPE http_errors_total counter', body)
+        self.assertIn('endpoint="unmatched"', body)
+
+    # Test GET /metrics without the permission - Error
+    def test_metrics_error(self):
+        token_Assistant = os.environ['TOKEN_ASSISTANT']
+        res = self.client().get(
+            '/metrics', headers={"Authorization": "Bearer "+token_Assistant})
+        self.assertEqual(res.status_code, 403)
+
+    # Test the query debug mode reports slow queries and repeated ones
+    def test_query_debug(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        enable_query_debug(self.app, slow_ms=0, threshold=2)
+
+        @self.app.route('/test-n-plus-one')
+        def n_plus_one():
+            for movie_id in range(1, 5):
+                Movies.query.get(movie_id)
+            return 'done'
+
+        with self.assertLogs('query_debug', 'WARNING') as logs:
+            res = self.client().get(
+                '/movies', headers={"Authorization": "Bearer "+token_Producer})
+        self.assertIn('db;dur=', res.headers['Server-Timing'])
+        self.assertTrue(any('slow query' in line for line in logs.output))
+        with self.assertLogs('query_debug', 'WARNING') as logs:
+            res = self.client().get('/test-n-plus-one')
+        self.assertIn('nplusone', res.headers['Server-Timing'])
+        self.assertTrue(any('possible N+1 in GET /test-n-plus-one: 4 runs'
+                            in line for line in logs.output))
+
+    # Test a failing EXPLAIN leaves the transaction usable
+    def test_query_debug_explain_error(self):
+        with self.app.app_context():
+            with db.engine.connect() as conn:
+                transaction = conn.begin()
+                conn.execute(Movies.__table__.select())
+                plan = explain(conn, 'SELECT * FROM no_such_table', ())
+                self.assertTrue(plan.startswith('no plan: '))
+                self.assertEqual(conn.execute(text('SELECT 1')).scalar(), 1)
+                transaction.rollback()
+
     # Test DELETE /movies
     def test_delete_movie(self):
         token_Producer = os.environ['TOKEN_PRODUCER']
@@ -179,6 +939,349 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 422)
         self.assertEqual(data['success'], False)
 
+    # Test PATCH /movies of an unknown movie - Error
+    def test_patch_movie_not_found(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        res = self.client().patch(
+            '/movies/999999',
+            json={"title": "Fast and Furious"},
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    # Test PATCH /movies returns the updated movie
+    def test_patch_movie_response(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        setup_response = self.client().post(
+            '/movies', json={"title": "Men in Black2", "date": "2002"},
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        tmp = json.loads(setup_response.data.decode('utf-8'))
+        res = self.client().patch(
+            '/movies/'+str(tmp['movie_id']),
+            json={"title": "Fast and Furious"},
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated movie'], {
+            "id": tmp['movie_id'], "title": "Fast and Furious",
+            "date": "2002-01-01"
+        })
+
+    # Test a retried POST /movies with the same Idempotency-Key
+    def test_create_movie_idempotent(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        headers = {"Authorization": "Bearer "+token_Producer,
+                   "Idempotency-Key": "create-%f" % time.time()}
+        first = self.client().post('/movies', json=self.new_movie,
+                                   headers=headers)
+        retry = self.client().post('/movies', json=self.new_movie,
+                                   headers=headers)
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry.headers['ETag'], first.headers['ETag'])
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        movie_id = json.loads(first.data)['movie_id']
+        self.assertEqual(Movies.query.filter(Movies.id > movie_id).count(),
+                         0)
+        # the same key for another movie
+        res = self.client().post('/movies', json={
+            "title": "Heat", "date": "1995"}, headers=headers)
+        self.assertEqual(res.status_code, 422)
+
+    # Test the same key and body with another query string is refused
+    def test_bulk_idempotent_query_string(self):
+        headers = {"Authorization": "Bearer "+os.environ['TOKEN_PRODUCER'],
+                   "Idempotency-Key": "bulk-%f" % time.time()}
+        movies = [{"title": "Heat", "date": "1995"}]
+        res = self.client().post('/movies/bulk?mode=atomic', json=movies,
+                                 headers=headers)
+        self.assertEqual(res.status_code, 201)
+        res = self.client().post('/movies/bulk?mode=partial', json=movies,
+                                 headers=headers)
+        self.assertEqual(res.status_code, 422)
+
+    # Test a failed store neither loses the response nor frees the key
+    def test_create_movie_idempotent_store_error(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        owner = jwt.get_unverified_claims(token_Producer).get('sub', '')
+        table = IdempotencyKeys.__table__
+        for failures, stored in ((1, 201), (idempotency.STORE_ATTEMPTS,
+                                            None)):
+            key = "store-%d-%f" % (failures, time.time())
+            headers = {"Authorization": "Bearer "+token_Producer,
+                       "Idempotency-Key": key}
+            store = idempotency.store
+            errors = [RuntimeError('store failed')] * failures
+
+            def flaky_store(*args):
+                if errors:
+                    raise errors.pop()
+                return store(*args)
+
+            # giving up on the store is logged
+            logs = contextlib.nullcontext() if stored is not None else \
+                self.assertLogs('idempotency', 'ERROR')
+            with mock.patch('idempotency.store', flaky_store), logs:
+                res = self.client().post('/movies', json=self.new_movie,
+                                         headers=headers)
+            self.assertEqual(res.status_code, 201)
+            with self.app.app_context():
+                row = db.session.execute(table.select().where(
+                    (table.c.owner == owner) & (table.c.key == key))).first()
+            self.assertEqual(row.status, stored)
+
+    # Test a duplicate waits for the response of the running request
+    def test_create_movie_idempotent_wait(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        key = "wait-%f" % time.time()
+        body = json.dumps(self.new_movie).encode('utf-8')
+        owner = jwt.get_unverified_claims(token_Producer).get('sub', '')
+        table = IdempotencyKeys.__table__
+        with self.app.app_context():
+            # the first request is still running
+            db.session.execute(table.insert().values(
+                owner=owner, key=key,
+                fingerprint=hashlib.sha256(
+                    b'POST /movies?\n' + body).hexdigest(),
+                created_at=time.time(), expires_at=time.time() + 60))
+            db.session.commit()
+
+        def finish():
+            time.sleep(0.2)
+            with self.app.app_context():
+                db.session.execute(table.update().where(
+                    table.c.key == key).values(
+                    status=201, body=b'{"movie_id": 0, "success": true}',
+                    headers='{"Content-Type": "application/json"}'))
+                db.session.commit()
+
+        finisher = threading.Thread(target=finish)
+        finisher.start()
+        res = self.client().post(
+            '/movies', data=body, content_type='application/json',
+            headers={"Authorization": "Bearer "+token_Producer,
+                     "Idempotency-Key": key})
+        finisher.join()
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(json.loads(res.data)['movie_id'], 0)
+
+    # Test single movies carry their version as ETag
+    def test_get_single_movie(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        headers = {"Authorization": "Bearer "+token_Producer}
+        res = self.client().post('/movies', json=self.new_movie,
+                                 headers=headers)
+        movie_id = json.loads(res.data)['movie_id']
+        self.assertEqual(res.headers['ETag'], '"movies-%d-v1"' % movie_id)
+        res = self.client().get('/movies/%d' % movie_id, headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['movie']['title'],
+                         "Men in Black")
+        res = self.client().get(
+            '/movies/%d' % movie_id,
+            headers=dict(headers, **{"If-None-Match": res.headers['ETag']}))
+        self.assertEqual(res.status_code, 304)
+        res = self.client().get('/movies/999999', headers=headers)
+        self.assertEqual(res.status_code, 404)
+
+    # Test a single movie is read without loading its cast
+    def test_get_single_movie_queries(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        res = self.client().post(
+            '/actors', json=self.new_actor,
+            headers={"Authorization": "Bearer "+token_Producer})
+        movie_id = self.create_cast_movie(
+            token_Producer, json.loads(res.data)['actor_id'])
+        res, queries = self.count_queries('/movies/%d' % movie_id,
+                                          token_Producer)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(queries, 1)
+
+    # Test If-Match rejects writes based on an outdated version
+    def test_patch_movie_if_match(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        headers = {"Authorization": "Bearer "+token_Producer}
+        res = self.client().post('/movies', json=self.new_movie,
+                                 headers=headers)
+        movie_id = json.loads(res.data)['movie_id']
+        first = dict(headers, **{"If-Match": res.headers['ETag']})
+        res = self.client().patch('/movies/%d' % movie_id,
+                                  json={"title": "Heat"}, headers=first)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['ETag'], '"movies-%d-v2"' % movie_id)
+        second = dict(headers, **{"If-Match": res.headers['ETag']})
+        # another writer that read version 1
+        res = self.client().patch('/movies/%d' % movie_id,
+                                  json={"title": "Ronin"}, headers=first)
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(json.loads(res.data)['success'], False)
+        res = self.client().delete('/movies/%d' % movie_id, headers=first)
+        self.assertEqual(res.status_code, 412)
+        self.assertEqual(Movies.query.get(movie_id).title, "Heat")
+        res = self.client().delete('/movies/%d' % movie_id, headers=second)
+        self.assertEqual(res.status_code, 200)
+
+    # Test GETs read from a replica and a writing client from the primary
+    def test_read_replica_routing(self):
+        replica_path = os.path.join(tempfile.mkdtemp(), 'replica.db')
+        replica = enable_replicas(self.app, ['sqlite:///' + replica_path],
+                                  sticky_seconds=60).replicas[0]
+        db.metadata.create_all(replica.engine)
+        # a row only the replica has
+        replica.engine.execute(Movies.__table__.insert().values(
+            id=999998, title="Replica Only", date=datetime.date(2001, 1, 1)))
+        assistant = {"Authorization": "Bearer " +
+                     os.environ['TOKEN_ASSISTANT']}
+        producer = {"Authorization": "Bearer " +
+                    os.environ['TOKEN_PRODUCER']}
+        res = self.client().get('/movies/999998', headers=producer)
+        self.assertEqual(res.status_code, 200)
+        client = self.client()
+        res = client.post('/movies', json=self.new_movie, headers=producer)
+        self.assertIn('db_primary_until', res.headers['Set-Cookie'])
+        movie_id = json.loads(res.data)['movie_id']
+        # the writer reads its own write from the primary, with the
+        # cookie and through its token
+        res = client.get('/movies/%d' % movie_id, headers=producer)
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get('/movies/999998', headers=producer)
+        self.assertEqual(res.status_code, 404)
+        res = self.client().get('/movies/999998', headers=assistant)
+        self.assertEqual(res.status_code, 200)
+
+    # Test requests read the health flag and the checker updates it
+    def test_read_replica_health_checker(self):
+        replica_path = os.path.join(tempfile.mkdtemp(), 'replica.db')
+        router = enable_replicas(self.app, ['sqlite:///' + replica_path],
+                                 health_interval=0.05)
+        replica = router.replicas[0]
+        db.metadata.create_all(replica.engine)
+        headers = {"Authorization": "Bearer " +
+                   os.environ['TOKEN_ASSISTANT']}
+        checked_on = []
+        check = router.check
+
+        def record(replica):
+            checked_on.append(threading.get_ident())
+            check(replica)
+
+        router.check = record
+        replica.healthy = False
+        res = self.client().get('/movies', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        deadline = time.monotonic() + 5
+        while not replica.healthy and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertNotIn(threading.get_ident(), checked_on)
+        self.assertTrue(replica.healthy)
+
+    # Test a CORS preflight does not pin the client to the primary
+    def test_read_replica_preflight(self):
+        replica_path = os.path.join(tempfile.mkdtemp(), 'replica.db')
+        enable_replicas(self.app, ['sqlite:///' + replica_path],
+                        sticky_seconds=60)
+        res = self.client().options('/movies', headers={
+            "Origin": "http://example.com",
+            "Access-Control-Request-Method": "POST"})
+        self.assertNotIn('db_primary_until',
+                         res.headers.get('Set-Cookie', ''))
+
+    # Test statements on a replica are seen by query debugging
+    def test_read_replica_query_debug(self):
+        producer = {"Authorization": "Bearer " +
+                    os.environ['TOKEN_PRODUCER']}
+        for debug_first in (True, False):
+            app = create_app()
+            setup_db(app, self.database_path)
+            if debug_first:
+                enable_query_debug(app, threshold=0)
+            replica_path = os.path.join(tempfile.mkdtemp(), 'replica.db')
+            replica = enable_replicas(
+                app, ['sqlite:///' + replica_path]).replicas[0]
+            if not debug_first:
+                enable_query_debug(app, threshold=0)
+            db.metadata.create_all(replica.engine)
+            replica.engine.execute(Movies.__table__.insert().values(
+                id=999998, title="Replica Only",
+                date=datetime.date(2001, 1, 1)))
+            with self.assertLogs('query_debug', 'WARNING') as logs:
+                res = app.test_client().get('/movies/999998',
+                                            headers=producer)
+            self.assertEqual(res.status_code, 200)
+            self.assertIn('nplusone', res.headers['Server-Timing'])
+            self.assertTrue(any('FROM movies' in line
+                                for line in logs.output))
+
+    # Test connections to a Postgres replica time out quickly
+    def test_replica_connect_timeout(self):
+        options = replica_engine_options(
+            {'DB_STATEMENT_TIMEOUT': 100}, 'postgres://db/replica', 3)
+        self.assertEqual(options['connect_args'], {
+            'options': '-c statement_timeout=100', 'connect_timeout': 3})
+        options = replica_engine_options({}, 'sqlite://', 3)
+        self.assertNotIn('connect_args', options)
+
+    # Test reads fall back to the primary when no replica is healthy
+    def test_read_replica_fallback(self):
+        missing = os.path.join(tempfile.mkdtemp(), 'missing', 'replica.db')
+        router = enable_replicas(self.app, ['sqlite:///' + missing])
+        headers = {"Authorization": "Bearer " +
+                   os.environ['TOKEN_ASSISTANT']}
+        res = self.client().get('/movies', headers=headers)
+        self.assertEqual(res.status_code, 200)
+        self.assertFalse(router.replicas[0].healthy)
+
+    # Test PATCH /movies updates a batch and reports every id
+    def test_patch_movies_batch(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        headers = {"Authorization": "Bearer "+token_Producer}
+        res = self.client().post('/movies/bulk', json=[
+            {"title": "Heat", "date": "1995"},
+            {"title": "Ronin", "date": "1998"}], headers=headers)
+        first, second = [item['id']
+                         for item in json.loads(res.data)['movies']]
+        res = self.client().patch('/movies', json=[
+            {"id": first, "version": 1, "title": "Heat (1995)"},
+            {"id": second, "date": "1999-02-01"},
+            {"id": 999999, "title": "Nowhere"}], headers=headers)
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            [(item['id'], item['status'], item['version'])
+             for item in data['movies']],
+            [(first, 'updated', 2), (second, 'updated', 2),
+             (999999, 'not_found', None)])
+        movie = Movies.query.get(second)
+        self.assertEqual((movie.title, movie.date.isoformat()),
+                         ("Ronin", "1999-02-01"))
+        # a client that read version 1 lost the race
+        res = self.client().patch('/movies', json=[
+            {"id": first, "version": 1, "title": "Heat (stale)"}],
+            headers=headers)
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(data['movies'][0]['status'], 'conflict')
+        self.assertEqual(data['movies'][0]['version'], 2)
+        self.assertEqual(Movies.query.get(first).title, "Heat (1995)")
+
+    # Test PATCH /movies with an invalid item - Error
+    def test_patch_movies_batch_error(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        res = self.client().patch('/movies', json=[
+            {"id": 1, "title": "Heat"}, {"id": 1, "title": "Heat"},
+            {"title": "no id"}, {"id": 2, "date": "someday"}],
+            headers={"Authorization": "Bearer "+token_Producer})
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['errors'], [
+            {"index": 1, "error": "duplicate id"},
+            {"index": 2, "error": "missing id"},
+            {"index": 3, "error": "invalid date"}])
+
     # Test POST /actors =======================================
     def test_create_new_actor(self):
         token_Producer = os.environ['TOKEN_PRODUCER']
@@ -201,6 +1304,23 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 400)
         self.assertEqual(data['success'], False)
 
+    # Test POST /actors rejects ages that are not whole numbers
+    def test_create_new_actor_invalid_age(self):
+        headers = {"Authorization": "Bearer "+os.environ['TOKEN_PRODUCER']}
+        for age in ([1], {}, 41.9, "41.9", True, "-3"):
+            res = self.client().post(
+                '/actors', json={"name": "Ryan", "gender": "female",
+                                 "age": age}, headers=headers)
+            self.assertEqual(res.status_code, 400)
+        res = self.client().post(
+            '/actors/bulk', json=[{"name": "Ryan", "gender": "female",
+                                   "age": [1]}], headers=headers)
+        self.assertEqual(res.status_code, 400)
+        res = self.client().post(
+            '/actors', json={"name": "Ryan", "gender": "female", "age": 41},
+            headers=headers)
+        self.assertEqual(res.status_code, 201)
+
     # Test GET /actors
     def test_get_actors(self):
         token_Producer = os.environ['TOKEN_PRODUCER']
@@ -222,6 +1342,51 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data['success'], False)
 
+    # Test POST /actors/bulk
+    def test_create_actors_bulk(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        res = self.client().post(
+            '/actors/bulk',
+            json=[{"name": "Ryan", "gender": "female", "age": "32"},
+                  {"name": "Bud Spencer", "gender": "male", "age": "57"}],
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(len(data['actors']), 2)
+
+    # Test POST /actors/bulk --RBAC - Error
+    def test_create_actors_bulk_RBAC_error(self):
+        token_assistant = os.environ['TOKEN_ASSISTANT']
+        res = self.client().post(
+            '/actors/bulk',
+            json=[{"name": "Ryan", "gender": "female", "age": "32"}],
+            headers={"Authorization": "Bearer "+token_assistant}
+            )
+        self.assertEqual(res.status_code, 403)
+
+    # Test GET /actors filtered by name, gender and age
+    def test_get_actors_filtered(self):
+        token_Producer = os.environ['TOKEN_PRODUCER']
+        self.client().post(
+            '/actors/bulk',
+            json=[{"name": "Meg Ryan", "gender": "female", "age": "32"},
+                  {"name": "Meg Tilly", "gender": "female", "age": 61},
+                  {"name": "Meg Young", "gender": "male", "age": 40}],
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        res = self.client().get(
+            '/actors?name=meg&gender=female&age_min=30&age_max=50',
+            headers={"Authorization": "Bearer "+token_Producer}
+            )
+        data = json.loads(res.data.decode('utf-8'))
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(len(data['actors']) > 0)
+        for actor in data['actors']:
+            self.assertTrue(actor['name'].startswith('Meg'))
+            self.assertEqual(actor['gender'], 'female')
+            self.assertTrue(30 <= actor['age'] <= 50)
+
     # Test DELETE /actors
     def test_delete_actor(self):
         token_Producer = os.environ['TOKEN_PRODUCER']
@@ -295,6 +1460,496 @@ class CapstoneTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
 
 
+class JWKSCacheTestCase(unittest.TestCase):
+    """This class represents the JWKS key cache test case"""
+
+    def setUp(self):
+        self.jwks_file = tempfile.NamedTemporaryFile(
+            mode='w', suffix='.json', delete=False)
+        self.write_keys('key-1')
+        self.cache = JWKSCache('file://' + self.jwks_file.name,
+                               ttl=3600, min_refetch_interval=3600)
+
+    def tearDown(self):
+        os.remove(self.jwks_file.name)
+
+    def write_keys(self, *kids):
+        with open(self.jwks_file.name, 'w') as jwks_file:
+            json.dump({'keys': [{
+                'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': 'n', 'e': 'e'
+            } for kid in kids]}, jwks_file)
+
+    # Test the keys are fetched once and then served from memory
+    def test_jwks_cache_hit(self):
+        self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+        os.remove(self.jwks_file.name)
+        self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+        self.write_keys('key-1')
+
+    # Test an unknown kid refetches the keys only once per interval
+    def test_jwks_cache_kid_miss_rate_limited(self):
+        self.cache.min_refetch_interval = 0
+        self.cache.get_key('key-1')
+        self.write_keys('key-1', 'key-2')
+        self.assertEqual(self.cache.get_key('key-2')['kid'], 'key-2')
+        self.cache.min_refetch_interval = 3600
+        self.write_keys('key-1', 'key-2', 'key-3')
+        self.assertEqual(self.cache.get_key('key-3'), None)
+
+    # Test injected keys are served without fetching the URL
+    def test_jwks_cache_use_jwks(self):
+        cache = JWKSCache(url='file:///nonexistent/jwks.json',
+                          min_refetch_interval=0)
+        cache.use_jwks({'keys': [{'kty': 'RSA', 'kid': 'local', 'use': 'sig',
+                                  'n': 'n', 'e': 'e'}]})
+        self.assertEqual(cache.get_key('local')['kid'], 'local')
+        self.assertEqual(cache.get_key('other'), None)
+        self.assertEqual(cache.refresh(), {'local': cache.get_key('local')})
+        key = asyncio.run(cache.get_key_async('local'))
+        self.assertEqual(key['kid'], 'local')
+
+    # Test the async lookup fetches the keys once and shares them
+    def test_jwks_cache_get_key_async(self):
+        key = asyncio.run(self.cache.get_key_async('key-1'))
+        self.assertEqual(key['kid'], 'key-1')
+        os.remove(self.jwks_file.name)
+        self.assertEqual(self.cache.get_key('key-1')['kid'], 'key-1')
+        self.write_keys('key-1')
+
+    # Test concurrent async lookups wait for one fetch instead of failing
+    def test_jwks_cache_get_key_async_concurrent(self):
+        fetches = []
+        fetch = self.cache.fetch_async
+
+        async def slow_fetch():
+            fetches.append(1)
+            await asyncio.sleep(0.05)
+            return await fetch()
+
+        self.cache.fetch_async = slow_fetch
+
+        async def lookups():
+            return await asyncio.gather(
+                *(self.cache.get_key_async('key-1') for _ in range(5)))
+
+        keys = asyncio.run(lookups())
+        self.assertEqual([key['kid'] for key in keys], ['key-1'] * 5)
+        self.assertEqual(len(fetches), 1)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test case"""
+
+    def setUp(self):
+        self.cache = TokenCache(maxsize=2)
+        self.payload = {'exp': time.time() + 60, 'permissions': []}
+
+    # Test a cached token is served and counted as hit
+    def test_token_cache_hit(self):
+        self.assertEqual(self.cache.get('token-1'), None)
+        self.cache.put('token-1', self.payload)
+        self.assertEqual(self.cache.get('token-1'), self.payload)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    # Test an expired token is never returned
+    def test_token_cache_expired(self):
+        self.cache.put('token-1', {'exp': time.time() - 1})
+        self.assertEqual(self.cache.get('token-1'), None)
+        self.assertEqual(len(self.cache), 0)
+
+    # Test the least recently used token is evicted
+    def test_token_cache_lru_eviction(self):
+        self.cache.put('token-1', self.payload)
+        self.cache.put('token-2', self.payload)
+        self.cache.get('token-1')
+        self.cache.put('token-3', self.payload)
+        self.assertEqual(self.cache.get('token-2'), None)
+        self.assertEqual(self.cache.get('token-1'), self.payload)
+
+
+class PermissionsTestCase(unittest.TestCase):
+    """This class represents the compiled permissions test case"""
+
+    def setUp(self):
+        self.payload = Payload({'permissions': ['get:movies', 'get:actors']})
+
+    # Test the payload carries its permissions as frozenset
+    def test_payload_permission_set(self):
+        self.assertEqual(self.payload.permission_set,
+                         frozenset(['get:movies', 'get:actors']))
+
+    # Test all-of and any-of requirements
+    def test_check_permissions(self):
+        self.assertTrue(check_permissions('get:movies', self.payload))
+        self.assertTrue(check_permissions(
+            Permissions(all_of=['get:movies', 'get:actors']), self.payload))
+        self.assertTrue(check_permissions(
+            Permissions(any_of=['post:movies', 'get:actors']), self.payload))
+
+    # Test missing permissions are rejected with 403
+    def test_check_permissions_error(self):
+        with self.assertRaises(AuthError) as context:
+            check_permissions(
+                Permissions(any_of=['post:movies', 'patch:movies']),
+                self.payload)
+        self.assertEqual(context.exception.status_code, 403)
+
+    # Test a payload without permissions claim is rejected with 400
+    def test_check_permissions_missing_claim(self):
+        with self.assertRaises(AuthError) as context:
+            check_permissions('get:movies', Payload({}))
+        self.assertEqual(context.exception.status_code, 400)
+
+
+class PoolTestCase(unittest.TestCase):
+    """This class represents the connection pool settings test case"""
+
+    # Test the pool settings are taken from the config
+    def test_engine_options(self):
+        options = engine_options(
+            {'DB_POOL_SIZE': 3, 'DB_STATEMENT_TIMEOUT': 5000},
+            'postgresql://user@localhost:5432/capstone')
+        self.assertEqual(options['pool_size'], 3)
+        self.assertEqual(options['poolclass'], InstrumentedQueuePool)
+        self.assertEqual(options['connect_args'],
+                         {'options': '-c statement_timeout=5000'})
+        # the scheme of Heroku's DATABASE_URL
+        options = engine_options(
+            {'DB_STATEMENT_TIMEOUT': 5000},
+            'postgres://user@localhost:5432/capstone')
+        self.assertEqual(options['connect_args'],
+                         {'options': '-c statement_timeout=5000'})
+
+    # Test SQLite keeps its own pool
+    def test_engine_options_sqlite(self):
+        options = engine_options({}, 'sqlite:///capstone.db')
+        self.assertFalse('pool_size' in options)
+
+    # Test every checkout is recorded in the wait histogram
+    def test_checkout_wait_recorded(self):
+        engine = create_engine('sqlite://', poolclass=InstrumentedQueuePool)
+        count_before = pool_checkout_wait.snapshot()['count']
+        engine.connect().close()
+        self.assertEqual(pool_checkout_wait.snapshot()['count'],
+                         count_before + 1)
+
+
+class RegistryTestCase(unittest.TestCase):
+    """This class represents the Prometheus metrics registry test case"""
+
+    # Test counters and histograms render in the Prometheus text format
+    def test_render(self):
+        registry = Registry()
+        requests = registry.counter('requests_total', 'Requests.',
+                                    ('code',))
+        latency = registry.histogram('latency', 'Latency.', (), (0.1, 1))
+        requests.labels(200).inc()
+        requests.labels(200).inc()
+        latency.labels().observe(0.5)
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP requests_total Requests.',
+            '# TYPE requests_total counter',
+            'requests_total{code="200"} 2',
+            '# HELP latency Latency.',
+            '# TYPE latency histogram',
+            'latency_bucket{le="0.1"} 0',
+            'latency_bucket{le="1.0"} 1',
+            'latency_bucket{le="+Inf"} 1',
+            'latency_sum 0.5',
+            'latency_count 1',
+        ]) + '\n')
+        with self.assertRaises(ValueError):
+            registry.counter('requests', 'Requests.')
+
+
+class QueryDebugTestCase(unittest.TestCase):
+    """This class represents the statement shape test case"""
+
+    # Test statements differing in literals and list sizes share a shape
+    def test_statement_shape(self):
+        self.assertEqual(
+            statement_shape("SELECT * FROM movies WHERE id IN (?, ?, ?)"),
+            statement_shape("SELECT * FROM movies\n WHERE id IN (?)"))
+        self.assertEqual(
+            statement_shape("SELECT * FROM actors WHERE name = 'Meg'"),
+            statement_shape("SELECT * FROM actors WHERE name = %(name_1)s"))
+        self.assertNotEqual(statement_shape("SELECT id FROM movies"),
+                            statement_shape("SELECT id FROM actors"))
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    """This class represents the benchmark report test case"""
+
+    # Test percentiles are read from the sorted latencies
+    def test_percentile(self):
+        latencies = [i / 100 for i in range(1, 101)]
+        self.assertEqual(percentile(latencies, 0.5), 0.51)
+        self.assertEqual(percentile(latencies, 0.99), 0.99)
+        self.assertEqual(percentile([], 0.5), 0.0)
+
+    # Test only changes beyond the threshold count as regressions
+    def test_compare(self):
+        baseline = {'list': {'p95_ms': 10.0, 'rps': 100.0}}
+        self.assertEqual(compare(
+            {'list': {'p95_ms': 11.0, 'rps': 90.0}}, baseline, 0.2), [])
+        self.assertEqual(len(compare(
+            {'list': {'p95_ms': 13.0, 'rps': 70.0}}, baseline, 0.2)), 2)
+        self.assertEqual(compare(
+            {'new': {'p95_ms': 99.0, 'rps': 1.0}}, baseline, 0.2), [])
+
+    # Test runs at another scale or concurrency are not compared
+    def test_incomparable(self):
+        self.assertIsNone(incomparable({'scale': '1k'}, '1k', 1))
+        self.assertIn('scale 100k', incomparable(
+            {'scale': '100k', 'concurrency': 1}, '1k', 1))
+        self.assertIn('concurrency 8', incomparable(
+            {'scale': '1k', 'concurrency': 8}, '1k', 1))
+
+    # Test concurrent requests are all measured
+    def test_run_scenario_concurrency(self):
+        class Driver:
+            in_flight = 0
+            peak = 0
+            lock = threading.Lock()
+
+            def request(self, method, path, body):
+                with self.lock:
+                    self.in_flight += 1
+                    self.peak = max(self.peak, self.in_flight)
+                time.sleep(0.01)
+                with self.lock:
+                    self.in_flight -= 1
+                return 404 if path == '/2' else 200
+
+        driver = Driver()
+        result = run_scenario(driver, lambda i: ('GET', '/%d' % i, None),
+                              requests=8, warmup=0, offset=0, concurrency=4)
+        self.assertEqual((result['requests'], result['errors']), (8, 1))
+        self.assertEqual(driver.peak, 4)
+
+    # Test every endpoint of the app is driven by a scenario
+    def test_scenarios_cover_endpoints(self):
+        urls = create_app().url_map.bind('localhost')
+        driven = set()
+        for name, factory in scenarios(1000, random.Random(1)):
+            method, path, body = factory(0)
+            endpoint, _ = urls.match(path.split('?')[0], method=method)
+            driven.add(endpoint)
+        endpoints = {rule.endpoint for rule in urls.map.iter_rules()
+                     if rule.endpoint != 'static'}
+        self.assertEqual(endpoints - driven, set())
+
+
+class GunicornConfigTestCase(unittest.TestCase):
+    """This class represents the gunicorn settings test case"""
+
+    # runs gunicorn.conf.py in a copy of the environment
+    def run_config(self, **overrides):
+        environ = {name: value for name, value in os.environ.items()
+                   if name not in ('DB_POOL_SIZE', 'DB_MAX_OVERFLOW',
+                                   'WEB_CONCURRENCY', 'GUNICORN_THREADS')}
+        environ.update(overrides)
+        with mock.patch.dict(os.environ, environ, clear=True):
+            config = runpy.run_path(
+                os.path.join(os.path.dirname(__file__), 'gunicorn.conf.py'))
+            return config, dict(os.environ)
+
+    def setUp(self):
+        self.config, _ = self.run_config()
+
+    # Test the pools are sized from the connections of the dyno
+    def test_worker_count(self):
+        worker_count = self.config['worker_count']
+        pool_size = self.config['pool_size']
+        self.assertEqual(worker_count(2, 20), 5)
+        self.assertEqual(pool_size(5, 20), 4)
+        self.assertEqual(worker_count(8, 10), 10)
+        self.assertEqual(pool_size(10, 10), 1)
+        config, environ = self.run_config(DB_MAX_CONNECTIONS='20',
+                                          WEB_DYNOS='2',
+                                          WEB_CONCURRENCY='3')
+        self.assertEqual(config['workers'], 3)
+        self.assertEqual(environ['DB_POOL_SIZE'], '3')
+        self.assertEqual(environ['DB_MAX_OVERFLOW'], '0')
+        self.assertEqual(config['threads'], 3)
+        self.assertLessEqual(
+            config['workers'] * int(environ['DB_POOL_SIZE']) * 2, 20)
+
+    # Test the app is preloaded and the engine disposed around the fork
+    def test_fork_settings(self):
+        self.assertTrue(self.config['preload_app'])
+        self.assertLessEqual(self.config['max_requests_jitter'],
+                             self.config['max_requests'])
+        if self.config['threads'] > 1:
+            self.assertEqual(self.config['worker_class'], 'gthread')
+        self.config['post_fork'](None, None)
+
+
+class CacheBackendTestCase(unittest.TestCase):
+    """This class represents the response cache backends test case"""
+
+    # Test the LRU backend evicts the least recently used entry
+    def test_lru_backend_eviction(self):
+        backend = LRUCacheBackend(maxsize=2)
+        backend.set('a', 1)
+        backend.set('b', 2)
+        backend.get('a')
+        backend.set('c', 3)
+        self.assertEqual(backend.get('b'), None)
+        self.assertEqual(backend.get('a'), 1)
+
+    # Test expired entries are not returned
+    def test_lru_backend_ttl(self):
+        backend = LRUCacheBackend()
+        backend.set('a', 1, ttl=-1)
+        self.assertEqual(backend.get('a'), None)
+
+    # Test both backends count generations the same way
+    def test_backend_counters(self):
+        for backend in (LRUCacheBackend(maxsize=1), FakeSharedCache()):
+            self.assertEqual(backend.counter('movies:generation'), 0)
+            backend.incr('movies:generation')
+            backend.set('a', (b'body', 200, 'application/json'))
+            backend.set('b', (b'body', 200, 'application/json'))
+            self.assertEqual(backend.incr('movies:generation'), 2)
+            self.assertEqual(backend.get('b'),
+                             (b'body', 200, 'application/json'))
+
+    # Test shared entries are stored as JSON, not pickled
+    def test_shared_backend_json(self):
+        backend = FakeSharedCache()
+        backend.set('a', (b'\xff{}', 200, 'application/json'))
+        stored = json.loads(backend.get_bytes('a'))
+        self.assertEqual(stored, ['/3t9', 200, 'application/json'])
+        self.assertEqual(backend.get('a'),
+                         (b'\xff{}', 200, 'application/json'))
+        backend.set_bytes('b', pickle.dumps((b'', 200, 'text/plain')))
+        with self.assertRaises(ValueError):
+            backend.get('b')
+
+    # Test the Redis backend keeps its keys under its prefix
+    def test_redis_backend(self):
+        class Client:
+            def __init__(self):
+                self.entries = {}
+
+            def get(self, key):
+                return self.entries.get(key)
+
+            def set(self, key, value, px=None):
+                self.entries[key] = value
+
+            def incr(self, key):
+                self.entries[key] = str(int(self.entries.get(key, 0)) + 1)
+                return int(self.entries[key])
+
+            def scan_iter(self, match):
+                return [key for key in self.entries
+                        if key.startswith(match.rstrip('*'))]
+
+            def delete(self, *keys):
+                for key in keys:
+                    del self.entries[key]
+
+        client = Client()
+        client.entries['other'] = b'kept'
+        backend = RedisCacheBackend(client=client)
+        backend.set('a', (b'body', 200, 'application/json'), ttl=0.0001)
+        self.assertEqual(backend.incr('movies:generation'), 1)
+        self.assertEqual(backend.counter('movies:generation'), 1)
+        self.assertEqual(backend.get('a'), (b'body', 200, 'application/json'))
+        backend.clear()
+        self.assertEqual(client.entries, {'other': b'kept'})
+
+    # Test invalidation moves the namespace to a new generation
+    def test_invalidate(self):
+        cache = ResponseCache(FakeSharedCache())
+        cache.invalidate('movies')
+        self.assertEqual(cache.backend.counter('movies:generation'), 1)
+        self.assertEqual(cache.backend.counter('actors:generation'), 0)
+
+
+class StartupTestCase(unittest.TestCase):
+    """This class represents the import time and settings test case"""
+
+    # seconds `import app` may take in a fresh interpreter
+    IMPORT_BUDGET = float(os.environ.get('IMPORT_BUDGET_SECONDS', 1.5))
+
+    # Test importing the app reads no configuration and stays in budget
+    def test_import_budget(self):
+        env = {name: value for name, value in os.environ.items()
+               if name not in ('DATABASE_URL', 'AUTH0_DOMAIN', 'ALGORITHMS',
+                               'API_AUDIENCE')}
+        script = (
+            'import json, sys, time\n'
+            'start = time.perf_counter()\n'
+            'import app\n'
+            'seconds = time.perf_counter() - start\n'
+            'print(json.dumps({"seconds": seconds, "loaded": [name for name'
+            ' in ("jose", "flask_migrate", "httpx") if name in sys.modules]'
+            '}))\n')
+        output = subprocess.run(
+            [sys.executable, '-c', script], env=env, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE).stdout
+        result = json.loads(output)
+        self.assertEqual(result['loaded'], [])
+        self.assertLess(result['seconds'], self.IMPORT_BUDGET)
+
+    # Test every invalid variable is reported at once
+    def test_settings_validation(self):
+        settings = Settings({'DATABASE_URL': 'sqlite://',
+                             'AUTH0_DOMAIN': 'example.auth0.com',
+                             'TOKEN_CACHE_SIZE': 'many'})
+        with self.assertRaises(SettingsError) as context:
+            settings.TOKEN_CACHE_SIZE
+        message = str(context.exception)
+        for name in ('ALGORITHMS', 'API_AUDIENCE', 'TOKEN_CACHE_SIZE'):
+            self.assertIn(name, message)
+        settings = Settings({'DATABASE_URL': 'sqlite://',
+                             'AUTH0_DOMAIN': 'example.auth0.com',
+                             'ALGORITHMS': 'RS256', 'API_AUDIENCE': 'a'})
+        self.assertEqual(settings.JWKS_URL,
+                         'https://example.auth0.com/.well-known/jwks.json')
+        self.assertEqual(settings.DB_POOL_SIZE, 5)
+        self.assertTrue(settings.DB_POOL_PRE_PING)
+
+    # Test malformed flags and numbers are refused instead of defaulted
+    def test_settings_malformed(self):
+        environ = {'DATABASE_URL': 'sqlite://',
+                   'AUTH0_DOMAIN': 'example.auth0.com',
+                   'ALGORITHMS': 'RS256', 'API_AUDIENCE': 'a'}
+        for name, value in (('QUERY_DEBUG', 'ture'),
+                            ('DB_POOL_PRE_PING', 'enabled'),
+                            ('DB_POOL_SIZE', '-1'),
+                            ('MAX_PAGE_SIZE', '0'),
+                            ('RESPONSE_CACHE_TTL', 'nan'),
+                            ('JWKS_TTL', '-5')):
+            settings = Settings(dict(environ, **{name: value}))
+            with self.assertRaises(SettingsError) as context:
+                settings.DATABASE_URL
+            self.assertIn(f'{name}={value!r}', str(context.exception))
+        settings = Settings(dict(environ, QUERY_DEBUG='1',
+                                 DB_POOL_PRE_PING='Off'))
+        self.assertTrue(settings.QUERY_DEBUG)
+        self.assertFalse(settings.DB_POOL_PRE_PING)
+
+    # Test a misspelt or incomplete response cache backend is refused
+    def test_settings_cache_backend(self):
+        environ = {'DATABASE_URL': 'sqlite://',
+                   'AUTH0_DOMAIN': 'example.auth0.com',
+                   'ALGORITHMS': 'RS256', 'API_AUDIENCE': 'a'}
+        for backend, error in (('lur', 'RESPONSE_CACHE_BACKEND'),
+                               ('redis', 'RESPONSE_CACHE_URL')):
+            settings = Settings(dict(environ, RESPONSE_CACHE_BACKEND=backend))
+            with self.assertRaises(SettingsError) as context:
+                settings.RESPONSE_CACHE_BACKEND
+            self.assertIn(error, str(context.exception))
+        settings = Settings(dict(environ, RESPONSE_CACHE_BACKEND='redis',
+                                 RESPONSE_CACHE_URL='redis://localhost'))
+        self.assertEqual(settings.RESPONSE_CACHE_BACKEND, 'redis')
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,53 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+'''
+Test environment
+    imported by test_app.py before the app modules read their settings.
+    When TOKEN_ASSISTANT, TOKEN_DIRECTOR and TOKEN_PRODUCER are set the
+    tests run against Auth0 as before. Otherwise they run offline: the
+    tokens are minted by local_issuer.default_issuer(), whose signing
+    keys are handed to auth.jwks_cache, and every test process gets its
+    own SQLite database, so `pytest -n auto` runs the suite in parallel.
+
+    TEST_DATABASE_URL replaces DATABASE_URL in both modes, `{worker}` is
+    replaced by the pytest-xdist worker id, e.g.
+    postgresql://localhost/capstone_test_{worker}.
+'''
+
+ROLE_PERMISSIONS = {
+    'ASSISTANT': ('get:actors', 'get:movies'),
+    'DIRECTOR': ('delete:actors', 'get:actors', 'get:movies',
+                 'patch:actors', 'patch:movies', 'post:actors'),
+    'PRODUCER': ('delete:actors', 'delete:movies', 'get:actors',
+                 'get:movies', 'patch:actors', 'patch:movies',
+                 'post:actors', 'post:movies'),
+}
+
+
+def configure():
+    worker = os.environ.get('PYTEST_XDIST_WORKER', 'main')
+    if 'TEST_DATABASE_URL' in os.environ:
+        os.environ['DATABASE_URL'] = \
+            os.environ['TEST_DATABASE_URL'].format(worker=worker)
+    if all('TOKEN_' + role in os.environ for role in ROLE_PERMISSIONS):
+        return
+    os.environ.setdefault('AUTH0_DOMAIN', 'capstone.local')
+    os.environ.setdefault('ALGORITHMS', 'RS256')
+    os.environ.setdefault('API_AUDIENCE', 'Capstone')
+    if 'TEST_DATABASE_URL' not in os.environ:
+        directory = tempfile.mkdtemp(prefix=f'capstone-test-{worker}-')
+        atexit.register(shutil.rmtree, directory, True)
+        os.environ['DATABASE_URL'] = \
+            'sqlite:///' + os.path.join(directory, 'test.db')
+    from auth import jwks_cache
+    from local_issuer import default_issuer
+    issuer = default_issuer()
+    jwks_cache.use_jwks(issuer.jwks())
+    for role, permissions in ROLE_PERMISSIONS.items():
+        os.environ['TOKEN_' + role] = issuer.mint(permissions)
+
+
+configure()